@@ -0,0 +1,8 @@
+# Data loading and checkpointing code shared by `vessel_detector.py` and
+# `vessel_classifier.py`; both scripts add `models/` to `sys.path` to import it
+from .augment import gaussian_kernel1d, BatchAugment, REPLAY_VARIANTS, augment_variant
+from .images import ZipImageSource, open_image
+from .tiles import image_source, cache_tiles, build_tile_cache, TileCache, VariantSampler
+from .shards import SHARD_RECORD_HEADER, read_shard, ShardDataset
+from .loaders import seed_worker, init_worker, make_loader, FrozenDataset
+from .checkpoints import snapshot_tensors, atomic_save, CheckpointWriter, rng_state, set_rng_state
@@ -0,0 +1,118 @@
+import math
+import torch
+import torch.nn as nn
+
+from PIL import Image, ImageFilter
+
+
+def gaussian_kernel1d(sigma: float, device=None) -> torch.Tensor:
+    '''Normalized 1-D Gaussian kernel of standard deviation `sigma`, truncated at 3 sigma.'''
+    radius = int(math.ceil(3 * sigma))
+    x = torch.arange(-radius, radius + 1, dtype=torch.float32, device=device)
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+class BatchAugment:
+    '''
+    Batched counterpart of `RandomBlur`, the random flips, `ToTensor` and
+    `Normalize`, applied to a whole collated (B, C, H, W) uint8 batch (see
+    `VesselDataset(batch_augment=True)` in either script), typically after
+    moving it to the GPU.
+
+    Every sample is independently blurred with probability `blur_p` (separable
+    Gaussian with sigma `radius`, the same parameter as PIL's `GaussianBlur`,
+    rounded back to integer levels like PIL) and flipped with probabilities
+    `hflip_p` / `vflip_p`, updating `boxes` (and `masks`) of its target if
+    detection `targets` are given.
+    Scaling to [0, 1] and normalizing are fused into one multiply-add.
+    '''
+    def __init__(self,
+                 blur_p: float = 0.0,
+                 radius: float = 2,
+                 hflip_p: float = 0.0,
+                 vflip_p: float = 0.0,
+                 mean=(0.485, 0.456, 0.406),
+                 std=(0.229, 0.224, 0.225),
+                 normalize: bool = True):
+        self.blur_p = blur_p
+        self.radius = radius
+        self.hflip_p = hflip_p
+        self.vflip_p = vflip_p
+        self.mean = tuple(mean)
+        self.std = tuple(std)
+        self.normalize = normalize
+        self.scale = 1 / (255 * torch.tensor(std, dtype=torch.float32)).reshape((1, -1, 1, 1))
+        self.bias = -(torch.tensor(mean) / torch.tensor(std)).float().reshape((1, -1, 1, 1))
+
+
+    def blur(self, images: torch.Tensor) -> torch.Tensor:
+        kernel = gaussian_kernel1d(self.radius, device=images.device)
+        channels, pad = images.shape[1], len(kernel) // 2
+        images = nn.functional.pad(images, (pad, pad, pad, pad), mode='replicate')
+        row = kernel.reshape((1, 1, 1, -1)).expand(channels, -1, -1, -1)
+        col = kernel.reshape((1, 1, -1, 1)).expand(channels, -1, -1, -1)
+        images = nn.functional.conv2d(images, row, groups=channels)
+        images = nn.functional.conv2d(images, col, groups=channels)
+        return images.round_()
+
+
+    def flip(self, images: torch.Tensor, targets, flip: torch.Tensor, dim: int):
+        if not flip.any():
+            return images, targets
+        images[flip] = images[flip].flip(dim)
+        if targets is not None:
+            size = images.shape[dim]
+            # x for horizontal (dim -1), y for vertical (dim -2) flips
+            lo, hi = (0, 2) if dim == -1 else (1, 3)
+            for i in torch.nonzero(flip).flatten().tolist():
+                target = dict(targets[i])
+                boxes = target['boxes'].clone()
+                boxes[:, lo], boxes[:, hi] = size - target['boxes'][:, hi], size - target['boxes'][:, lo]
+                target['boxes'] = boxes
+                if 'masks' in target:
+                    target['masks'] = target['masks'].flip(dim)
+                targets[i] = target
+        return images, targets
+
+
+    def __call__(self, images: torch.Tensor, targets=None):
+        batch_size = images.shape[0]
+        images = images.float()
+        targets = list(targets) if targets is not None else None
+        blur = torch.rand(batch_size, device=images.device) < self.blur_p
+        if blur.any():
+            images[blur] = self.blur(images[blur])
+        hflip = torch.rand(batch_size, device=images.device) < self.hflip_p
+        images, targets = self.flip(images, targets, hflip, -1)
+        vflip = torch.rand(batch_size, device=images.device) < self.vflip_p
+        images, targets = self.flip(images, targets, vflip, -2)
+        if self.normalize:
+            images = torch.addcmul(self.bias.to(images.device), images, self.scale.to(images.device))
+        if targets is None:
+            return images
+        return images, targets
+
+
+    def __repr__(self):
+        return '%s(blur_p=%s, radius=%s, hflip_p=%s, vflip_p=%s, mean=%s, std=%s, normalize=%s)' % (
+            self.__class__.__name__, self.blur_p, self.radius, self.hflip_p, self.vflip_p,
+            self.mean, self.std, self.normalize)
+
+
+# (blur, hflip, vflip) of the augmented variants stored per image by
+# `build_tile_cache`: the two `RandomBlur` states, flips being left to
+# `BatchAugment` (or the per-sample transforms)
+REPLAY_VARIANTS = ((False, False, False), (True, False, False))
+
+
+def augment_variant(img: Image.Image, variant, radius: float = 2) -> Image.Image:
+    '''Applies one (blur, hflip, vflip) variant, as `RandomBlur` and the random flips would.'''
+    blur, hflip, vflip = variant
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(radius))
+    if hflip:
+        img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    if vflip:
+        img = img.transpose(Image.FLIP_TOP_BOTTOM)
+    return img
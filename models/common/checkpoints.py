@@ -0,0 +1,167 @@
+import os
+import time
+import queue
+import random
+import signal
+import threading
+import torch
+import numpy as np
+
+import pathlib
+from typing import Union, Optional
+
+
+def snapshot_tensors(obj):
+    '''Copy of `obj` (nested dicts, lists and tuples) with every tensor copied to CPU memory.'''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_tensors(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_tensors(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path: Union[str, pathlib.Path]) -> None:
+    '''
+    `torch.save` to a temporary file next to `path`, renamed over it once
+    written and synced, so `path` always holds a complete checkpoint.
+    '''
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    '''
+    Writes checkpoints with `atomic_save` on a background thread, so
+    training only waits for its tensors to be copied to CPU.
+
+    Paths passed to `retain` are rotated: only the last `keep_last` and the
+    one with the best (highest) metric are kept. After `handle_sigterm`,
+    SIGTERM sets `preempted`, for the training loop to save its state and
+    `close` the writer; if the process is still alive `deadline` seconds
+    later it exits regardless (completed files are never left partial).
+    Only the process which called `handle_sigterm` is preempted: forked
+    workers inheriting the handler take the default action (DataLoader
+    workers from `make_loader` ignore SIGTERM instead).
+    '''
+    def __init__(self, keep_last: int = 3, deadline: float = 30.0):
+        self.keep_last = keep_last
+        self.deadline = deadline
+        self.rotation = []
+        self.best = None
+        self.error = None
+        self.preempted = threading.Event()
+        self.pending = 0
+        self.done = threading.Condition()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def put(self, item) -> None:
+        if self.error is not None:
+            raise self.error
+        with self.done:
+            self.pending += 1
+        self.queue.put(item)
+
+
+    def save(self, obj, path: Union[str, pathlib.Path]) -> None:
+        self.put(('save', snapshot_tensors(obj), path))
+
+
+    def retain(self, path: Union[str, pathlib.Path], metric: Optional[float] = None) -> None:
+        '''Adds `path`, saved before, to the rotation, deleting checkpoints no longer kept.'''
+        self.put(('retain', path, metric))
+
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                if item[0] == 'save':
+                    atomic_save(item[1], item[2])
+                else:
+                    self.rotate(item[1], item[2])
+            except Exception as e:
+                self.error = e
+            with self.done:
+                self.pending -= 1
+                self.done.notify_all()
+
+
+    def rotate(self, path, metric) -> None:
+        if metric is not None and (self.best is None or metric > self.best[0]):
+            self.best = (metric, path)
+        self.rotation = [p for p in self.rotation if p != path] + [path]
+        keep = self.rotation[-self.keep_last:] if self.keep_last > 0 else []
+        if self.best is not None:
+            keep.append(self.best[1])
+        for old in self.rotation:
+            if old not in keep and os.path.exists(old):
+                os.remove(old)
+        self.rotation = [p for p in self.rotation if p in keep]
+
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        '''Waits until all queued writes are done; False if `timeout` expired first.'''
+        with self.done:
+            flushed = self.done.wait_for(lambda: self.pending == 0, timeout)
+        if self.error is not None:
+            raise self.error
+        return flushed
+
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        flushed = self.flush(timeout)
+        self.queue.put(None)
+        return flushed
+
+
+    def handle_sigterm(self) -> None:
+        self.pid = os.getpid()
+        signal.signal(signal.SIGTERM, self.on_sigterm)
+
+
+    def on_sigterm(self, signum, frame) -> None:
+        if os.getpid() != self.pid:
+            # A forked worker (e.g. of a `multiprocessing.Pool`), which must
+            # still exit when its pool is terminated
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        self.preempted.set()
+        threading.Thread(target=self.expire, daemon=True).start()
+
+
+    def expire(self) -> None:
+        time.sleep(self.deadline)
+        print('Checkpoint deadline of %.0fs after SIGTERM expired, exiting.' % self.deadline)
+        os._exit(128 + signal.SIGTERM)
+
+
+def rng_state() -> dict:
+    '''States of the torch (CPU and CUDA), NumPy and `random` global RNGs, as plain values.'''
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'random': random.getstate(),
+    }
+
+
+def set_rng_state(state: dict) -> None:
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(state['random'])
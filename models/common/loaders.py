@@ -0,0 +1,173 @@
+import os
+import json
+import signal
+import threading
+import random
+import hashlib
+import torch
+import numpy as np
+
+from torch.utils.data import DataLoader
+from torch.utils.data import Dataset
+from torch.utils.data import Sampler
+from torch.utils.data import Subset
+
+import pathlib
+from typing import Callable, Union, Optional
+
+
+def seed_worker(worker_id: int) -> None:
+    '''
+    Seeds NumPy and `random` in each DataLoader worker from the per-worker
+    torch seed, so forked workers stop sharing the parent's NumPy state and
+    draw different (but reproducible) `RandomBlur` decisions.
+    '''
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def init_worker(worker_id: int) -> None:
+    '''
+    `seed_worker`, and ignores SIGTERM: on preemption the main process
+    (see `CheckpointWriter.handle_sigterm`) saves its state and shuts the
+    workers down, where a worker killed first would fail the DataLoader.
+    '''
+    seed_worker(worker_id)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def make_loader(dataset: Dataset,
+                batch_size: int,
+                sampler: Optional[Sampler] = None,
+                shuffle: bool = False,
+                collate_fn: Optional[Callable] = None,
+                num_workers: int = 0,
+                persistent_workers: bool = True,
+                prefetch_factor: int = 2,
+                seed: int = 0,
+                pin_memory: Optional[bool] = None,
+                batch_sampler: Optional[Sampler] = None) -> DataLoader:
+    '''
+    DataLoader with picklable (module-level) collate and worker init
+    functions, so it also works with the spawn start method; `collate_fn`
+    defaults to the DataLoader's own. Worker seeds derive from `seed`;
+    `persistent_workers` and `prefetch_factor` only apply when
+    `num_workers > 0`. A `batch_sampler` (e.g. `GroupedBatchSampler` in
+    `vessel_detector.py`) replaces `batch_size`, `sampler` and `shuffle`.
+    '''
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = {'persistent_workers': persistent_workers,
+                  'prefetch_factor': prefetch_factor}
+    if batch_sampler is not None:
+        kwargs['batch_sampler'] = batch_sampler
+        batch_size, sampler, shuffle = 1, None, False
+    return DataLoader(
+                dataset=dataset,
+                batch_size=batch_size,
+                sampler=sampler,
+                shuffle=shuffle if sampler is None else False,
+                collate_fn=collate_fn,
+                num_workers=num_workers,
+                worker_init_fn=init_worker,
+                generator=torch.Generator().manual_seed(seed),
+                pin_memory=torch.cuda.is_available() if pin_memory is None else pin_memory,
+                **kwargs
+            )
+
+
+class FrozenDataset(Dataset):
+    '''
+    The samples of a deterministic dataset (e.g. validation), materialized
+    once and reused for every evaluation pass. Images are stored as `dtype`,
+    by default uint8 if the dataset returns uint8 tensors
+    (`batch_augment=True`), else float16; targets are kept as they are.
+    Values which are not finite once stored (e.g. float16 overflow) raise
+    ValueError.
+
+    `prepare` (e.g. `BatchAugment(blur_p=1.0, normalize=False)`) is applied
+    to each batch of images before storing, so deterministic augmentation
+    is also done only once. With `cache_dir` the images are written to a
+    memory-mapped `images.npy` and the targets to `targets.pt`, and reused
+    across runs until `config`, `prepare` or the dataset's
+    `transform_config()` change; without it they are kept in RAM.
+
+    When `stop` (e.g. `CheckpointWriter.preempted`) is set, the build ends
+    after the current batch; the dataset is then incomplete and not cached.
+    '''
+    def __init__(self,
+                 dataset: Dataset,
+                 cache_dir: Optional[Union[str, pathlib.Path]] = None,
+                 config: Optional[dict] = None,
+                 prepare: Optional[Callable] = None,
+                 batch_size: int = 32,
+                 num_workers: int = 0,
+                 dtype: Optional[np.dtype] = None,
+                 stop: Optional[threading.Event] = None):
+        config = dict(config or {}, prepare=repr(prepare), size=len(dataset))
+        if dtype is not None:
+            config['dtype'] = np.dtype(dtype).name
+        source = dataset.dataset if isinstance(dataset, Subset) else dataset
+        if hasattr(source, 'transform_config'):
+            config['dataset'] = source.transform_config()
+        if isinstance(dataset, Subset):
+            config['subset'] = [int(i) for i in dataset.indices]
+        self.key = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+        key_path = os.path.join(cache_dir, 'config.sha1') if cache_dir is not None else None
+        if key_path is not None and os.path.exists(key_path):
+            with open(key_path) as f:
+                if f.read() == self.key:
+                    self.images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+                    self.targets = torch.load(os.path.join(cache_dir, 'targets.pt'))
+                    return
+            os.remove(key_path)
+
+        loader = make_loader(dataset, batch_size, collate_fn=list, num_workers=num_workers,
+                             pin_memory=False)
+        self.images, self.targets = None, []
+        first = 0
+        for batch in loader:
+            images = torch.stack([s[0] if isinstance(s, tuple) else s for s in batch])
+            if dtype is None:
+                dtype = np.uint8 if images.dtype == torch.uint8 else np.float16
+            if prepare is not None:
+                images = prepare(images)
+            if self.images is None:
+                shape = (len(dataset),) + tuple(images.shape[1:])
+                if cache_dir is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    self.images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy'),
+                                                            mode='w+', dtype=dtype, shape=shape)
+                else:
+                    self.images = np.zeros(shape, dtype=dtype)
+            with np.errstate(over='ignore'):
+                stored = images.numpy().astype(dtype)
+            if np.issubdtype(dtype, np.floating) and not np.all(np.isfinite(stored)):
+                raise ValueError('Non-finite values in samples %d-%d stored as %s (float16 overflows '
+                                 'beyond 65504); use dtype=np.float32' %
+                                 (first, first + len(images) - 1, np.dtype(dtype).name))
+            self.images[first:first + len(images)] = stored
+            self.targets += [s[1:] if isinstance(s, tuple) else () for s in batch]
+            first += len(images)
+            if stop is not None and stop.is_set():
+                return
+        if cache_dir is not None:
+            self.images.flush()
+            torch.save(self.targets, os.path.join(cache_dir, 'targets.pt'))
+            # Written last, so an interrupted build is never reused
+            with open(key_path, 'w') as f:
+                f.write(self.key)
+
+
+    def __len__(self):
+        return len(self.targets)
+
+
+    def __getitem__(self, idx):
+        img = torch.from_numpy(np.array(self.images[idx]))
+        if img.dtype == torch.float16:
+            img = img.float()
+        if len(self.targets[idx]) == 0:
+            return img
+        return (img,) + tuple(self.targets[idx])
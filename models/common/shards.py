@@ -0,0 +1,110 @@
+import os
+import struct
+import torch
+import numpy as np
+
+from torch.utils.data import Dataset
+from torch.utils.data import IterableDataset
+
+import pathlib
+from typing import Iterator, Union, Optional, Tuple
+
+
+# Shard record header (see `write_shards` in `vessel_detector.py`): image ID,
+# label, then the lengths of the file name, the JPEG bytes and the
+# (num_boxes, 4) int32 boxes which follow it
+SHARD_RECORD_HEADER = struct.Struct('<qbHII')
+
+
+def read_shard(path: Union[str, pathlib.Path]) -> Iterator[dict]:
+    '''Yields the records of a shard written by `write_shards`, reading it sequentially.'''
+    with open(path, 'rb', buffering=1 << 20) as f:
+        while True:
+            header = f.read(SHARD_RECORD_HEADER.size)
+            if not header:
+                return
+            idx, label, name_length, jpeg_length, num_boxes = SHARD_RECORD_HEADER.unpack(header)
+            name = f.read(name_length).decode()
+            jpeg = f.read(jpeg_length)
+            boxes = np.frombuffer(f.read(16 * num_boxes), dtype=np.int32).reshape((num_boxes, 4))
+            yield {'id': idx, 'label': label, 'name': name, 'jpeg': jpeg, 'boxes': boxes}
+
+
+class ShardDataset(IterableDataset):
+    '''
+    Streams the shards written by `write_shards` in `vessel_detector.py`.
+
+    Every epoch (see `set_epoch`) the shards are put in a seeded random order
+    and dealt out round-robin across all DataLoader workers of all ranks, so
+    every record is read by exactly one of them; records then pass through
+    a shuffle buffer of `buffer_size` records. With `dataset`, records are
+    turned into that dataset's samples with its `from_record`.
+
+    Ranks default to the initialized `torch.distributed` process group. Use
+    at least as many shards as workers x ranks, or some workers get none.
+    '''
+    def __init__(self,
+                 shard_dir: Union[str, pathlib.Path],
+                 dataset: Optional[Dataset] = None,
+                 shuffle: bool = True,
+                 buffer_size: int = 1024,
+                 seed: int = 0,
+                 rank: Optional[int] = None,
+                 world_size: Optional[int] = None):
+        self.shard_paths = sorted(os.path.join(shard_dir, f) for f in os.listdir(shard_dir) \
+                                  if f.endswith('.shard'))
+        self.counts = np.load(os.path.join(shard_dir, 'counts.npy'))
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if world_size is None:
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+
+    def __len__(self):
+        # Exact for a single rank; shards are not split evenly across ranks
+        return int(self.counts.sum()) // self.world_size
+
+
+    def set_epoch(self, epoch: int) -> None:
+        '''Must be called before each epoch; DataLoader workers must not be persistent.'''
+        self.epoch = epoch
+
+
+    def worker_shards(self) -> Tuple[np.ndarray, int]:
+        '''Shard numbers read by this worker this epoch, and its global worker number.'''
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        worker = self.rank * num_workers + worker_id
+        order = np.arange(len(self.shard_paths))
+        if self.shuffle:
+            order = np.random.RandomState([self.seed, self.epoch]).permutation(len(order))
+        return order[worker::self.world_size * num_workers], worker
+
+
+    def __iter__(self):
+        shards, worker = self.worker_shards()
+        rng = np.random.RandomState([self.seed, self.epoch, worker])
+        convert = self.dataset.from_record if self.dataset is not None else lambda record: record
+        buffer = []
+        for shard in shards:
+            for record in read_shard(self.shard_paths[shard]):
+                if not self.shuffle:
+                    yield convert(record)
+                elif len(buffer) < self.buffer_size:
+                    buffer.append(record)
+                else:
+                    i = rng.randint(len(buffer))
+                    yield convert(buffer[i])
+                    buffer[i] = record
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield convert(record)
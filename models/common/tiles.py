@@ -0,0 +1,202 @@
+import os
+import zipfile
+import threading
+import multiprocessing
+import torch
+import numpy as np
+
+from PIL import ImageFile
+from torchvision.transforms.functional import resize
+
+import pathlib
+from typing import Union, Optional, List, Tuple
+
+from .augment import augment_variant
+from .images import ZipImageSource, open_image
+
+
+# Image roots opened by `cache_tiles` in this process: a `ZipImageSource`
+# for each archive, read once, else the directory itself
+_sources = {}
+
+
+def image_source(root: str) -> Union[str, ZipImageSource]:
+    '''The directory `root`, or a `ZipImageSource` if it is a zip archive.'''
+    if root not in _sources:
+        _sources[root] = ZipImageSource(root) if zipfile.is_zipfile(root) else root
+    return _sources[root]
+
+
+def cache_tiles(args) -> None:
+    '''Worker for `build_tile_cache`: decodes, resizes and writes a slice of rows.'''
+    tiles_path, images, first_row, size, interpolation, variants, radius = args
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    tiles = np.load(tiles_path, mmap_mode='r+')
+    for row, (root, name) in enumerate(images, first_row):
+        img = open_image(image_source(root), name)
+        img = resize(img, size=size, interpolation=interpolation).convert('RGB')
+        if variants is None:
+            tiles[row] = np.asarray(img)
+        else:
+            for k, variant in enumerate(variants):
+                tiles[row, k] = np.asarray(augment_variant(img, variant, radius))
+    tiles.flush()
+
+
+def build_tile_cache(images: List[Tuple[str, str]],
+                     cache_dir: Union[str, pathlib.Path],
+                     size=(299, 299),
+                     interpolation=2,
+                     num_workers: int = 0,
+                     chunksize: int = 256,
+                     variants: Optional[tuple] = None,
+                     radius: float = 2,
+                     stop: Optional[threading.Event] = None) -> None:
+    '''
+    One-time job which decodes every image, given as (root, file name)
+    pairs whose root is a directory or a zip archive, resizes it exactly as
+    `Resize` in `vessel_detector.py` does and stores the result in a
+    memory-mapped (N, height, width, 3) uint8 array `tiles.npy`, with the
+    sorted file names of its rows in `names.npy`. Images are looked up by
+    file name, so names must be unique. The cache is read by both scripts.
+
+    With `variants` (e.g. `REPLAY_VARIANTS`), K augmented copies of every
+    image are stored instead, as an (N, K, height, width, 3) `tiles.npy`
+    plus the (K, 3) bool (blur, hflip, vflip) `variants.npy`. Blur and
+    flips are deterministic, so K = 2 (or 8, with both flips) covers every
+    outcome of the random transforms; see `VariantSampler`.
+
+    When `stop` (e.g. `CheckpointWriter.preempted`) is set, the build is
+    abandoned after the current chunks, leaving an incomplete cache.
+    '''
+    names = np.array([name for _, name in images], dtype=np.bytes_)
+    order = np.argsort(names, kind='stable')
+    names = names[order]
+    if np.any(names[1:] == names[:-1]):
+        raise ValueError('tile cache needs unique image file names')
+    images = [(str(images[i][0]), images[i][1]) for i in order]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tiles_path = os.path.join(cache_dir, 'tiles.npy')
+    shape = (len(names), size[0], size[1], 3)
+    if variants is not None:
+        variants = np.array(variants, dtype=bool).reshape((-1, 3))
+        np.save(os.path.join(cache_dir, 'variants.npy'), variants)
+        shape = (len(names), len(variants), size[0], size[1], 3)
+    tiles = np.lib.format.open_memmap(tiles_path, mode='w+', dtype=np.uint8, shape=shape)
+    del tiles
+    jobs = [(tiles_path, images[i:i + chunksize], i, size, interpolation, variants, radius) \
+            for i in range(0, len(images), chunksize)]
+    if num_workers > 0:
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.imap_unordered(cache_tiles, jobs)
+            for _ in jobs:
+                # Polled, as workers killed by the same SIGTERM never return their chunks
+                while True:
+                    if stop is not None and stop.is_set():
+                        return
+                    try:
+                        results.next(timeout=1.0)
+                        break
+                    except multiprocessing.TimeoutError:
+                        pass
+    else:
+        for job in jobs:
+            cache_tiles(job)
+            if stop is not None and stop.is_set():
+                return
+    # Written last, so a cache without `names.npy` is known to be incomplete
+    np.save(os.path.join(cache_dir, 'names.npy'), names)
+
+
+class TileCache:
+    '''
+    Read-only, memory-mapped view of a cache written by `build_tile_cache`.
+    `variants` is None unless the cache holds augmented variants. Pickled
+    (e.g. for spawned DataLoader workers) as its directory only, so every
+    copy maps the same file.
+    '''
+    def __init__(self, cache_dir: Union[str, pathlib.Path]):
+        self.cache_dir = cache_dir
+        self.names = np.load(os.path.join(cache_dir, 'names.npy'), mmap_mode='r')
+        self.tiles = np.load(os.path.join(cache_dir, 'tiles.npy'), mmap_mode='r')
+        variants_path = os.path.join(cache_dir, 'variants.npy')
+        self.variants = np.load(variants_path) if os.path.exists(variants_path) else None
+
+
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'])
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def __contains__(self, name: str) -> bool:
+        row = int(np.searchsorted(self.names, name.encode()))
+        return row < len(self.names) and self.names[row] == name.encode()
+
+
+    def tile(self, name: str, variant: int = 0) -> np.ndarray:
+        '''(height, width, 3) uint8 view of the resized image `name`, or of one of its variants.'''
+        row = int(np.searchsorted(self.names, name.encode()))
+        if row >= len(self.names) or self.names[row] != name.encode():
+            raise KeyError(name)
+        if self.variants is None:
+            return self.tiles[row]
+        return self.tiles[row, variant]
+
+
+class VariantSampler:
+    '''
+    Picks which cached variant (see `build_tile_cache`) a training sample
+    uses, with the probabilities the random transforms would give it:
+    each (blur, hflip, vflip) variant is weighted by `blur_p` or
+    `1 - blur_p` etc., renormalized over the cached variants. Flips which
+    are not cached should stay with `BatchAugment` (or the per-sample
+    transforms).
+
+    Draws come from a NumPy generator created on first use in each
+    process, seeded from the DataLoader worker seed (itself derived from
+    the loader's generator, see `make_loader`) or from `seed` in the main
+    process, so forked workers never share a random state.
+    '''
+    def __init__(self,
+                 variants: np.ndarray,
+                 blur_p: float = 0.0,
+                 hflip_p: float = 0.0,
+                 vflip_p: float = 0.0,
+                 seed: int = 0):
+        variants = np.asarray(variants, dtype=bool).reshape((-1, 3))
+        p = np.array([blur_p, hflip_p, vflip_p])
+        weights = np.prod(np.where(variants, p, 1 - p), axis=1)
+        if weights.sum() == 0:
+            raise ValueError('no cached variant has a nonzero probability')
+        self.variants = variants
+        self.probs = weights / weights.sum()
+        self.seed = seed
+        self._rng = None
+        self._pid = None
+
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_rng'], state['_pid'] = None, None
+        return state
+
+
+    def rng(self) -> np.random.Generator:
+        if self._rng is None or self._pid != os.getpid():
+            worker_info = torch.utils.data.get_worker_info()
+            seed = worker_info.seed if worker_info is not None else self.seed
+            self._rng = np.random.default_rng(seed)
+            self._pid = os.getpid()
+        return self._rng
+
+
+    def __call__(self) -> int:
+        return int(self.rng().choice(len(self.probs), p=self.probs))
@@ -4,6 +4,7 @@ from vessel_classifier import *
 
 import os
 import time
+import tempfile
 import torch
 import numpy as np
 import pandas as pd
@@ -307,7 +308,96 @@ class TestVesselClassifier(unittest.TestCase):
         savepath = '../../../data/test_vessel_classifier_state_dict.pth'
         torch.save(model.state_dict(), savepath)
         print('Done.')
+
+
+
+class TestLossAdaptiveSampler(unittest.TestCase):
+    def test_sampling(self):
+        rng = np.random.RandomState(0)
+        labels = (rng.rand(2000) < 0.1).astype(np.int64)
+        losses = np.where(labels == 1, 1.0, rng.exponential(0.05, len(labels)))
+        sampler = LossAdaptiveSampler(labels, easy_fraction=0.2, hard_loss=0.1, max_age=5)
+        # Every sample is seen in the first epoch
+        self.assertEqual(len(sampler), len(labels))
+        self.assertEqual(sorted(sampler), list(range(len(labels))))
+        sampler.update(np.arange(len(labels)), losses)
+        recorded = sampler.losses.astype(np.float64)
+        hard = (labels == 0) & (recorded >= 0.1)
+        estimates = []
+        last_seen = np.zeros(len(labels), dtype=np.int64)
+        for epoch in range(1, 201):
+            sampler.set_epoch(epoch)
+            num_samples = len(sampler)
+            indices = np.array(list(sampler))
+            # The length is known before iterating, and iterating again replays the epoch
+            self.assertEqual(len(indices), num_samples)
+            self.assertEqual(list(sampler), list(indices))
+            self.assertTrue(np.all(np.isin(np.flatnonzero((labels == 1) | hard), indices)))
+            self.assertEqual(len(indices), len(set(indices)))
+            estimates.append(np.mean(sampler.weights[indices] * recorded[indices]))
+            sampler.update(indices, recorded[indices])
+            last_seen[indices] = epoch
+            # Easy negatives are refreshed at least every `max_age` epochs
+            self.assertTrue(np.all(epoch - last_seen < 5))
+        self.assertLess(len(sampler), 0.5 * len(labels))
+        # Importance weights keep the epoch loss an unbiased estimate of the full mean
+        self.assertAlmostEqual(np.mean(estimates), recorded.mean(), delta=0.002)
     
     
+class TestTrainingState(unittest.TestCase):
+    def train(self, model, optimizer, sampler, inputs, labels, start_epoch=0, start_step=0,
+              stop=None, path=None):
+        criterion = nn.CrossEntropyLoss(reduction='none')
+        for epoch in range(start_epoch, 3):
+            step = start_step if epoch == start_epoch else 0
+            sampler.set_epoch(epoch, step * 16)
+            indices = np.array(list(sampler))
+            for i, first in enumerate(range(0, len(indices), 16), step):
+                batch = indices[first:first + 16]
+                # Noise from the global RNG, which must also be restored
+                outputs = model(torch.from_numpy(inputs[batch]) + 0.1 * torch.randn(len(batch), 4))
+                losses = criterion(outputs, torch.from_numpy(labels[batch]))
+                sampler.update(batch, losses.detach().numpy())
+                loss = (torch.from_numpy(sampler.weights[batch]) * losses).mean()
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                if (epoch, i + 1) == stop:
+                    save_training_state(path, model, optimizer, epoch, i + 1, sampler,
+                                        best=(0.5, 'epoch1.pth'))
+                    return
+
+
+    def test_resume(self):
+        rng = np.random.RandomState(0)
+        labels = (rng.rand(200) < 0.3).astype(np.int64)
+        inputs = (rng.randn(200, 4) + labels[:, None]).astype(np.float32)
+
+        def setup(seed):
+            torch.manual_seed(seed)
+            model = nn.Linear(4, 2)
+            optimizer = optim.Adam(model.parameters(), lr=0.01)
+            sampler = LossAdaptiveSampler(labels, easy_fraction=0.3, hard_loss=0.3, max_age=2)
+            return model, optimizer, sampler
+
+        model, optimizer, sampler = setup(0)
+        self.train(model, optimizer, sampler, inputs, labels)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'training_state.pth')
+            resumed = setup(0)
+            self.train(*resumed, inputs, labels, stop=(1, 3), path=path)
+            torch.randn(100) # Progress made after the checkpoint is lost
+            # A new process: other initial weights, fresh optimizer and sampler
+            resumed = setup(1)
+            epoch, step, best, validate = load_training_state(path, *resumed)
+            self.assertEqual((epoch, step, best, validate), (1, 3, (0.5, 'epoch1.pth'), False))
+            self.train(*resumed, inputs, labels, start_epoch=epoch, start_step=step)
+            # Saved at the end of an epoch, before validation
+            save_training_state(path, resumed[0], resumed[1], 3, 0, resumed[2], validate=True)
+            self.assertEqual(load_training_state(path, *setup(2))[::3], (3, True))
+        self.assertTrue(torch.equal(resumed[0].weight, model.weight))
+        self.assertTrue(np.array_equal(resumed[2].losses, sampler.losses))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,10 @@
+import io
 import os
+import sys
 import time
+import zipfile
+import signal
+import threading
 import torch
 import numpy as np
 import pandas as pd
@@ -10,10 +15,21 @@ import torchvision
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
+from torch.utils.data import Sampler
 from torchvision.transforms import ToTensor, Compose, RandomHorizontalFlip, RandomVerticalFlip, Resize, Normalize
 from sklearn.model_selection import train_test_split
+from torchvision.transforms.functional import resize
 from PIL import Image, ImageFile, ImageFilter
 
+import pathlib
+from typing import Iterator, Union, Optional, Tuple
+
+# Data loading and checkpointing code shared with `vessel_detector.py`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import BatchAugment, REPLAY_VARIANTS, ZipImageSource, open_image, build_tile_cache, \
+    TileCache, VariantSampler, ShardDataset, make_loader, FrozenDataset, atomic_save, \
+    CheckpointWriter, rng_state, set_rng_state
+
 
 class RandomBlur:
     def __init__(self, p=0.5, radius=2):
@@ -28,17 +44,84 @@ class RandomBlur:
         return x
 
 
+    def __repr__(self):
+        return '%s(p=%s, radius=%s)' % (self.__class__.__name__, self.p, self.radius)
+
+
+def read_annotation_index(index_dir) -> pd.DataFrame:
+    '''
+    Reads an annotation index written by `vessel_detector.py`, including any
+    label batches added with `append_labels`, into one row per image with
+    columns ImageId, label, image_dir (None to use the dataset's directory)
+    and valid (stored train (0) / valid (1) assignment, -1 if not stored).
+    '''
+    segment_dirs = [index_dir]
+    if os.path.isdir(os.path.join(index_dir, 'segments')):
+        segment_dirs += [os.path.join(index_dir, 'segments', d) \
+                         for d in sorted(os.listdir(os.path.join(index_dir, 'segments')))]
+    dfs = []
+    for segment_dir in segment_dirs:
+        load = lambda key: np.load(os.path.join(segment_dir, key + '.npy'))
+        exists = lambda key: os.path.exists(os.path.join(segment_dir, key + '.npy'))
+        names = load('names')
+        counts = np.diff(load('offsets'))
+        if exists('roots'):
+            roots = np.array([root.decode() for root in load('roots')], dtype=object)
+            image_dirs = roots[load('root_ids')]
+        else:
+            image_dirs = np.full(len(names), None, dtype=object)
+        dfs.append(pd.DataFrame({
+            'ImageId': [name.decode() for name in names],
+            'label': load('labels') if exists('labels') else (counts > 0).astype(np.int8),
+            'image_dir': image_dirs,
+            'valid': load('valid') if exists('valid') else np.full(len(names), -1, dtype=np.int8),
+        }))
+    return pd.concat(dfs, ignore_index=True)
+
+
 class VesselDataset(Dataset):
     def __init__(self, img_df, train_image_dir=None, valid_image_dir=None, 
-                 test_image_dir=None, transform=None, mode='train', binary=True):
-        self.image_ids = list(img_df.ImageId.unique())
-        if binary:
-            self.image_labels = list(map(lambda x: 1 if x > 1 else 0, img_df.counts))
+                 test_image_dir=None, transform=None, mode='train', binary=True,
+                 tile_cache: Optional[TileCache] = None, batch_augment: bool = False,
+                 draft_size: Optional[Tuple[int, int]] = None, return_index: bool = False,
+                 variant_sampler: Optional[VariantSampler] = None):
+        # `img_df` either has one row per image with `label` (and optionally
+        # `image_dir`) columns, as from `read_annotation_index`, or `counts`
+        if 'label' in img_df.columns:
+            self.image_ids = list(img_df.ImageId)
+            self.image_labels = list(img_df.label)
         else:
-            self.image_labels = list(img_df.counts - 1) # Image with no mask has 'count' == 1 in df
+            self.image_ids = list(img_df.ImageId.unique())
+            if binary:
+                self.image_labels = list(map(lambda x: 1 if x > 1 else 0, img_df.counts))
+            else:
+                self.image_labels = list(img_df.counts - 1) # Image with no mask has 'count' == 1 in df
+        self.image_dirs = None
+        if 'image_dir' in img_df.columns:
+            self.image_dirs = list(img_df.image_dir)
+        # Image directories may also be `ZipImageSource`s; `image_dir` values
+        # which are zip files are opened (and their central directories read) here
+        self.archives = {}
+        if self.image_dirs is not None:
+            self.archives = {d: ZipImageSource(d) for d in set(self.image_dirs) \
+                             if isinstance(d, str) and zipfile.is_zipfile(d)}
         self.train_image_dir = train_image_dir
         self.valid_image_dir = valid_image_dir
         self.test_image_dir = test_image_dir
+        # Pre-resized images, `Resize` below is then a no-op
+        self.tile_cache = tile_cache
+        # Training samples read one of the tile cache's augmented variants,
+        # picked by `variant_sampler`, and are not blurred again
+        if variant_sampler is not None and (tile_cache is None or tile_cache.variants is None):
+            raise ValueError('variant_sampler requires a tile cache built with variants')
+        self.variant_sampler = variant_sampler
+        # Return resized (C, H, W) uint8 images for train and valid samples,
+        # leaving blur, flips and normalization to `BatchAugment`
+        self.batch_augment = batch_augment
+        # Decode JPEGs at reduced resolution before the final resize (see `open_image`)
+        self.draft_size = draft_size
+        # Also return the sample's position, to record its loss (`LossAdaptiveSampler`)
+        self.return_index = return_index
 
         mean = [0.485, 0.456, 0.406]
         std = [0.229, 0.224, 0.225]
@@ -64,6 +147,17 @@ class VesselDataset(Dataset):
             ToTensor(),
             Normalize(mean, std) # Apply to all input images
         ])
+        # For cached variants: only the flips which were not cached
+        flips = []
+        if variant_sampler is not None:
+            if not variant_sampler.variants[:, 1].any():
+                flips.append(RandomHorizontalFlip(p=0.5))
+            if not variant_sampler.variants[:, 2].any():
+                flips.append(RandomVerticalFlip(p=0.5))
+        self.replay_transform = Compose(flips + [
+            ToTensor(),
+            Normalize(mean, std)
+        ])
         self.mode = mode
 
 
@@ -71,27 +165,229 @@ class VesselDataset(Dataset):
         return len(self.image_ids)
 
 
+    def transform_config(self) -> dict:
+        '''Everything which determines the samples, for `FrozenDataset`.'''
+        transform = {'train': self.train_transform, 'valid': self.valid_transform}.get(
+            self.mode, self.test_transform)
+        return {
+            'mode': self.mode,
+            'image_ids': self.image_ids,
+            'image_labels': [int(label) for label in self.image_labels],
+            'image_dirs': self.image_dirs,
+            'transform': repr(transform),
+            'batch_augment': self.batch_augment,
+            'draft_size': self.draft_size,
+            'tile_cache': str(self.tile_cache.cache_dir) if self.tile_cache is not None else None,
+            'return_index': self.return_index,
+        }
+
+
     def __getitem__(self, idx):
         img_file_name = self.image_ids[idx]
-        if self.mode == 'train':
-            img_path = os.path.join(self.train_image_dir, img_file_name)
+        # Missing directories may read back from pandas as NaN instead of None
+        if self.image_dirs is not None and isinstance(self.image_dirs[idx], str):
+            image_dir = self.archives.get(self.image_dirs[idx], self.image_dirs[idx])
+        elif self.mode == 'train':
+            image_dir = self.train_image_dir
         elif self.mode == 'valid':
-            img_path = os.path.join(self.valid_image_dir, img_file_name)
+            image_dir = self.valid_image_dir
         else:
-            img_path = os.path.join(self.test_image_dir, img_file_name)
+            image_dir = self.test_image_dir
 
         #img = imread(img_path)
-        img = Image.open(img_path)
-        label = self.image_labels[idx]
-        if self.mode =='train':
-            img = self.train_transform(img)
+        variant = None
+        if self.tile_cache is not None:
+            if self.variant_sampler is not None and self.mode == 'train':
+                variant = self.variant_sampler()
+                img = Image.fromarray(self.tile_cache.tile(img_file_name, variant))
+            else:
+                img = Image.fromarray(self.tile_cache.tile(img_file_name))
+        else:
+            img = open_image(image_dir, img_file_name, draft_size=self.draft_size)
+        return self.make_sample(img, self.image_labels[idx], idx, variant=variant)
+
+
+    def from_record(self, record: dict):
+        '''Builds the same sample as `__getitem__` from a `read_shard` record.'''
+        img = Image.open(io.BytesIO(record['jpeg']))
+        if self.draft_size is not None:
+            img.draft('RGB', self.draft_size)
+        return self.make_sample(img, int(record['label']), record['id'])
+
+
+    def make_sample(self, img: Image.Image, label: int, idx: int, variant: Optional[int] = None):
+        if self.batch_augment and self.mode != 'test':
+            img = resize(img, size=(299, 299), interpolation=2).convert('RGB')
+            img = torch.from_numpy(np.array(img, dtype=np.uint8)).permute(2, 0, 1)
+        elif self.mode =='train':
+            img = self.train_transform(img) if variant is None else self.replay_transform(img)
         elif self.mode == 'valid':
             img = self.valid_transform(img)
         else:
             img = self.test_transform(img)
+        if self.return_index:
+            return img, label, idx
         return img, label
 
+
+class LossAdaptiveSampler(Sampler):
+    '''
+    Samples each epoch all positives, all hard negatives (last recorded loss
+    >= `hard_loss`, or never seen) and a random `easy_fraction` of the
+    remaining easy negatives, in random order.
+
+    Per-sample losses are recorded with `update` into a float16 array. An
+    easy negative whose loss was last recorded `max_age` or more epochs ago
+    is stale and sampled like a hard one, so its loss is refreshed at least
+    every `max_age` epochs.
+
+    The sample of an epoch is drawn by `set_epoch` (from `seed` and the
+    epoch, using the losses recorded so far), which must be called before
+    each epoch; it is kept until the epoch changes, and is part of
+    `state_dict`, so a resumed epoch replays it, skipping the `start`
+    samples already seen. `weights` then holds the importance weight of each position
+    (1 / `easy_fraction` for sampled easy negatives, 1 otherwise, times the
+    fraction of the dataset sampled), so the mean of weight x loss over an
+    epoch is an unbiased estimate of the mean loss over the full dataset.
+    The first epoch sees every sample.
+    '''
+    def __init__(self,
+                 labels,
+                 easy_fraction: float = 0.1,
+                 hard_loss: float = 0.1,
+                 max_age: int = 10,
+                 seed: int = 0):
+        self.labels = np.asarray(labels)
+        self.easy_fraction = easy_fraction
+        self.hard_loss = hard_loss
+        self.max_age = max_age
+        self.seed = seed
+        self.losses = np.full(len(self.labels), np.nan, dtype=np.float16)
+        # Epoch in which each loss was last recorded
+        self.seen = np.full(len(self.labels), -1, dtype=np.int32)
+        self.epoch = 0
+        self.indices = self.sample()
+        self.start = 0
+
+
+    def __len__(self):
+        return len(self.indices) - self.start
+
+
+    def set_epoch(self, epoch: int, start: int = 0) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.indices = self.sample()
+        self.start = start
+
+
+    def state_dict(self) -> dict:
+        '''Recorded losses and the current epoch's sample, as tensors (see `save_training_state`).'''
+        return {
+            'epoch': self.epoch,
+            'indices': torch.from_numpy(self.indices),
+            'weights': torch.from_numpy(self.weights),
+            'counts': self.counts,
+            'losses': torch.from_numpy(self.losses),
+            'seen': torch.from_numpy(self.seen),
+        }
+
+
+    def load_state_dict(self, state: dict) -> None:
+        self.epoch = state['epoch']
+        self.indices = state['indices'].numpy()
+        self.weights = state['weights'].numpy()
+        self.counts = state['counts']
+        self.losses = state['losses'].numpy()
+        self.seen = state['seen'].numpy()
+
+
+    def update(self, indices: np.ndarray, losses: np.ndarray) -> None:
+        '''Records the latest (unweighted) per-sample losses.'''
+        indices = np.asarray(indices)
+        self.losses[indices] = np.asarray(losses, dtype=np.float32)
+        self.seen[indices] = self.epoch
+
+
+    def sample(self) -> np.ndarray:
+        rng = np.random.RandomState(self.seed + self.epoch)
+        positive = self.labels != 0
+        hard = ~positive & ~(self.losses < self.hard_loss) # NaN (never seen) is hard
+        stale = ~positive & ~hard & (self.epoch - self.seen >= self.max_age)
+        easy = ~positive & ~hard & ~stale
+        keep_easy = easy & (rng.rand(len(self.labels)) < self.easy_fraction)
+        selected = positive | hard | stale | keep_easy
+        raw_weights = np.where(keep_easy, 1 / self.easy_fraction, 1.0)
+        self.weights = (raw_weights * selected.sum() / len(self.labels)).astype(np.float32)
+        self.counts = {'positive': int(positive.sum()),
+                       'hard_negative': int(hard.sum()),
+                       'stale_negative': int(stale.sum()),
+                       'easy_negative': int(keep_easy.sum()),
+                       'total': len(self.labels)}
+        indices = np.flatnonzero(selected)
+        return indices[rng.permutation(len(indices))]
+
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.indices[self.start:].tolist())
+
         
+def save_training_state(path: Union[str, pathlib.Path],
+                        model: nn.Module,
+                        optimizer: optim.Optimizer,
+                        epoch: int,
+                        step: int,
+                        sampler: Optional[LossAdaptiveSampler] = None,
+                        best: Optional[Tuple[float, str]] = None,
+                        writer: Optional[CheckpointWriter] = None,
+                        validate: bool = False) -> None:
+    '''
+    Checkpoint holding everything needed to resume training after `step`
+    batches of `epoch`: the model's state dict (so `torch.load(path)
+    ['state_dict']` also reads the model), the optimizer (Adam moments), the
+    sampler's recorded losses and sample, the (validation accuracy, path)
+    of the best epoch so far and the RNG states. Written atomically, in the
+    background with `writer`. `validate` marks a state saved at the end of
+    epoch `epoch - 1` before it was validated, so resuming validates it first.
+    '''
+    checkpoint = {
+        'state_dict': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'sampler': sampler.state_dict() if sampler is not None else None,
+        'epoch': epoch,
+        'step': step,
+        'best': best,
+        'validate': validate,
+        'rng': rng_state(),
+    }
+    if writer is not None:
+        writer.save(checkpoint, path)
+    else:
+        atomic_save(checkpoint, path)
+
+
+def load_training_state(path: Union[str, pathlib.Path],
+                        model: nn.Module,
+                        optimizer: optim.Optimizer,
+                        sampler: Optional[LossAdaptiveSampler] = None) -> Tuple[int, int, Optional[tuple], bool]:
+    '''
+    Restores the model, optimizer, sampler and RNG states of a
+    `save_training_state` checkpoint. Returns (epoch, step, best, validate):
+    the position training resumes from, where the sampler's `set_epoch`
+    skips the samples already seen, the best epoch so far and whether epoch
+    `epoch - 1` still has to be validated. RNGs of DataLoader workers
+    (per-sample transforms) are reseeded rather than restored.
+    '''
+    checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+    model.load_state_dict(checkpoint['state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    if sampler is not None and checkpoint['sampler'] is not None:
+        sampler.load_state_dict(checkpoint['sampler'])
+    set_rng_state(checkpoint['rng'])
+    return checkpoint['epoch'], checkpoint['step'], checkpoint['best'], \
+        checkpoint.get('validate', False)
+
+
 def binary_acc(outputs, labels):
     preds = torch.argmax(outputs, axis=1)
     num_correct = (preds == labels).sum().float()
@@ -99,7 +395,10 @@ def binary_acc(outputs, labels):
     return acc
 
 
-def validation(model, criterion, valid_loader):
+def validation(model, criterion, valid_loader, augment: Optional[BatchAugment] = None,
+               stop: Optional[threading.Event] = None):
+    # Returns None if `stop` (e.g. `CheckpointWriter.preempted`) is set
+    # before all batches are evaluated
     #print("Calculating validation on hold-out....")
     model.eval()
     losses = []
@@ -107,11 +406,15 @@ def validation(model, criterion, valid_loader):
     with torch.no_grad():
         for inputs, labels in valid_loader:
             inputs, labels = Variable(inputs).cuda(), Variable(labels).cuda()
+            if augment is not None:
+                inputs = augment(inputs)
             outputs = model(inputs)
             loss = criterion(outputs, labels)
             losses.append(loss.item())
             acc = binary_acc(outputs, labels)
             accs.append(acc.item())
+            if stop is not None and stop.is_set():
+                return None
         
     valid_loss = np.mean(losses)  # type: float
     valid_acc = np.mean(accs)
@@ -136,71 +439,237 @@ def main(savepath, load_state_dict=False, state_dict=None):
     model = model.to(device)
     
     criterion = nn.CrossEntropyLoss()
+    # Per-sample losses, to record them and apply importance weights
+    train_criterion = nn.CrossEntropyLoss(reduction='none')
     
     lr = 1e-4
     weight_decay = 1e-7 # Default should be 1e-5
     optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
+
+    # Checkpoints are written in the background; per-epoch copies are kept
+    # for the last `keep_checkpoints` epochs plus the best by validation
+    # accuracy. On SIGTERM (preemption) the training state is saved within
+    # the deadline; the cache builds below stop as well
+    keep_checkpoints = 3
+    preempt_deadline = 30.0
+    writer = CheckpointWriter(keep_last=keep_checkpoints, deadline=preempt_deadline)
+    writer.handle_sigterm()
+
+    def exit_if_preempted():
+        # The training state is saved before this point; wait for pending writes
+        if writer.preempted.is_set():
+            print('Preempted, exiting...\n')
+            writer.close(timeout=preempt_deadline)
+            sys.exit(128 + signal.SIGTERM)
     
     ship_dir = '../../../data/airbus-ship-detection/'
     train_image_dir = os.path.join(ship_dir, 'train_v2/')
     valid_image_dir = os.path.join(ship_dir, 'train_v2/')
-    masks = pd.read_csv(os.path.join(ship_dir,
-                                     'train_ship_segmentations_v2.csv'))
-    unique_img_ids = masks.groupby('ImageId').size().reset_index(name='counts')
-    train_ids, valid_ids = train_test_split(unique_img_ids, 
-                     test_size = 0.01, 
-                     stratify = unique_img_ids['counts'],
-                     random_state=seed
-                    )
-    print("Train Size: %d" % len(train_ids))
-    print("Valid Size: %d" % len(valid_ids))
-    train_df = pd.merge(unique_img_ids, train_ids)
-    valid_df = pd.merge(unique_img_ids, valid_ids)
+    # Annotation index built by `vessel_detector.py` with null samples kept;
+    # it also holds any labeled tile batches added with `append_labels`
+    index_dir = os.path.join(ship_dir, 'annotation_index/')
+    if os.path.exists(os.path.join(index_dir, 'ids.npy')):
+        img_df = read_annotation_index(index_dir)
+        unassigned = img_df[img_df.valid == -1]
+        train_df, valid_df = train_test_split(unassigned,
+                         test_size = 0.01,
+                         stratify = unassigned['label'],
+                         random_state=seed
+                        )
+        # Stored assignments of appended batches never change
+        train_df = pd.concat([train_df, img_df[img_df.valid == 0]])
+        valid_df = pd.concat([valid_df, img_df[img_df.valid == 1]])
+    else:
+        masks = pd.read_csv(os.path.join(ship_dir,
+                                         'train_ship_segmentations_v2.csv'))
+        unique_img_ids = masks.groupby('ImageId').size().reset_index(name='counts')
+        train_ids, valid_ids = train_test_split(unique_img_ids, 
+                         test_size = 0.01, 
+                         stratify = unique_img_ids['counts'],
+                         random_state=seed
+                        )
+        train_df = pd.merge(unique_img_ids, train_ids)
+        valid_df = pd.merge(unique_img_ids, valid_ids)
+    print("Train Size: %d" % len(train_df))
+    print("Valid Size: %d" % len(valid_df))
+
+    # Decode and resize every image once into a uint8 memmap and read tiles
+    # from it during training
+    use_tile_cache = False
+    tile_cache = None
+    if use_tile_cache:
+        cache_dir = os.path.join(ship_dir, 'tile_cache_299/')
+        if not os.path.exists(os.path.join(cache_dir, 'names.npy')):
+            # Roots may be directories or zip archives
+            images = []
+            for df, image_dir in [(train_df, train_image_dir), (valid_df, valid_image_dir)]:
+                image_dirs = df.image_dir if 'image_dir' in df.columns else [None] * len(df)
+                images += [(d if isinstance(d, str) else image_dir, name) \
+                           for name, d in zip(df.ImageId, image_dirs)]
+            build_tile_cache(images, cache_dir, num_workers=8, stop=writer.preempted)
+            exit_if_preempted()
+        tile_cache = TileCache(cache_dir)
+
+    # Precompute blurred and unblurred variants of every training tile
+    # (`REPLAY_VARIANTS`) and read one per sample, picked with the same
+    # probability, instead of blurring during training
+    use_replay_cache = False
+    train_tile_cache, variant_sampler = tile_cache, None
+    if use_replay_cache:
+        replay_dir = os.path.join(ship_dir, 'replay_cache_299/')
+        if not os.path.exists(os.path.join(replay_dir, 'names.npy')):
+            image_dirs = train_df.image_dir if 'image_dir' in train_df.columns else [None] * len(train_df)
+            images = [(d if isinstance(d, str) else train_image_dir, name) \
+                      for name, d in zip(train_df.ImageId, image_dirs)]
+            build_tile_cache(images, replay_dir, num_workers=8, variants=REPLAY_VARIANTS,
+                             stop=writer.preempted)
+            exit_if_preempted()
+        train_tile_cache = TileCache(replay_dir)
+        variant_sampler = VariantSampler(train_tile_cache.variants, blur_p=0.85, seed=seed)
+
+    # Blur, flip and normalize whole batches on the GPU instead of per sample
+    # in the workers; same probabilities as the PIL transforms
+    batch_augment = True
+    augment = BatchAugment(blur_p=0.0 if use_replay_cache else 0.85, radius=2,
+                           hflip_p=0.5, vflip_p=0.5)
+    valid_augment = BatchAugment(blur_p=1.0, radius=2)
+
+    # Decode 768x768 JPEGs at 384x384 in the DCT domain before resizing to
+    # 299x299; `None` decodes at full size
+    draft_size = (384, 384)
 
     binary = True
     vessel_dataset = VesselDataset(train_df, train_image_dir=train_image_dir, 
-                                   mode='train', binary=binary)
+                                   mode='train', binary=binary, tile_cache=train_tile_cache,
+                                   batch_augment=batch_augment, draft_size=draft_size,
+                                   return_index=True, variant_sampler=variant_sampler)
 
     vessel_valid_dataset = VesselDataset(valid_df, valid_image_dir=valid_image_dir, 
-                                   mode='valid', binary=binary)
+                                   mode='valid', binary=binary, tile_cache=tile_cache,
+                                   batch_augment=batch_augment, draft_size=draft_size)
     
     batch_size = 64
     shuffle = True
-    loader = DataLoader(
-                dataset=vessel_dataset,
-                shuffle=shuffle,
-                #num_workers = 0,
-                batch_size=batch_size,
-                pin_memory=torch.cuda.is_available()
-            )
-
-    valid_loader = DataLoader(
-                dataset=vessel_valid_dataset,
-                shuffle=shuffle,
-                #num_workers = 0,
-                batch_size=batch_size,
-                pin_memory=torch.cuda.is_available()
-            )
+    num_workers = 8
+    # Stream training images from the sequential shards written from the
+    # annotation index by `write_shards` in `vessel_detector.py`, instead of
+    # reading loose JPEGs at random; this replaces the adaptive sampler
+    shard_dir = None
+    shard_dataset, sampler = None, None
+    if shard_dir is not None:
+        shard_dataset = ShardDataset(shard_dir, dataset=vessel_dataset, shuffle=shuffle,
+                                     buffer_size=2048, seed=seed)
+        # Workers must be restarted to see `set_epoch`
+        loader = make_loader(shard_dataset, batch_size, num_workers=num_workers,
+                             persistent_workers=False, seed=seed)
+    else:
+        # Each epoch: all positives and hard negatives, 10% of the easy negatives,
+        # and easy negatives whose loss is 10 or more epochs old
+        sampler = LossAdaptiveSampler(vessel_dataset.image_labels, easy_fraction=0.1,
+                                      hard_loss=0.1, max_age=10, seed=seed)
+        loader = make_loader(vessel_dataset, batch_size, sampler=sampler,
+                             num_workers=num_workers, seed=seed)
+
+    # Decode, resize and blur the validation set once into a memmap (rebuilt
+    # when the transforms change) instead of on every evaluation pass
+    freeze_valid = True
+    if freeze_valid:
+        prepare = None
+        if batch_augment:
+            # Blur is applied once when freezing; only normalization is left
+            prepare = BatchAugment(blur_p=1.0, radius=2, normalize=False)
+            valid_augment = BatchAugment()
+        frozen_valid_dataset = FrozenDataset(vessel_valid_dataset,
+                                             cache_dir=os.path.join(ship_dir, 'classifier_valid_cache/'),
+                                             config={'seed': seed},
+                                             prepare=prepare,
+                                             batch_size=batch_size,
+                                             num_workers=num_workers,
+                                             stop=writer.preempted)
+        exit_if_preempted()
+        valid_loader = make_loader(frozen_valid_dataset, batch_size, shuffle=shuffle, seed=seed)
+    else:
+        valid_loader = make_loader(vessel_valid_dataset, batch_size, shuffle=shuffle,
+                                   num_workers=num_workers, seed=seed)
     
     num_epochs = 30
     print_every = 100
 
+    # Periodically save the full training state (model, optimizer, sampler,
+    # RNGs, epoch and step) next to `savepath` and resume from it when present
+    resume = True
+    checkpoint_every = 1000
+    resume_path = os.path.splitext(savepath)[0] + '_training_state.pth'
+    start_epoch, start_step, best, validate = 0, 0, None, False
+    if resume and os.path.exists(resume_path):
+        start_epoch, start_step, best, validate = load_training_state(resume_path, model,
+                                                                      optimizer, sampler)
+        if best is not None and os.path.exists(best[1]):
+            # Keep the best epoch's checkpoint through the rotation
+            writer.retain(best[1], metric=best[0])
+        print('Resuming from epoch %d, step %d.\n' % (start_epoch + 1, start_step))
+
+    def save_checkpoint(epoch, step, validate=False):
+        save_training_state(resume_path, model, optimizer, epoch, step, sampler, best,
+                            writer=writer, validate=validate)
+
+    def validate_epoch(epoch):
+        nonlocal best
+        print('Epoch %d completed. Running validation...\n' % (epoch + 1))
+        metrics = validation(model, criterion, valid_loader,
+                             augment=valid_augment if batch_augment else None,
+                             stop=writer.preempted)
+        exit_if_preempted()
+        print('[Epoch %d] Validation Accuracy: %.3f | Validation Loss: %.3f\n' %
+             ((epoch + 1), metrics['valid_acc'], metrics['valid_loss']))
+        print('Saving Model...\n')
+        writer.save(model.state_dict(), savepath)
+        epoch_path = os.path.splitext(savepath)[0] + '_epoch%d.pth' % (epoch + 1)
+        writer.save(model.state_dict(), epoch_path)
+        writer.retain(epoch_path, metric=float(metrics['valid_acc']))
+        if best is None or metrics['valid_acc'] > best[0]:
+            best = (float(metrics['valid_acc']), epoch_path)
+        # Records the best epoch, and that this one no longer needs validating
+        save_checkpoint(epoch + 1, 0)
+        print('Model Saved.\n')
+        exit_if_preempted()
+
+    if validate:
+        # Preempted before the last epoch trained was validated
+        validate_epoch(start_epoch - 1)
     print('Starting Training...\n')
-    for epoch in range(num_epochs):  # loop over the dataset multiple times
+    for epoch in range(start_epoch, num_epochs):  # loop over the dataset multiple times
+        step = start_step if epoch == start_epoch else 0
+        if shard_dataset is not None:
+            # The shuffle buffer cannot be replayed; resume at the epoch's start
+            step = 0
+            shard_dataset.set_epoch(epoch)
+        if sampler is not None:
+            sampler.set_epoch(epoch, step * batch_size)
         model.train()
         running_loss = 0.0
         minibatch_time = 0.0
-        for i, data in enumerate(loader):
+        for i, data in enumerate(loader, step):
             start = time.time()
-            inputs, labels = data
+            inputs, labels, indices = data
             inputs, labels = Variable(inputs).cuda(), Variable(labels).cuda()
+            if batch_augment:
+                inputs = augment(inputs)
 
             optimizer.zero_grad()
 
             outputs = model(inputs)
-            loss = criterion(outputs, labels)
+            losses = train_criterion(outputs, labels)
+            if sampler is not None:
+                sampler.update(indices.numpy(), losses.detach().cpu().numpy())
+                weights = torch.from_numpy(sampler.weights[indices.numpy()]).cuda()
+                losses = weights * losses
+            loss = losses.mean()
             loss.backward()
             optimizer.step()
+            if (i + 1) % checkpoint_every == 0 or writer.preempted.is_set():
+                save_checkpoint(epoch, i + 1)
+            exit_if_preempted()
 
             # Print statistics
             running_loss += loss.item()
@@ -208,7 +677,7 @@ def main(savepath, load_state_dict=False, state_dict=None):
             minibatch_time += float(end - start)
             if (i + 1) % print_every == 0: 
                 minibatch_time = minibatch_time / (3600.0 * print_every)
-                num_minibatches_left = 1.01 * len(loader) - (i + 1)
+                num_minibatches_left = 1.01 * len(loader) - (i + 1 - step)
                 num_minibatches_per_epoch = 1.01 * len(loader) - 1 + ((len(vessel_dataset) % batch_size) / batch_size)
                 num_epochs_left = num_epochs - (epoch + 1)
                 time_left = minibatch_time * \
@@ -221,16 +690,20 @@ def main(savepath, load_state_dict=False, state_dict=None):
                 print('           Estimated Hours Remaining: %.2f\n' % time_left)
                 running_loss = 0.0
                 minibatch_time = 0.0
-        print('Epoch %d completed. Running validation...\n' % (epoch + 1))
-        metrics = validation(model, criterion, valid_loader)
-        print('[Epoch %d] Validation Accuracy: %.3f | Validation Loss: %.3f\n' %
-             ((epoch + 1), metrics['valid_acc'], metrics['valid_loss']))
-        print('Saving Model...\n')
-        torch.save(model.state_dict(), savepath)
-        print('Model Saved.\n')
+        if sampler is not None:
+            print('Epoch %d sampled %d of %d images (%d positive, %d hard negative, '
+                  '%d stale negative, %d easy negative)' % (
+                      (epoch + 1), len(sampler), sampler.counts['total'],
+                      sampler.counts['positive'], sampler.counts['hard_negative'],
+                      sampler.counts['stale_negative'], sampler.counts['easy_negative']))
+        # Saved before validation, so a preemption from here on loses no
+        # training, and marked so that resuming validates the epoch
+        save_checkpoint(epoch + 1, 0, validate=True)
+        validate_epoch(epoch)
     print('Finished Training.\n')
     print('Saving Model...\n')
-    torch.save(model.state_dict(), savepath)
+    writer.save(model.state_dict(), savepath)
+    writer.close()
     print('Done.')
 
     
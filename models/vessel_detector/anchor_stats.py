@@ -0,0 +1,161 @@
+import os
+import torch
+import numpy as np
+
+from vessel_detector import AnnotationIndex, Resize, ingest_annotations
+
+import pathlib
+from typing import Union, Optional, List, Tuple
+
+
+def get_box_shapes(boxes: np.ndarray,
+                   input_shape=(768, 768),
+                   output_shape=(299, 299)) -> Tuple[np.ndarray, int]:
+    '''
+    boxes: (N, 4) (x0, y0, x1, y1) boxes at `input_shape` resolution, which
+        may also be an (N, 2) array of per-box image (width, height), see
+        `box_image_sizes`
+    Returns the (M, 2) (width, height) of the boxes after the same `Resize`
+    used by `VesselDataset`, and the number of boxes which collapse to zero
+    width or height (these are never seen in training).
+    '''
+    boxes = Resize(input_shape=input_shape,
+                   output_shape=output_shape).resize_boxes(torch.from_numpy(boxes))
+    boxes = boxes.numpy().astype(np.float64)
+    shapes = np.stack([boxes[:,2] - boxes[:,0], boxes[:,3] - boxes[:,1]], axis=1)
+    degenerate = np.any(shapes <= 0, axis=1)
+    return shapes[~degenerate], int(degenerate.sum())
+
+
+def box_image_sizes(index: AnnotationIndex):
+    '''
+    (B, 2) (width, height) of the image of every box of `index`, in the
+    order of `index.boxes`, or (768, 768) if the index has no sizes.
+    '''
+    if index.sizes is None:
+        return (768, 768)
+    return np.repeat(np.asarray(index.sizes), np.diff(index.offsets), axis=0)
+
+
+def format_anchor_params(anchor_sizes, aspect_ratios) -> str:
+    '''
+    `anchor_sizes` and `aspect_ratios` as entries of the params of
+    `vessel_detector.main`, with one size per feature map.
+    '''
+    anchor_sizes = tuple((int(size),) for size in anchor_sizes)
+    return '    \'anchor_sizes\': %s,\n    \'aspect_ratios\': %s,' % (anchor_sizes,
+                                                                   tuple(aspect_ratios))
+
+
+def make_anchor_shapes(sizes, aspect_ratios) -> np.ndarray:
+    '''(len(sizes) * len(aspect_ratios), 2) anchor (width, height) as built by `AnchorGenerator`.'''
+    sizes = np.asarray(sizes, dtype=np.float64)
+    h_ratios = np.sqrt(np.asarray(aspect_ratios, dtype=np.float64))
+    w_ratios = 1 / h_ratios
+    ws = np.round((w_ratios[:, None] * sizes[None, :]).ravel())
+    hs = np.round((h_ratios[:, None] * sizes[None, :]).ravel())
+    return np.stack([ws, hs], axis=1)
+
+
+def shape_iou(shapes: np.ndarray, anchors: np.ndarray) -> np.ndarray:
+    '''(N, K) IoU of (width, height) `shapes` and `anchors` sharing a common center.'''
+    inter = np.minimum(shapes[:, None, 0], anchors[None, :, 0]) * \
+        np.minimum(shapes[:, None, 1], anchors[None, :, 1])
+    areas = shapes[:, 0] * shapes[:, 1]
+    anchor_areas = anchors[:, 0] * anchors[:, 1]
+    return inter / (areas[:, None] + anchor_areas[None, :] - inter)
+
+
+def anchor_recall(shapes: np.ndarray, anchors: np.ndarray, iou_thresh: float) -> float:
+    '''Fraction of boxes whose best matching anchor shape has IoU >= `iou_thresh`.'''
+    return float(np.mean(shape_iou(shapes, anchors).max(axis=1) >= iou_thresh))
+
+
+def kmeans_1d(values: np.ndarray, k: int, num_iters: int = 100) -> np.ndarray:
+    '''Sorted k-means centers of 1-D `values`, initialized at evenly spaced quantiles.'''
+    centers = np.quantile(values, (np.arange(k) + 0.5) / k)
+    for _ in range(num_iters):
+        labels = np.abs(values[:, None] - centers[None, :]).argmin(axis=1)
+        new_centers = np.array([values[labels == i].mean() if np.any(labels == i) \
+                                else centers[i] for i in range(k)])
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+    return np.sort(centers)
+
+
+def fit_anchors(shapes: np.ndarray,
+                target_recall: float = 0.95,
+                iou_thresh: float = 0.5,
+                max_sizes: int = 5,
+                max_ratios: int = 5) -> Tuple[tuple, tuple, float]:
+    '''
+    Fits the smallest set of anchor sizes x aspect ratios (the grid built by
+    `AnchorGenerator`) for which `anchor_recall` reaches `target_recall`.
+
+    Candidate sizes and ratios are 1-D k-means centers of the log box sizes
+    (sqrt(w * h)) and log aspect ratios (h / w). Returns (sizes, aspect_ratios,
+    recall); if no candidate reaches the target the best one found is returned.
+    '''
+    log_sizes = np.log(np.sqrt(shapes[:, 0] * shapes[:, 1]))
+    log_ratios = np.log(shapes[:, 1] / shapes[:, 0])
+    candidates = sorted([(n_sizes * n_ratios, n_sizes, n_ratios) \
+                         for n_sizes in range(1, max_sizes + 1) \
+                         for n_ratios in range(1, max_ratios + 1)])
+    best = None
+    for _, n_sizes, n_ratios in candidates:
+        sizes = tuple(sorted(set(int(max(1, round(s))) for s in \
+                                 np.exp(kmeans_1d(log_sizes, n_sizes)))))
+        ratios = tuple(sorted(set(float(round(r, 2)) for r in \
+                                  np.exp(kmeans_1d(log_ratios, n_ratios)))))
+        recall = anchor_recall(shapes, make_anchor_shapes(sizes, ratios), iou_thresh)
+        if best is None or recall > best[2]:
+            best = (sizes, ratios, recall)
+        if recall >= target_recall:
+            return sizes, ratios, recall
+    return best
+
+
+def print_shape_stats(shapes: np.ndarray, num_degenerate: int) -> None:
+    sizes = np.sqrt(shapes[:, 0] * shapes[:, 1])
+    ratios = shapes[:, 1] / shapes[:, 0]
+    quantiles = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+    print('Number of boxes: %d (%d collapse to zero size at 299x299)' %
+          (len(shapes), num_degenerate))
+    print('    Quantile | Size (sqrt(w*h)) | Aspect ratio (h/w)')
+    for q, s, r in zip(quantiles, np.quantile(sizes, quantiles), np.quantile(ratios, quantiles)):
+        print('    %-8.2f | %-16.2f | %-.3f' % (q, s, r))
+    print('\n')
+
+
+def main(index_dir: Union[str, pathlib.Path],
+         sources: Optional[List[dict]] = None,
+         target_recall: float = 0.95,
+         iou_thresh: float = 0.5,
+         anchor_sizes=((4,), (8,), (16,), (32,), (64,)),
+         aspect_ratios=(0.25, 0.5, 1.0, 2.0, 4.0)):
+    # `anchor_sizes` and `aspect_ratios` are the current params of `vessel_detector.main`
+    if not os.path.exists(os.path.join(index_dir, 'boxes.npy')):
+        ingest_annotations(sources, index_dir, no_null_samples=True, probe_sizes=True)
+    index = AnnotationIndex(index_dir)
+    shapes, num_degenerate = get_box_shapes(np.array(index.boxes), box_image_sizes(index))
+    print_shape_stats(shapes, num_degenerate)
+
+    current = make_anchor_shapes([size for sizes in anchor_sizes for size in sizes], aspect_ratios)
+    print('Current anchors (%d per location): recall %.4f at IoU >= %.2f' %
+          (len(current), anchor_recall(shapes, current, iou_thresh), iou_thresh))
+    sizes, aspect_ratios, recall = fit_anchors(shapes, target_recall, iou_thresh)
+    print('Fitted anchors (%d per location): recall %.4f at IoU >= %.2f' %
+          (len(sizes) * len(aspect_ratios), recall, iou_thresh))
+    print(format_anchor_params(sizes, aspect_ratios))
+    return sizes, aspect_ratios
+
+
+if __name__ == '__main__':
+    ship_dir = '../../../data/airbus-ship-detection/'
+    sources = [
+        {'csv': os.path.join(ship_dir, 'train_ship_segmentations_v2.csv'),
+         'image_dir': os.path.join(ship_dir, 'train_v2/')},
+    ]
+    index_dir = os.path.join(ship_dir, 'annotation_index_no_null/')
+    main(index_dir, sources)
@@ -0,0 +1,125 @@
+import os
+import time
+import tempfile
+import torch
+import numpy as np
+
+from PIL import Image
+from torch.utils.data import DataLoader, RandomSampler
+from torchvision.transforms.functional import resize
+from vessel_detector import AnnotationIndex, VesselDataset, ingest_annotations, \
+    make_loader, list_collate, stack_collate
+
+import pathlib
+from typing import Union, Optional, List, Tuple
+
+
+def benchmark_loader(loader: DataLoader, step_time: float = 0.0) -> Tuple[float, float]:
+    '''
+    Iterates `loader` once, sleeping `step_time` seconds per batch to stand in
+    for the training step. Returns (images/sec, fraction of wall time spent
+    waiting for data). The first batch (worker startup) is not counted.
+    '''
+    batches = iter(loader)
+    next(batches)
+    num_images, wait = 0, 0.0
+    start = time.perf_counter()
+    while True:
+        fetch_start = time.perf_counter()
+        try:
+            images, _ = next(batches)
+        except StopIteration:
+            break
+        wait += time.perf_counter() - fetch_start
+        num_images += len(images)
+        if step_time > 0:
+            time.sleep(step_time)
+    total = time.perf_counter() - start
+    return num_images / total, wait / total
+
+
+def compare_decode(image_paths: List[str],
+                   draft_size=(384, 384),
+                   size=(299, 299),
+                   repeats: int = 5) -> dict:
+    '''
+    Decodes and resizes every image to `size` at full resolution and through
+    a `draft_size` JPEG draft decode, as `open_image` does. Reports ms per
+    image for both paths and how far the draft results are from the full
+    ones (mean / max absolute difference in grey levels and PSNR).
+    '''
+    def decode(path, draft):
+        img = Image.open(path)
+        if draft is not None:
+            img.draft('RGB', draft)
+        return np.asarray(resize(img, size=size, interpolation=2).convert('RGB'), dtype=np.float64)
+
+    results = {}
+    for name, draft in [('full', None), ('draft', draft_size)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            outputs = [decode(path, draft) for path in image_paths]
+        results[name] = outputs
+        results[name + '_ms'] = 1000 * (time.perf_counter() - start) / (repeats * len(image_paths))
+    diff = np.abs(np.stack(results['full']) - np.stack(results['draft']))
+    mse = np.mean(diff ** 2)
+    comparison = {
+        'full_ms': results['full_ms'],
+        'draft_ms': results['draft_ms'],
+        'mean_abs_diff': float(diff.mean()),
+        'max_abs_diff': float(diff.max()),
+        'psnr': float(10 * np.log10(255 ** 2 / mse)) if mse > 0 else float('inf'),
+    }
+    print('Decode + resize to %dx%d (%d images):' % (size[0], size[1], len(image_paths)))
+    print('    Full decode:  %.2f ms/image' % comparison['full_ms'])
+    print('    Draft %dx%d: %.2f ms/image (%.1fx faster)' %
+          (draft_size[0], draft_size[1], comparison['draft_ms'],
+           comparison['full_ms'] / comparison['draft_ms']))
+    print('    Difference: mean %.2f, max %.0f grey levels, PSNR %.1f dB\n' %
+          (comparison['mean_abs_diff'], comparison['max_abs_diff'], comparison['psnr']))
+    return comparison
+
+
+def main(sources: List[dict],
+         worker_counts=(0, 1, 2, 4),
+         batch_size: int = 12,
+         num_samples: int = 480,
+         step_time: float = 0.0,
+         batch_augment: bool = True,
+         draft_size: Optional[Tuple[int, int]] = None,
+         index_dir: Optional[Union[str, pathlib.Path]] = None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_dir = index_dir or tmp_dir
+        if not os.path.exists(os.path.join(index_dir, 'boxes.npy')):
+            ingest_annotations(sources, index_dir, no_null_samples=True)
+        index = AnnotationIndex(index_dir)
+        dataset = VesselDataset(None, index.ids, None, mode='train', index=index,
+                                batch_augment=batch_augment, draft_size=draft_size)
+        print('%d images, batch size %d, %d samples per run, %.3fs per training step, '
+              'draft decode %s' % (len(dataset), batch_size, num_samples, step_time, draft_size))
+        print('    Workers | Images/sec | Data wait')
+        results = {}
+        for num_workers in worker_counts:
+            sampler = RandomSampler(dataset, replacement=True, num_samples=num_samples)
+            loader = make_loader(dataset, batch_size, sampler=sampler,
+                                 collate_fn=stack_collate if batch_augment else list_collate,
+                                 num_workers=num_workers)
+            results[num_workers] = benchmark_loader(loader, step_time)
+            print('    %-7d | %-10.1f | %.1f%%' % (num_workers, results[num_workers][0],
+                                                   100 * results[num_workers][1]))
+            del loader
+    return results
+
+
+if __name__ == '__main__':
+    ship_dir = '../../dev/'
+    sources = [
+        {'csv': os.path.join(ship_dir, 'train_ship_segmentations_v2.csv'),
+         'image_dir': os.path.join(ship_dir, 'imgs/')},
+    ]
+    image_dir = sources[0]['image_dir']
+    compare_decode([os.path.join(image_dir, name) for name in sorted(os.listdir(image_dir))])
+    main(sources)
+    main(sources, draft_size=(384, 384))
+    # With a GPU-sized training step the loader should keep the wait near zero
+    main(sources, step_time=0.05, draft_size=(384, 384))
@@ -0,0 +1,165 @@
+import os
+import multiprocessing
+import numpy as np
+
+from PIL import Image, ImageFile
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from vessel_detector import AnnotationIndex, ZipImageSource, open_image
+
+import pathlib
+from typing import Union, Optional, List, Tuple
+
+
+def dct_matrix(n: int) -> np.ndarray:
+    '''(n, n) orthonormal DCT-II matrix.'''
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_32 = dct_matrix(32)
+
+
+def phash(img: Image.Image) -> np.uint64:
+    '''
+    64-bit perceptual hash: the signs of the 8x8 lowest frequencies of the DCT
+    of the 32x32 greyscale image, relative to their median (DC excluded).
+    Constant (e.g. entirely black) images all hash to 0.
+    '''
+    img.draft('L', (64, 64))
+    pixels = np.asarray(img.convert('L').resize((32, 32), Image.BILINEAR), dtype=np.float64)
+    coefficients = (DCT_32 @ pixels @ DCT_32.T)[:8, :8].ravel()
+    bits = coefficients > np.median(coefficients[1:])
+    bits[0] = False
+    if np.ptp(pixels) == 0:
+        bits[:] = False
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+
+def hash_images(args) -> np.ndarray:
+    '''Worker for `compute_hashes`: hashes `names` from one image directory or archive.'''
+    image_dir, names = args
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    return np.array([phash(open_image(image_dir, name)) for name in names], dtype=np.uint64)
+
+
+def compute_hashes(index: AnnotationIndex,
+                   ids: np.ndarray,
+                   image_dir: Optional[Union[str, pathlib.Path]] = None,
+                   num_workers: int = 0,
+                   chunksize: int = 256) -> np.ndarray:
+    '''(len(ids),) uint64 `phash` of images `ids`, read from their index root, else `image_dir`.'''
+    roots = [index.image_dir(idx) or image_dir for idx in ids]
+    missing = sum(root is None for root in roots)
+    if missing > 0:
+        raise ValueError('%d images have no index root; image_dir is required' % missing)
+    archives = {root: ZipImageSource(root) for root in set(roots) if os.path.isfile(root)}
+    jobs, positions = [], []
+    for root in sorted(set(roots)):
+        rows = [i for i, r in enumerate(roots) if r == root]
+        for first in range(0, len(rows), chunksize):
+            chunk = rows[first:first + chunksize]
+            jobs.append((archives.get(root, root), [index.name(ids[i]) for i in chunk]))
+            positions.append(chunk)
+    if num_workers > 0:
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.map(hash_images, jobs)
+    else:
+        results = [hash_images(job) for job in jobs]
+    hashes = np.zeros(len(ids), dtype=np.uint64)
+    for chunk, result in zip(positions, results):
+        hashes[chunk] = result
+    return hashes
+
+
+POPCOUNT_8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    '''Elementwise Hamming distance of two uint64 arrays.'''
+    xor = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return POPCOUNT_8[xor.view(np.uint8)].reshape((-1, 8)).sum(axis=1)
+
+
+def near_duplicate_groups(hashes: np.ndarray, max_distance: int = 4) -> np.ndarray:
+    '''
+    Group number of every hash, where hashes within Hamming distance
+    `max_distance` (transitively) share a group.
+
+    Multi-index lookup: the 64 bits are split into `max_distance + 1`
+    contiguous chunks, so by the pigeonhole principle two hashes within
+    `max_distance` agree exactly on at least one chunk. Only pairs sharing a
+    chunk value are compared, found per chunk by sorting on it. Identical
+    hashes (e.g. all black tiles) are collapsed first.
+    '''
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    bounds = np.linspace(0, 64, max_distance + 2).astype(np.uint64)
+    rows, cols = [], []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        mask = np.uint64((1 << int(hi - lo)) - 1)
+        chunk = (unique >> lo) & mask
+        order = np.argsort(chunk, kind='stable')
+        chunk = chunk[order]
+        # Pairs (i, i + k) of the sorted chunks are in the same bucket while
+        # equal; once they differ they differ for every larger k
+        same = np.arange(len(order))
+        k = 1
+        while True:
+            same = same[same + k < len(order)]
+            same = same[chunk[same + k] == chunk[same]]
+            if len(same) == 0:
+                break
+            a, b = order[same], order[same + k]
+            close = hamming(unique[a], unique[b]) <= max_distance
+            rows.append(a[close])
+            cols.append(b[close])
+            k += 1
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                       shape=(len(unique), len(unique)))
+    _, labels = connected_components(graph, directed=False)
+    return labels[inverse]
+
+
+def select_representatives(ids: np.ndarray,
+                           groups: np.ndarray,
+                           num_boxes: np.ndarray) -> np.ndarray:
+    '''Sorted IDs keeping one image per group: the one with most boxes, then the lowest ID.'''
+    order = np.lexsort((ids, -num_boxes, groups))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    return np.sort(ids[order][first])
+
+
+def main(index_dir: Union[str, pathlib.Path],
+         image_dir: Optional[Union[str, pathlib.Path]] = None,
+         max_distance: int = 4,
+         num_workers: int = 8) -> np.ndarray:
+    '''
+    Hashes every image of the index and writes the deduplicated ID list to
+    `index_dir/dedup_ids.npy`, for `get_train_valid_dfs` / `AnnotationIndex.split`.
+    '''
+    index = AnnotationIndex(index_dir)
+    ids = np.asarray(index.ids)
+    hashes = compute_hashes(index, ids, image_dir, num_workers=num_workers)
+    groups = near_duplicate_groups(hashes, max_distance)
+    keep_ids = select_representatives(ids, groups, np.diff(index.offsets))
+    np.save(os.path.join(index_dir, 'dedup_ids.npy'), keep_ids)
+    sizes = np.bincount(groups)
+    print('Images: %d, near-duplicate groups (Hamming distance <= %d): %d' %
+          (len(ids), max_distance, len(sizes)))
+    print('    Groups with duplicates: %d, largest group: %d images' %
+          (int(np.sum(sizes > 1)), int(sizes.max()) if len(sizes) else 0))
+    print('    Constant (e.g. black) images: %d' % int(np.sum(hashes == 0)))
+    print('    Kept: %d, removed: %d\n' % (len(keep_ids), len(ids) - len(keep_ids)))
+    return keep_ids
+
+
+if __name__ == '__main__':
+    ship_dir = '../../../data/airbus-ship-detection/'
+    index_dir = os.path.join(ship_dir, 'annotation_index_no_null/')
+    main(index_dir, os.path.join(ship_dir, 'train_v2/'))
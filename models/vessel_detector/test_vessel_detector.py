@@ -1,8 +1,19 @@
 import unittest
 
 from vessel_detector import *
+import anchor_stats
+import near_duplicates
 
+import io
 import os
+import pickle
+import multiprocessing
+import random
+import shutil
+import signal
+import zipfile
+import tempfile
+import threading
 import time
 import torch
 import math
@@ -16,10 +27,12 @@ from torch import tensor
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
+from torch.utils.data import Subset
 from torchvision import transforms
 from torchvision.models.detection.rpn import AnchorGenerator
 from torchvision.models.detection.faster_rcnn import FasterRCNN, FastRCNNPredictor
 from torchvision.ops.boxes import box_iou
+from torchvision.ops.misc import FrozenBatchNorm2d
 from torchvision.transforms import ToTensor, Compose, RandomHorizontalFlip,\
     RandomVerticalFlip,  Normalize
 from sklearn.model_selection import train_test_split
@@ -30,6 +43,25 @@ from typing import Callable, Iterator, Union, Optional, List, Tuple, Dict
 from torchvision.transforms.functional import resize
 
 
+DEV_SOURCES = [{'csv': os.path.join('../../dev/', 'train_ship_segmentations_v2.csv'),
+                'image_dir': os.path.join('../../dev/', 'imgs/')}]
+# Indexes of the dev CSV by `no_null_samples`, ingested once for all tests
+# which only read them
+dev_index_dirs = {}
+
+
+def dev_index(no_null_samples: bool = True) -> AnnotationIndex:
+    if no_null_samples not in dev_index_dirs:
+        dev_index_dirs[no_null_samples] = tempfile.TemporaryDirectory()
+        ingest_annotations(DEV_SOURCES, dev_index_dirs[no_null_samples].name, no_null_samples)
+    return AnnotationIndex(dev_index_dirs[no_null_samples].name)
+
+
+def tearDownModule():
+    for index_dir in dev_index_dirs.values():
+        index_dir.cleanup()
+
+
 class TestVesselDetector(unittest.TestCase):
     def test_training(self):
         self.main(train = True)
@@ -181,6 +213,984 @@ class TestVesselDetector(unittest.TestCase):
         
 
 
+class TestAnnotations(unittest.TestCase):
+    ship_dir = '../../dev/'
+
+
+    def test_rle2bbox_batch(self):
+        masks = get_masks(self.ship_dir, None, None)
+        boxes = rle2bbox_batch(masks['EncodedPixels'], (768, 768))
+        self.assertEqual(boxes.shape, (len(masks), 4))
+        self.assertEqual(boxes.dtype, np.float32)
+        for rle, box in zip(masks['EncodedPixels'], boxes):
+            if isinstance(rle, str):
+                self.assertEqual(tuple(box), tuple(float(v) for v in rle2bbox(rle, (768, 768))))
+            else:
+                self.assertTrue(np.isnan(box).all())
+        # Runs are counted per RLE whatever the whitespace around them
+        is_str, n_pairs, starts, lengths = rle_pairs([' 1 3  5 2 ', None, '10 4\t'])
+        self.assertEqual(list(is_str), [True, False, True])
+        self.assertEqual(list(n_pairs), [2, 1])
+        self.assertEqual(list(starts), [0, 4, 9])
+        self.assertEqual(list(lengths), [3, 2, 4])
+
+
+
+    def test_annotation_index(self):
+        masks = get_masks(self.ship_dir, None, None)
+        image_names, image_masks = filter_masks(masks, no_null_samples=False)
+        with tempfile.TemporaryDirectory() as index_dir:
+            compile_annotation_index(image_names, image_masks, index_dir)
+            index = AnnotationIndex(index_dir)
+            self.assertEqual(len(index), len(image_names))
+            for idx, in_mask_list in image_masks.items():
+                self.assertEqual(index.name(idx), image_names[idx])
+                N = sum([1 for i in in_mask_list if isinstance(i, str)])
+                target = make_target(in_mask_list, N)
+                self.assertTrue(torch.equal(
+                    make_target_from_boxes(index.image_boxes(idx))['boxes'], target['boxes']
+                ))
+
+
+    def test_filter_annotations(self):
+        masks = get_masks(self.ship_dir, None, None)
+        # A second, empty mask makes `0005d01c8.jpg` invalid
+        masks = pd.concat([masks, pd.DataFrame({'ImageId': ['0005d01c8.jpg'],
+                                                'EncodedPixels': ['1 0']})])
+        for no_null_samples in (True, False):
+            image_names, image_masks = filter_masks(masks, no_null_samples)
+            annotations, report = filter_annotations(masks, no_null_samples)
+            self.assertEqual(list(annotations['ids']), sorted(image_names.keys()))
+            self.assertEqual(report['invalid_box'], 1)
+            self.assertEqual(report['kept'], len(image_names))
+            self.assertEqual(list(split_image_ids(annotations['ids'], 0, 1)[0]),
+                             get_train_valid_dfs(image_masks, 0, 1)[0])
+
+
+    def test_stratified_split(self):
+        # Counts 5 and 7 have one image each and are pooled; the lone 0 joins the 1s
+        strata = pooled_strata(np.array([0, 1, 1, 2, 2, 2, 5, 7]))
+        self.assertEqual(list(strata), [2, 2, 2, 1, 1, 1, 0, 0])
+        index = dev_index(no_null_samples=False)
+        train_ids, valid_ids = index.split(0, 0.4, stratify=True)
+        self.assertEqual(sorted(np.concatenate([train_ids, valid_ids])), list(index.ids))
+        # Every box count (0, 1 and 2) is represented in the held-out images
+        counts = np.diff(index.offsets)[np.searchsorted(index.ids, valid_ids)]
+        self.assertEqual(set(counts.tolist()), {0, 1, 2})
+
+
+    def test_ingest_annotations(self):
+        csv = os.path.join(self.ship_dir, 'train_ship_segmentations_v2.csv')
+        image_dir = os.path.join(self.ship_dir, 'imgs/')
+        annotations, _ = filter_annotations(get_masks(self.ship_dir, None, None), True)
+        with tempfile.TemporaryDirectory() as index_dir:
+            sources = [{'csv': csv, 'image_dir': image_dir},
+                       {'csv': csv, 'image_dir': image_dir}, # Same images again
+                       {'csv': csv, 'image_dir': 'other_imgs/'}]
+            report = ingest_annotations(sources, index_dir, True, chunksize=5)
+            index = AnnotationIndex(index_dir)
+            n = len(annotations['ids'])
+            self.assertEqual(report['kept'], 2 * n)
+            self.assertEqual(report['duplicate'], 9)
+            self.assertTrue(np.array_equal(index.names[:n], annotations['names']))
+            self.assertTrue(np.array_equal(index.boxes[:len(annotations['boxes'])],
+                                           annotations['boxes']))
+            self.assertEqual(index.image_dir(index.ids[n]), 'other_imgs/')
+            # Only index arrays are left behind
+            self.assertFalse([f for f in os.listdir(index_dir) if not f.endswith('.npy')])
+            # Rows of an image spread over several chunks end up together
+            shuffled_csv = os.path.join(index_dir, 'shuffled.csv')
+            masks = pd.read_csv(csv)
+            masks.sample(frac=1.0, random_state=0).to_csv(shuffled_csv, index=False)
+            shuffled_dir = os.path.join(index_dir, 'shuffled/')
+            ingest_annotations([{'csv': shuffled_csv, 'image_dir': image_dir}], shuffled_dir, True,
+                               chunksize=4)
+            shuffled = AnnotationIndex(shuffled_dir)
+            self.assertTrue(np.array_equal(shuffled.names, annotations['names']))
+            self.assertTrue(np.array_equal(shuffled.offsets, annotations['offsets']))
+            for idx in shuffled.ids:
+                expected = masks[masks.ImageId == shuffled.name(idx)]['EncodedPixels'].values
+                expected = rle2bbox_batch(expected[pd.notna(expected)], (768, 768))
+                self.assertTrue(np.array_equal(np.sort(shuffled.image_boxes(idx), axis=0),
+                                               np.sort(expected.astype(np.int32), axis=0)))
+
+
+    def test_merge_sorted_runs(self):
+        rng = np.random.RandomState(0)
+        dtype = [('key', np.int32), ('name', 'S2'), ('row', np.int64)]
+        with tempfile.TemporaryDirectory() as run_dir:
+            runs, paths = [], []
+            for k, size in enumerate([0, 7, 30, 1, 12]):
+                run = np.zeros(size, dtype=dtype)
+                run['key'] = rng.randint(0, 3, size)
+                run['name'] = rng.choice([b'a', b'bb', b'c'], size)
+                run['row'] = np.arange(size) + 100 * k
+                runs.append(run)
+                paths.append(os.path.join(run_dir, '%d.npy' % k))
+                np.save(paths[-1], np.sort(run, order=['key', 'name', 'row']))
+            expected = np.sort(np.concatenate(runs), order=['key', 'name', 'row'])
+            for block_size in [1, 3, 64]:
+                batches = list(merge_sorted_runs(paths, ('key', 'name', 'row'), dtype, block_size))
+                self.assertTrue(np.array_equal(np.concatenate(batches), expected))
+
+
+    def test_instance_masks(self):
+        masks = get_masks(self.ship_dir, None, None)
+        sources = DEV_SOURCES
+        with tempfile.TemporaryDirectory() as index_dir:
+            ingest_annotations(sources, index_dir, True, chunksize=5, with_masks=True)
+            single = index = AnnotationIndex(index_dir)
+            for idx in index.ids:
+                rles = masks[masks.ImageId == index.name(idx)]['EncodedPixels'].values
+                instance_masks = index.image_masks(idx, out_shape=(768, 768))
+                self.assertEqual(len(instance_masks), len(rles))
+                for rle, mask in zip(rles, instance_masks):
+                    # Column-major decode of the full mask
+                    s = np.array(rle.split(), dtype=int).reshape((-1, 2))
+                    full = np.zeros(768 * 768, dtype=np.uint8)
+                    for start, length in s:
+                        full[start - 1:start - 1 + length] = 1
+                    self.assertTrue(np.array_equal(mask, full.reshape((768, 768)).T))
+            dataset = VesselDataset(None, np.array(index.ids), None, index=index,
+                                    return_masks=True)
+            img, target = dataset[0]
+            self.assertEqual(tuple(target['masks'].shape), (len(target['boxes']), 299, 299))
+            # Masks copied from interleaved sources match those of a single source
+            with tempfile.TemporaryDirectory() as merged_dir:
+                ingest_annotations(sources + [dict(sources[0], image_dir='other_imgs/')] + sources,
+                                   merged_dir, True, chunksize=3, with_masks=True)
+                index = AnnotationIndex(merged_dir)
+                n = len(single)
+                self.assertEqual(len(index), 2 * n)
+                for i in range(len(index)):
+                    self.assertTrue(np.array_equal(
+                        index.image_masks(index.ids[i], out_shape=(768, 768)),
+                        single.image_masks(single.ids[i % n], out_shape=(768, 768))))
+
+
+    def test_rle_encode_batch(self):
+        masks = get_masks(self.ship_dir, None, None)
+        rles = [rle for rle in masks['EncodedPixels'] if isinstance(rle, str)]
+        boxes, bits, nbytes = rle2crop_batch(rles, (768, 768))
+        offsets = np.concatenate(([0], np.cumsum(nbytes)))
+        full = np.zeros((len(rles) + 1, 768, 768), dtype=np.uint8) # Last mask is empty
+        for i, box in enumerate(boxes.astype(int)):
+            x0, y0, x1, y1 = box
+            full[i, y0:y1, x0:x1 + 1] = unpack_crop(bits[offsets[i]:offsets[i + 1]], box)
+        self.assertEqual(rle_encode_batch(full), rles + [None])
+
+
+    def test_boxes2rle_batch(self):
+        boxes = np.array([[10, 20, 13, 25], [5, 5, 5, 9], [760, 760, 800, 800]])
+        masks = np.zeros((3, 768, 768), dtype=np.uint8)
+        masks[0, 20:25, 10:13] = 1
+        masks[2, 760:, 760:] = 1
+        self.assertEqual(boxes2rle_batch(boxes), rle_encode_batch(masks))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'submission.csv')
+            write_rle_csv(path, ['a.jpg', 'b.jpg'], boxes2rle_batch(boxes[:2]))
+            write_rle_csv(path, ['c.jpg'], boxes2rle_batch(boxes[2:]), append=True)
+            df = pd.read_csv(path)
+            self.assertEqual(list(df.ImageId), ['a.jpg', 'b.jpg', 'c.jpg'])
+            self.assertTrue(df.EncodedPixels.isnull()[1])
+
+
+    def test_fit_anchors(self):
+        rng = np.random.RandomState(0)
+        shapes = np.exp(rng.normal(2.5, 0.6, size=(2000, 2)))
+        sizes, aspect_ratios, recall = anchor_stats.fit_anchors(shapes, target_recall=0.9)
+        self.assertGreaterEqual(recall, 0.9)
+        self.assertLess(len(sizes) * len(aspect_ratios), 25)
+        anchors = anchor_stats.make_anchor_shapes(sizes, aspect_ratios)
+        self.assertEqual(anchor_stats.anchor_recall(shapes, anchors, 0.5), recall)
+        # Printed in the format of the params of `main`, one size per feature map
+        params = eval('{%s}' % anchor_stats.format_anchor_params(sizes, aspect_ratios))
+        self.assertEqual(params['anchor_sizes'], tuple((size,) for size in sizes))
+        self.assertEqual(params['aspect_ratios'], aspect_ratios)
+        # Boxes are rescaled from the size of their own image
+        boxes = np.array([[0, 0, 100, 100], [0, 0, 100, 100]], dtype=np.float32)
+        box_shapes, _ = anchor_stats.get_box_shapes(boxes, np.array([[768, 768], [598, 299]]))
+        self.assertTrue(np.array_equal(box_shapes, [[39, 39], [50, 100]]))
+
+
+    def test_append_labels(self):
+        with tempfile.TemporaryDirectory() as index_dir, \
+             tempfile.TemporaryDirectory() as tile_dir:
+            # Appending changes the index, so a copy of the shared one is used
+            shutil.copytree(dev_index().index_dir, index_dir, dirs_exist_ok=True)
+            train_ids, valid_ids = AnnotationIndex(index_dir).split(0, 1)
+            labels_csv = os.path.join(tile_dir, 'labels.csv')
+            pd.DataFrame({'sample_id': ['a', 'b', 'c'], 'label': [1, 0, 0]}).to_csv(labels_csv)
+            self.assertEqual(append_labels(index_dir, labels_csv, tile_dir, 0.5), 3)
+            self.assertEqual(append_labels(index_dir, labels_csv, tile_dir, 0.5), 0)
+            index = AnnotationIndex(index_dir)
+            self.assertEqual(len(index), 8)
+            self.assertEqual(index.name(7), 'c.jpg')
+            self.assertEqual(index.image_dir(7), tile_dir)
+            new_train_ids, new_valid_ids = index.split(0, 1)
+            self.assertEqual(list(new_train_ids[:len(train_ids)]), list(train_ids))
+            self.assertEqual(list(new_valid_ids[:len(valid_ids)]), list(valid_ids))
+            # The positive tile has no boxes, so the detector cannot train on it
+            self.assertEqual(list(index.has_box_targets(index.ids)), [True] * 5 + [False, True, True])
+            # A later batch only adds its unseen tiles, after the existing IDs
+            pd.DataFrame({'sample_id': ['d', 'c', 'a'], 'label': [0, 0, 1]}).to_csv(labels_csv)
+            self.assertEqual(append_labels(index_dir, labels_csv, tile_dir, 0.5), 1)
+            index = AnnotationIndex(index_dir)
+            self.assertNotIn('boxes', vars(index)) # Arrays are merged on first use
+            self.assertEqual(len(index), 9)
+            self.assertEqual(index.name(8), 'd.jpg')
+            self.assertEqual(list(index.root_ids), [0] * 5 + [1] * 3 + [2])
+            self.assertEqual(index.roots, [DEV_SOURCES[0]['image_dir'], tile_dir, tile_dir])
+
+
+    def test_pickled_index(self):
+        # Spawned workers unpickle the index from its directory
+        index = dev_index()
+        self.assertLess(len(pickle.dumps(index)), 1000)
+        self.assertIsInstance(pickle.loads(pickle.dumps(index)).boxes, np.memmap)
+        with tempfile.TemporaryDirectory() as index_dir, \
+             tempfile.TemporaryDirectory() as tile_dir:
+            shutil.copytree(index.index_dir, index_dir, dirs_exist_ok=True)
+            labels_csv = os.path.join(tile_dir, 'labels.csv')
+            pd.DataFrame({'sample_id': ['a', 'b'], 'label': [1, 0]}).to_csv(labels_csv)
+            append_labels(index_dir, labels_csv, tile_dir, 0.5)
+            index = AnnotationIndex(index_dir)
+            expected = {key: np.array(getattr(index, key)) for key in ('ids', 'offsets', 'labels')}
+            # Segments are merged once, in the parent, and the copies map the merged arrays
+            index.merge()
+            self.assertIsInstance(index.boxes, np.memmap)
+            copy = pickle.loads(pickle.dumps(index))
+            self.assertIn('boxes', vars(copy))
+            self.assertIsInstance(copy.boxes, np.memmap)
+            for key, value in expected.items():
+                self.assertTrue(np.array_equal(getattr(copy, key), value))
+            self.assertEqual(copy.roots, index.roots)
+            # Merged again once a batch is added
+            pd.DataFrame({'sample_id': ['c'], 'label': [0]}).to_csv(labels_csv)
+            append_labels(index_dir, labels_csv, tile_dir, 0.5)
+            self.assertEqual(len(pickle.loads(pickle.dumps(index)).ids), len(expected['ids']) + 1)
+        # Tile caches are pickled by directory too
+        with tempfile.TemporaryDirectory() as cache_dir:
+            build_tile_cache([(DEV_SOURCES[0]['image_dir'], index.name(index.ids[0]))], cache_dir)
+            tile_cache = TileCache(cache_dir)
+            self.assertLess(len(pickle.dumps(tile_cache)), 1000)
+            self.assertTrue(np.array_equal(pickle.loads(pickle.dumps(tile_cache)).tiles,
+                                           tile_cache.tiles))
+
+
+    def test_tile_cache(self):
+        index = dev_index()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            images = [(index.image_dir(i), index.name(i)) for i in index.ids]
+            image_paths = [os.path.join(root, name) for root, name in images]
+            cache_dir = os.path.join(tmp_dir, 'tile_cache_299/')
+            build_tile_cache(images[::-1], cache_dir, chunksize=2)
+            tile_cache = TileCache(cache_dir)
+            self.assertEqual(len(tile_cache), len(index))
+            for path in image_paths:
+                expected = resize(Image.open(path), size=(299, 299), interpolation=2)
+                tile = tile_cache.tile(os.path.basename(path))
+                self.assertEqual(tile.shape, (299, 299, 3))
+                self.assertTrue(np.array_equal(tile, np.asarray(expected)))
+            self.assertNotIn('missing.jpg', tile_cache)
+            with self.assertRaises(KeyError):
+                tile_cache.tile('missing.jpg')
+
+            # Cached tiles give the same samples as decoding and resizing
+            for cache in [None, tile_cache]:
+                dataset = VesselDataset(None, index.ids, None, mode='valid',
+                                        index=index, tile_cache=cache)
+                img, target = dataset[1]
+                if cache is None:
+                    expected_img, expected_target = img, target
+            self.assertTrue(torch.equal(img, expected_img))
+            self.assertTrue(torch.equal(target['boxes'], expected_target['boxes']))
+
+
+    def test_replay_cache(self):
+        index = dev_index()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            images = [(index.image_dir(i), index.name(i)) for i in index.ids]
+            cache_dir = os.path.join(tmp_dir, 'replay_cache_299/')
+            variants = REPLAY_VARIANTS + ((False, True, True),)
+            build_tile_cache(images, cache_dir, chunksize=2, variants=variants)
+            tile_cache = TileCache(cache_dir)
+            self.assertEqual(tile_cache.tiles.shape, (len(index), 3, 299, 299, 3))
+            name = index.name(index.ids[1])
+            img = resize(Image.open(os.path.join(*images[1])), size=(299, 299), interpolation=2)
+            self.assertTrue(np.array_equal(tile_cache.tile(name, 0), np.asarray(img)))
+            self.assertTrue(np.array_equal(tile_cache.tile(name, 1),
+                                           np.asarray(img.filter(ImageFilter.GaussianBlur(2)))))
+            self.assertTrue(np.array_equal(tile_cache.tile(name, 2), np.asarray(img)[::-1, ::-1]))
+
+            # Variants are drawn with the probabilities of the random transforms
+            sampler = VariantSampler(tile_cache.variants, blur_p=0.95, hflip_p=0.5, vflip_p=0.5)
+            self.assertTrue(np.allclose(sampler.probs, np.array([0.0125, 0.2375, 0.0125]) / 0.2625))
+            counts = np.bincount([sampler() for _ in range(2000)], minlength=3)
+            self.assertTrue(np.allclose(counts / 2000, sampler.probs, atol=0.05))
+
+            # Flipped variants get flipped boxes, as from `BatchAugment`
+            dataset = VesselDataset(None, index.ids, None, mode='train', index=index,
+                                    tile_cache=tile_cache, batch_augment=True,
+                                    variant_sampler=VariantSampler(tile_cache.variants,
+                                                                   hflip_p=1.0, vflip_p=1.0))
+            img, target = dataset[1]
+            plain_img, plain_target = VesselDataset(None, index.ids, None, mode='train',
+                                                    index=index, batch_augment=True)[1]
+            expected_img, expected_targets = BatchAugment(hflip_p=1.0, vflip_p=1.0, normalize=False)(
+                plain_img[None], [plain_target])
+            self.assertTrue(torch.equal(img.float(), expected_img[0]))
+            self.assertTrue(torch.equal(target['boxes'], expected_targets[0]['boxes']))
+
+            # Every worker draws its own reproducible stream
+            sampler = VariantSampler(tile_cache.variants, blur_p=0.5)
+            dataset = VesselDataset(None, np.repeat(index.ids, 8), None, mode='train', index=index,
+                                    tile_cache=tile_cache, batch_augment=True,
+                                    variant_sampler=sampler)
+            draws = []
+            for _ in range(2):
+                loader = make_loader(dataset, 8, num_workers=2, persistent_workers=False,
+                                     collate_fn=stack_collate, pin_memory=False)
+                draws.append(torch.cat([images for images, _ in loader]))
+            self.assertTrue(torch.equal(draws[0], draws[1]))
+            blurred = np.array([np.array_equal(img.permute(1, 2, 0).numpy(),
+                                               tile_cache.tile(index.name(i), 1)) \
+                                for img, i in zip(draws[0], dataset.image_ids)])
+            self.assertFalse(np.array_equal(blurred[:8], blurred[8:16]))
+
+
+    def test_resized_validity(self):
+        boxes = np.array([[0, 0, 10, 10], [100, 100, 101, 120], [5, 5, 700, 9],
+                          [0, 0, 768, 768]], dtype=np.int32)
+        offsets = np.array([0, 1, 1, 3, 4])
+        expected = []
+        for first, last in zip(offsets[:-1], offsets[1:]):
+            resized = Resize().resize_boxes(torch.from_numpy(boxes[first:last].astype(np.float32)))
+            expected.append(all(is_valid_box(row, shape=(299, 299)) for row in resized))
+        self.assertEqual(list(resized_validity(boxes, offsets)), expected)
+        self.assertEqual(expected, [True, True, False, True])
+        sizes = np.array([[768, 768], [768, 768], [768, 768], [1536, 768]])
+        self.assertEqual(list(resized_validity(boxes, offsets, sizes, chunksize=1)),
+                         list(resized_validity(boxes, offsets, sizes)))
+
+        index = dev_index()
+        self.assertTrue(os.path.exists(os.path.join(index.index_dir, 'resized_valid.npy')))
+        self.assertEqual(list(index.resized_valid),
+                         list(resized_validity(index.boxes, index.offsets)))
+        dataset = VesselDataset(None, index.ids, None, mode='valid', index=index,
+                                filter_invalid=False)
+        valid = np.zeros(len(dataset), dtype=bool)
+        valid[::2] = True
+        sampler = ValidSampler(valid & dataset.valid_mask())
+        self.assertEqual(sorted(sampler), list(np.flatnonzero(valid & dataset.valid_mask())))
+        self.assertEqual(sampler.num_excluded + len(sampler), len(dataset))
+        # By default the dataset itself drops the invalid samples
+        filtered = VesselDataset(None, index.ids, None, mode='valid', index=index)
+        self.assertEqual(list(filtered.image_ids),
+                         list(index.ids[dataset.valid_mask()]))
+        self.assertEqual(filtered.num_excluded, int(np.sum(~dataset.valid_mask())))
+        self.assertTrue(filtered.valid_mask().all())
+
+
+class TestBatchAugment(unittest.TestCase):
+    ship_dir = '../../dev/'
+
+
+    def test_matches_per_sample_transforms(self):
+        image_dir = os.path.join(self.ship_dir, 'imgs/')
+        img = resize(Image.open(os.path.join(image_dir, sorted(os.listdir(image_dir))[0])),
+                     size=(299, 299), interpolation=2)
+        batch = torch.from_numpy(np.array(img)).permute(2, 0, 1)[None]
+        mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+        expected = Compose([ToTensor(), Normalize(mean, std)])(img)
+        self.assertTrue(torch.allclose(BatchAugment()(batch)[0], expected, atol=1e-5))
+        # PIL approximates the Gaussian with box blurs, so levels differ slightly
+        blurred = BatchAugment(blur_p=1.0).blur(batch.float())[0].permute(1, 2, 0).numpy()
+        expected = np.asarray(img.filter(ImageFilter.GaussianBlur(2))).astype(np.float32)
+        self.assertLess(np.abs(blurred - expected).mean(), 0.5)
+
+
+    def test_flip_boxes(self):
+        images = torch.zeros((2, 3, 299, 299), dtype=torch.uint8)
+        images[:, :, 20:60, 10:30] = 255
+        targets = [{'boxes': torch.tensor([[10., 20., 30., 60.]]),
+                    'labels': torch.ones(1, dtype=torch.int64)} for _ in range(2)]
+        out, out_targets = BatchAugment(hflip_p=1.0, vflip_p=1.0, mean=(0, 0, 0),
+                                        std=(1, 1, 1))(images, targets)
+        for image, target in zip(out, out_targets):
+            x0, y0, x1, y1 = target['boxes'][0].int().tolist()
+            self.assertEqual([x0, y0, x1, y1], [269, 239, 289, 279])
+            self.assertEqual(image[0].sum().item(), image[0, y0:y1, x0:x1].sum().item())
+            self.assertEqual(image[0, y0:y1, x0:x1].min().item(), 1.0)
+        # Input targets are left untouched
+        self.assertEqual(targets[0]['boxes'][0].tolist(), [10., 20., 30., 60.])
+
+
+class TestZipImageSource(unittest.TestCase):
+    ship_dir = '../../dev/'
+    archive = '../../dev_data/raw_images.zip'
+
+
+    def test_read(self):
+        source = ZipImageSource(self.archive, prefix='content/imgs/')
+        with zipfile.ZipFile(self.archive) as archive:
+            members = [name for name in archive.namelist() if not name.endswith('/')]
+            self.assertEqual(len(source), len(members))
+            for member in members:
+                self.assertEqual(source.read(os.path.basename(member)), archive.read(member))
+        self.assertIn('0014b1235.jpg', source)
+        with self.assertRaises(KeyError):
+            source.read('missing.jpg')
+        # Unpickled copies (spawned workers) open their own handle
+        copy = pickle.loads(pickle.dumps(source))
+        self.assertEqual(copy.read('0014b1235.jpg'), source.read('0014b1235.jpg'))
+        self.assertEqual(copy.open('0014b1235.jpg').size, (768, 768))
+
+
+    def test_dataset(self):
+        csv = os.path.join(self.ship_dir, 'train_ship_segmentations_v2.csv')
+        image_dir = os.path.join(self.ship_dir, 'imgs/')
+        # An archive in place of a directory
+        image_names, image_masks = filter_masks(pd.read_csv(csv), True)
+        ids = list(image_names.keys())
+        datasets = [VesselDataset(image_masks, ids, image_names, valid_image_dir=valid_image_dir,
+                                  mode='valid', batch_augment=True) \
+                    for valid_image_dir in [image_dir, ZipImageSource(self.archive)]]
+        self.assertEqual(image_names[ids[0]], '0002756f7.jpg')
+        self.assertTrue(torch.equal(datasets[0][0][0], datasets[1][0][0]))
+        # An archive as the image root of an index
+        with tempfile.TemporaryDirectory() as index_dir:
+            ingest_annotations([{'csv': csv, 'image_dir': self.archive}], index_dir, True)
+            index = AnnotationIndex(index_dir)
+            dataset = VesselDataset(None, index.ids, None, mode='valid', index=index,
+                                    batch_augment=True)
+            self.assertEqual(index.name(index.ids[0]), '0002756f7.jpg')
+            self.assertTrue(torch.equal(dataset[0][0], datasets[0][0][0]))
+            self.assertTrue(torch.equal(dataset[0][1]['boxes'], datasets[0][0][1]['boxes']))
+
+
+    def test_tile_cache(self):
+        image_dir = os.path.join(self.ship_dir, 'imgs/')
+        names = sorted(os.listdir(image_dir))[:6]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # Tiles read from an archive root, in worker processes, match the directory's
+            for root, num_workers in [(image_dir, 0), (self.archive, 2)]:
+                build_tile_cache([(root, name) for name in names], cache_dir, chunksize=2,
+                                 num_workers=num_workers)
+                tiles = np.array(TileCache(cache_dir).tiles)
+                if num_workers == 0:
+                    expected = tiles
+            self.assertTrue(np.array_equal(tiles, expected))
+
+
+    def test_draft_decode(self):
+        source = ZipImageSource(self.archive)
+        for image_dir in [os.path.join(self.ship_dir, 'imgs/'), source]:
+            self.assertEqual(open_image(image_dir, '0014b1235.jpg', draft_size=(384, 384)).size,
+                             (384, 384))
+            full = resize(open_image(image_dir, '0014b1235.jpg'), size=(299, 299), interpolation=2)
+            draft = resize(open_image(image_dir, '0014b1235.jpg', draft_size=(384, 384)),
+                           size=(299, 299), interpolation=2)
+            diff = np.abs(np.asarray(full, dtype=np.float32) - np.asarray(draft, dtype=np.float32))
+            self.assertLess(diff.mean(), 2.0)
+
+class TestShards(unittest.TestCase):
+    ship_dir = '../../dev/'
+
+
+    def test_shards(self):
+        index = dev_index(no_null_samples=False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shard_dir = os.path.join(tmp_dir, 'shards/')
+            self.assertEqual(write_shards(index, index.ids, shard_dir, records_per_shard=2), 5)
+            records = [record for f in sorted(os.listdir(shard_dir)) if f.endswith('.shard') \
+                       for record in read_shard(os.path.join(shard_dir, f))]
+            self.assertEqual(sorted(record['id'] for record in records), list(index.ids))
+            for record in records:
+                self.assertEqual(record['name'], index.name(record['id']))
+                self.assertTrue(np.array_equal(record['boxes'], index.image_boxes(record['id'])))
+                self.assertEqual(record['jpeg'], read_image_bytes(index.image_dir(record['id']),
+                                                                  record['name']))
+
+            # Every record is read once per epoch across all workers of all ranks
+            for epoch in range(2):
+                ids = []
+                for rank in range(2):
+                    dataset = ShardDataset(shard_dir, buffer_size=3, rank=rank, world_size=2)
+                    dataset.set_epoch(epoch)
+                    loader = make_loader(dataset, 1, collate_fn=list, num_workers=2,
+                                         persistent_workers=False, pin_memory=False)
+                    ids += [batch[0]['id'] for batch in loader]
+                self.assertEqual(sorted(ids), list(index.ids))
+
+            # Samples match those read from the index and image directory
+            vessel_dataset = VesselDataset(None, index.ids, None, mode='valid', index=index,
+                                           batch_augment=True)
+            for img, target in ShardDataset(shard_dir, dataset=vessel_dataset, shuffle=False):
+                pass
+            idx = records[-1]['id']
+            expected_img, expected_target = vessel_dataset[list(index.ids).index(idx)]
+            self.assertTrue(torch.equal(img, expected_img))
+            self.assertTrue(torch.equal(target['boxes'], expected_target['boxes']))
+
+
+class TestFrozenDataset(unittest.TestCase):
+    ship_dir = '../../dev/'
+
+
+    def test_frozen_valid(self):
+        index = dev_index(no_null_samples=False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset = VesselDataset(None, index.ids, None, mode='valid', index=index,
+                                    batch_augment=True)
+            subset = Subset(dataset, np.arange(1, len(dataset)))
+            prepare = BatchAugment(blur_p=1.0, normalize=False)
+            cache_dir = os.path.join(tmp_dir, 'valid_cache/')
+            frozen = FrozenDataset(subset, cache_dir=cache_dir, prepare=prepare, batch_size=4)
+            self.assertEqual(len(frozen), len(subset))
+            img, target = frozen[2]
+            expected_img, expected_target = subset[2]
+            self.assertEqual(img.dtype, torch.uint8)
+            self.assertTrue(torch.equal(img, prepare(expected_img[None])[0].to(torch.uint8)))
+            self.assertTrue(torch.equal(target['boxes'], expected_target['boxes']))
+            # Normalizing the frozen images gives what `BatchAugment` would
+            self.assertTrue(torch.allclose(BatchAugment()(img[None])[0],
+                                           BatchAugment(blur_p=1.0)(expected_img[None])[0]))
+
+            # Reused while the configuration is unchanged, rebuilt when it changes
+            mtime = os.path.getmtime(os.path.join(cache_dir, 'images.npy'))
+            reused = FrozenDataset(subset, cache_dir=cache_dir, prepare=prepare)
+            self.assertIsInstance(reused.images, np.memmap)
+            self.assertEqual(os.path.getmtime(os.path.join(cache_dir, 'images.npy')), mtime)
+            rebuilt = FrozenDataset(subset, cache_dir=cache_dir,
+                                    prepare=BatchAugment(blur_p=1.0, radius=1, normalize=False))
+            self.assertNotEqual(rebuilt.key, reused.key)
+            self.assertFalse(torch.equal(rebuilt[2][0], img))
+            # Float samples are kept as float16, in RAM without `cache_dir`
+            dataset.batch_augment = False
+            frozen = FrozenDataset(dataset)
+            self.assertEqual(frozen.images.dtype, np.float16)
+            self.assertTrue(torch.allclose(frozen[0][0], dataset[0][0], atol=1e-2))
+
+
+    def test_activation_cache(self):
+        model = make_model(None, num_classes=2, anchor_sizes=((4, 8, 16, 32, 64),),
+                           box_detections_per_img=256, num_trainable_backbone_layers=3,
+                           trainable_offset=3)
+        index = dev_index()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset = VesselDataset(None, index.ids[:4], None, mode='valid', index=index,
+                                    batch_augment=True)
+            augment = BatchAugment(blur_p=1.0)
+            prefix = BackbonePrefix(model, augment=augment)
+            self.assertEqual(prefix.length, frozen_prefix_length(model.backbone))
+            self.assertFalse(any(p.requires_grad for p in model.backbone[:prefix.length].parameters()))
+            self.assertTrue(any(p.requires_grad for p in model.backbone[prefix.length].parameters()))
+            cache_dir = os.path.join(tmp_dir, 'activation_cache/')
+            # Activations of the randomly initialized backbone overflow float16
+            with self.assertRaises(ValueError):
+                FrozenDataset(dataset, cache_dir=cache_dir, prepare=prefix, batch_size=2,
+                              dtype=np.float16)
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, 'config.sha1')))
+            frozen = FrozenDataset(dataset, cache_dir=cache_dir, prepare=prefix, batch_size=2,
+                                   dtype=np.float32)
+            self.assertEqual(frozen.images.dtype, np.float32)
+            self.assertTrue(np.all(np.isfinite(frozen.images)))
+            activations, target = stack_collate([frozen[i] for i in range(2)])
+            self.assertTrue(torch.equal(target[1]['boxes'], dataset[1][1]['boxes']))
+
+            # Continuing from the cached activations gives the full model's detections
+            model.eval()
+            images = augment(torch.stack([dataset[i][0] for i in range(2)]))
+            with torch.no_grad():
+                expected = model(list(images))
+                detections = forward_from_activations(model, activations)
+            for a, b in zip(detections, expected):
+                self.assertTrue(torch.allclose(a['scores'], b['scores'], atol=1e-2))
+            # Losses are computed in training mode and reach the trainable layers only
+            model.train()
+            losses = forward_from_activations(model, activations, list(target))
+            sum(losses.values()).backward()
+            self.assertTrue(all(p.grad is not None for p in model.backbone[prefix.length].parameters()))
+
+            # Rebuilt when the frozen weights change
+            self.assertEqual(FrozenDataset(dataset, cache_dir=cache_dir, prepare=prefix,
+                                           dtype=np.float32).key, frozen.key)
+            with torch.no_grad():
+                model.backbone[0].conv.weight.add_(1)
+            self.assertNotEqual(repr(BackbonePrefix(model, augment=augment)), repr(prefix))
+
+
+class TestImageSizes(unittest.TestCase):
+    ship_dir = '../../dev/'
+    archive = '../../dev_data/raw_images.zip'
+
+
+    def test_probe_image_size(self):
+        image_dir = os.path.join(self.ship_dir, 'imgs/')
+        for name in sorted(os.listdir(image_dir)):
+            with open(os.path.join(image_dir, name), 'rb') as f:
+                self.assertEqual(jpeg_size(f), Image.open(os.path.join(image_dir, name)).size)
+        source = ZipImageSource(self.archive, prefix='content/imgs/')
+        self.assertEqual(probe_image_size(source, '001e418bc.jpg'), source.open('001e418bc.jpg').size)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            img = Image.new('RGB', (600, 400))
+            exif = Image.Exif()
+            exif[0x010e] = 'x' * 5000
+            img.save(os.path.join(tmp_dir, 'a.jpg'), exif=exif, progressive=True)
+            img.save(os.path.join(tmp_dir, 'b.png'))
+            with open(os.path.join(tmp_dir, 'b.png'), 'rb') as f:
+                self.assertIsNone(jpeg_size(f))
+            self.assertEqual(probe_image_sizes(tmp_dir, ['a.jpg', 'b.png']).tolist(),
+                             [[600, 400], [600, 400]])
+
+
+    def test_non_square_images(self):
+        mask = np.zeros((400, 600), dtype=np.uint8)
+        mask[300:310, 500:540] = 1
+        rle = rle_encode_batch(mask[None])[0]
+        square_rle = rle_encode_batch(np.ones((1, 768, 768), dtype=np.uint8))[0]
+        # Per-RLE shapes decode as each shape alone
+        boxes = rle2bbox_batch([rle, None, square_rle], np.array([[400, 600], [1, 1], [768, 768]]))
+        self.assertEqual(boxes[0].tolist(), rle2bbox_batch([rle], (400, 600))[0].tolist())
+        self.assertEqual(boxes[2].tolist(), [0, 0, 768, 768])
+        self.assertTrue(np.isnan(boxes[1]).all())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_dir = os.path.join(tmp_dir, 'imgs/')
+            os.makedirs(image_dir)
+            Image.new('RGB', (600, 400)).save(os.path.join(image_dir, 'wide.jpg'))
+            Image.new('RGB', (768, 768)).save(os.path.join(image_dir, 'square.jpg'))
+            csv = os.path.join(tmp_dir, 'masks.csv')
+            pd.DataFrame({'ImageId': ['wide.jpg', 'square.jpg'],
+                          'EncodedPixels': [rle, square_rle]}).to_csv(csv, index=False)
+            index_dir = os.path.join(tmp_dir, 'index/')
+            ingest_annotations([{'csv': csv, 'image_dir': image_dir}], index_dir, True,
+                               probe_sizes=True)
+            index = AnnotationIndex(index_dir)
+            self.assertEqual(index.sizes.tolist(), [[768, 768], [600, 400]])
+            self.assertEqual(index.image_boxes(1).tolist(), [[500, 300, 539, 310]])
+            dataset = VesselDataset(None, index.ids, None, mode='valid', index=index,
+                                    batch_augment=True)
+            img, target = dataset[1]
+            self.assertEqual(tuple(img.shape), (3, 299, 299))
+            self.assertEqual(target['boxes'].tolist(),
+                             [[round(500 * 299 / 600), round(300 * 299 / 400),
+                               round(539 * 299 / 600), round(310 * 299 / 400)]])
+            self.assertEqual(dataset.image_sizes().tolist(), index.sizes.tolist())
+
+
+    def test_grouped_batch_sampler(self):
+        sizes = np.array([[768, 768]] * 7 + [[600, 400]] * 5 + [[1200, 800]] * 3)
+        sampler = GroupedBatchSampler(sizes, 4, indices=np.arange(1, 15))
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(1, 15)))
+        for batch in batches:
+            self.assertEqual(len(set(map(tuple, sizes[batch].tolist()))), 1)
+        # 600x400 and 1200x800 share an aspect ratio bin
+        sampler = GroupedBatchSampler(sizes, 4, aspect_bins=(0.8, 1.25), drop_last=True)
+        batches = list(sampler)
+        self.assertEqual(len(batches), 3)
+        for batch in batches:
+            self.assertEqual(len(set(sizes[batch, 1] / sizes[batch, 0])), 1)
+
+
+class TestCheckpoint(unittest.TestCase):
+    arch = {
+        'num_classes': 2,
+        'anchor_sizes': ((4, 8, 16, 32, 64),),
+        'aspect_ratios': (0.25, 0.5, 1.0, 2.0, 4.0),
+        'box_detections_per_img': 256,
+        'num_trainable_backbone_layers': 3,
+    }
+
+
+    def test_match_state_dict(self):
+        model_dict = {'conv.weight': torch.zeros((4, 3)),
+                      'bn.weight': torch.zeros(4),
+                      'bn.num_batches_tracked': torch.tensor(0),
+                      'fc.weight': torch.zeros((2, 4))}
+        # Matched by name regardless of order, extra `num_batches_tracked` dropped
+        state_dict = {'fc.weight': torch.ones((2, 4)),
+                      'conv.weight': torch.full((4, 3), 2.0),
+                      'conv.num_batches_tracked': torch.tensor(5),
+                      'bn.weight': torch.full((4,), 3.0),
+                      'bn.num_batches_tracked': torch.tensor(7)}
+        matched = match_state_dict(state_dict, model_dict)
+        self.assertEqual(list(matched.keys()), list(model_dict.keys()))
+        self.assertTrue(torch.equal(matched['fc.weight'], state_dict['fc.weight']))
+        self.assertTrue(torch.equal(matched['conv.weight'], state_dict['conv.weight']))
+        self.assertEqual(int(matched['bn.num_batches_tracked']), 7)
+        # Paired by position when the names differ; missing `num_batches_tracked` zero-filled
+        renamed = {'0.weight': torch.full((4, 3), 2.0),
+                   '1.weight': torch.full((4,), 3.0),
+                   '2.weight': torch.ones((2, 4))}
+        matched = match_state_dict(renamed, model_dict)
+        self.assertTrue(torch.equal(matched['bn.weight'], renamed['1.weight']))
+        self.assertEqual(int(matched['bn.num_batches_tracked']), 0)
+        with self.assertRaises(ValueError):
+            match_state_dict(dict(renamed, **{'2.weight': torch.ones((4, 2))}), model_dict)
+        with self.assertRaises(ValueError):
+            match_state_dict({'0.weight': torch.zeros((4, 3))}, model_dict)
+
+
+    def test_load_model(self):
+        model = make_model(None, **self.arch)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'model.pth')
+            save_model(model, path, self.arch)
+            legacy_path = os.path.join(tmp_dir, 'legacy.pth')
+            torch.save(model.state_dict(), legacy_path)
+            expected = make_model_from_dict(legacy_path, None, **self.arch)
+            with self.assertRaises(ValueError):
+                load_model(legacy_path)
+            # Checkpoints rebuild the layers frozen in the saved model, plain
+            # state dicts those of `make_model_from_dict`
+            self.assertEqual(torch.load(path, weights_only=True)['arch']['trainable_offset'], 1)
+            for loaded, expected in [(load_model(path), model),
+                                     (load_model(legacy_path, arch=self.arch), expected)]:
+                self.assertEqual(loaded.backbone.num_frozen, expected.backbone.num_frozen)
+                self.assertEqual(list(loaded.state_dict().keys()), list(expected.state_dict().keys()))
+                for name, tensor in loaded.state_dict().items():
+                    self.assertTrue(torch.equal(tensor, expected.state_dict()[name]))
+                self.assertEqual([p.requires_grad for p in loaded.parameters()],
+                                 [p.requires_grad for p in expected.parameters()])
+                self.assertFalse(any(t.is_meta for t in list(loaded.parameters()) + list(loaded.buffers())))
+                loaded.eval()
+                expected.eval()
+                images = [torch.rand((3, 299, 299))]
+                with torch.no_grad():
+                    self.assertTrue(torch.equal(loaded(images)[0]['scores'],
+                                                expected(images)[0]['scores']))
+
+
+    def test_resume(self):
+        valid = np.ones(40, dtype=bool)
+        valid[::7] = False
+        sampler = ValidSampler(valid, seed=0)
+        sampler.set_epoch(1)
+        order = list(sampler)
+        self.assertEqual(sorted(order), np.flatnonzero(valid).tolist())
+        sampler.set_epoch(0)
+        self.assertNotEqual(list(sampler), order)
+        sampler.set_epoch(1, 10)
+        self.assertEqual(len(sampler), len(order) - 10)
+        self.assertEqual(list(sampler), order[10:])
+        batch_sampler = GroupedBatchSampler(np.full((40, 2), 768), 4, seed=0)
+        batches = list(batch_sampler)
+        batch_sampler.set_epoch(0, 3)
+        self.assertEqual(list(batch_sampler), batches[3:])
+
+        model = make_model(None, **self.arch)
+        optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+        for p in model.parameters():
+            if p.requires_grad:
+                p.grad = torch.rand_like(p)
+        optimizer.step()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'state.pth')
+            save_training_state(path, model, optimizer, self.arch, epoch=2, step=300)
+            rng = rng_state()
+            expected = (torch.rand(3), np.random.rand(3), random.random())
+            loaded = load_model(path)
+            loaded_optimizer = optim.SGD(loaded.parameters(), lr=0.1, momentum=0.9)
+            self.assertEqual(load_training_state(path, loaded_optimizer), (2, 300, False))
+            # Saved at the end of an epoch, before validation
+            save_training_state(path, model, optimizer, self.arch, epoch=3, step=0, validate=True)
+            self.assertEqual(load_training_state(path, optim.SGD(loaded.parameters(), lr=0.1)),
+                             (3, 0, True))
+            set_rng_state(rng)
+        self.assertTrue(torch.equal(torch.rand(3), expected[0]))
+        self.assertTrue(np.array_equal(np.random.rand(3), expected[1]))
+        self.assertEqual(random.random(), expected[2])
+        self.assertEqual(loaded_optimizer.param_groups[0]['lr'], 0.001)
+        for p, q in zip(model.parameters(), loaded.parameters()):
+            self.assertTrue(torch.equal(p, q))
+            if p.requires_grad:
+                self.assertTrue(torch.equal(optimizer.state[p]['momentum_buffer'],
+                                            loaded_optimizer.state[q]['momentum_buffer']))
+
+
+    def test_frozen_prefix(self):
+        layer = torchvision.models.inception.BasicConv2d(3, 8, kernel_size=3)
+        layer.bn.running_mean.uniform_(-1, 1)
+        layer.bn.running_var.uniform_(0.5, 2)
+        layer.eval()
+        x = torch.rand((2, 3, 16, 16))
+        expected = layer(x)
+        frozen = freeze_batch_norm(layer)
+        self.assertIsInstance(frozen.bn, FrozenBatchNorm2d)
+        frozen.train()
+        self.assertTrue(torch.allclose(frozen(x), expected, atol=1e-6))
+
+        model = make_model(None, trainable_offset=3, **self.arch)
+        backbone = model.backbone
+        self.assertEqual(backbone.num_frozen, 15)
+        self.assertFalse(any(isinstance(m, nn.BatchNorm2d) for m in backbone[:15].modules()))
+        self.assertTrue(any(isinstance(m, nn.BatchNorm2d) for m in backbone[15].modules()))
+        frozen_stats = {k: v.clone() for k, v in backbone[:15].state_dict().items()}
+        model.train()
+        targets = [{'boxes': torch.tensor([[10., 20., 50., 40.]]), 'labels': torch.tensor([1])}] * 2
+        losses = model(list(torch.rand((2, 3, 299, 299))), targets)
+        sum(losses.values()).backward()
+        # Frozen statistics do not drift and no gradient reaches the frozen layers
+        for name, tensor in backbone[:15].state_dict().items():
+            self.assertTrue(torch.equal(tensor, frozen_stats[name]))
+        self.assertTrue(all(p.grad is not None for p in backbone[15].parameters()))
+        self.assertTrue(all(p.grad is None for p in backbone[:15].parameters()))
+
+        # State dicts of models with batch norms frozen differently still load
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'model.pth')
+            torch.save(make_model(None, trainable_offset=1, **self.arch).state_dict(), path)
+            loaded = load_model(path, arch=self.arch)
+            self.assertEqual(loaded.backbone.num_frozen, 15)
+
+
+    def test_checkpoint_writer(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = CheckpointWriter(keep_last=2)
+            weights = torch.zeros(4)
+            metrics = [0.2, 0.5, 0.3, 0.1, 0.4]
+            paths = [os.path.join(tmp_dir, 'model_epoch%d.pth' % (i + 1)) for i in range(len(metrics))]
+            for i, (path, metric) in enumerate(zip(paths, metrics)):
+                writer.save({'weights': weights, 'epoch': i + 1}, path)
+                writer.retain(path, metric)
+                # The snapshot is taken when queued
+                weights += 1
+            self.assertTrue(writer.close(timeout=60))
+            self.assertEqual(sorted(os.listdir(tmp_dir)),
+                             ['model_epoch2.pth', 'model_epoch4.pth', 'model_epoch5.pth'])
+            for i in [1, 3, 4]:
+                checkpoint = torch.load(paths[i], weights_only=True)
+                self.assertEqual(checkpoint['epoch'], i + 1)
+                self.assertTrue(torch.equal(checkpoint['weights'], torch.full((4,), float(i))))
+
+            writer = CheckpointWriter()
+            writer.save({'weights': weights}, os.path.join(tmp_dir, 'missing/model.pth'))
+            with self.assertRaises(FileNotFoundError):
+                writer.flush(timeout=60)
+
+
+    def test_sigterm(self):
+        def terminated(init=None):
+            def run():
+                if init is not None:
+                    init(0)
+                os.kill(os.getpid(), signal.SIGTERM)
+            process = multiprocessing.get_context('fork').Process(target=run)
+            process.start()
+            process.join(timeout=60)
+            return process.exitcode
+
+        writer = CheckpointWriter(deadline=3600)
+        handler = signal.getsignal(signal.SIGTERM)
+        writer.handle_sigterm()
+        try:
+            # Forked workers inheriting the handler exit, DataLoader workers ignore it
+            self.assertEqual(terminated(), -signal.SIGTERM)
+            self.assertEqual(terminated(make_loader([], 1).worker_init_fn), 0)
+            self.assertFalse(writer.preempted.is_set())
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.assertTrue(writer.preempted.wait(timeout=60))
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+            writer.close()
+
+
+    def test_stopped_cache_builds(self):
+        # Builds stopped on preemption are left incomplete and never reused
+        index = dev_index()
+        stop = threading.Event()
+        stop.set()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            images = [(index.image_dir(i), index.name(i)) for i in index.ids]
+            build_tile_cache(images, os.path.join(tmp_dir, 'tiles/'), chunksize=2, stop=stop)
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'tiles/', 'names.npy')))
+            dataset = VesselDataset(None, index.ids, None, mode='valid', index=index,
+                                    batch_augment=True)
+            cache_dir = os.path.join(tmp_dir, 'frozen/')
+            stopped = FrozenDataset(dataset, cache_dir=cache_dir, batch_size=2, stop=stop)
+            self.assertEqual(len(stopped), 2)
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, 'config.sha1')))
+
+
+class TestNearDuplicates(unittest.TestCase):
+    ship_dir = '../../dev/'
+
+
+    def test_phash(self):
+        img = Image.open(os.path.join(self.ship_dir, 'imgs/0002756f7.jpg'))
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=30)
+        recompressed = Image.open(io.BytesIO(buffer.getvalue()))
+        distance = near_duplicates.hamming(np.array([near_duplicates.phash(img)]),
+                                           np.array([near_duplicates.phash(recompressed)]))
+        self.assertLessEqual(distance[0], 4)
+        self.assertEqual(near_duplicates.phash(Image.new('RGB', (768, 768))), 0)
+
+
+    def test_compute_hashes(self):
+        image_dir = os.path.join(self.ship_dir, 'imgs/')
+        index = dev_index()
+        ids = np.asarray(index.ids)
+        hashes = near_duplicates.compute_hashes(index, ids)
+        self.assertEqual(hashes[0], near_duplicates.phash(
+            Image.open(os.path.join(image_dir, index.name(ids[0])))))
+        # Without index roots images are read from `image_dir`, which is then required
+        index.roots = None
+        self.assertTrue(np.array_equal(near_duplicates.compute_hashes(index, ids, image_dir), hashes))
+        with self.assertRaises(ValueError):
+            near_duplicates.compute_hashes(index, ids)
+
+
+    def test_near_duplicate_groups(self):
+        rng = np.random.RandomState(0)
+        hashes = rng.randint(0, 2**62, size=300, dtype=np.int64).astype(np.uint64)
+        # Copies of the first 50 hashes with up to 5 flipped bits
+        copies = hashes[:50].copy()
+        for i in range(len(copies)):
+            for bit in rng.choice(64, rng.randint(0, 6), replace=False):
+                copies[i] ^= np.uint64(1) << np.uint64(bit)
+        hashes = np.concatenate([hashes, copies, np.zeros(3, dtype=np.uint64)])
+        groups = near_duplicates.near_duplicate_groups(hashes, max_distance=4)
+        for i in range(len(hashes)):
+            distances = near_duplicates.hamming(np.full(len(hashes), hashes[i]), hashes)
+            self.assertTrue(np.all(groups[distances <= 4] == groups[i]))
+        self.assertEqual(len(np.unique(groups[-3:])), 1)
+
+        ids = np.arange(len(hashes))
+        num_boxes = np.zeros(len(hashes), dtype=np.int64)
+        num_boxes[-4] = 1
+        keep_ids = near_duplicates.select_representatives(ids, groups, num_boxes)
+        self.assertEqual(len(keep_ids), len(np.unique(groups)))
+        self.assertIn(len(hashes) - 4, keep_ids)
+
+        masks = {idx: [] for idx in ids}
+        train_ids, _, valid_ids, _ = get_train_valid_dfs(masks, 0, 0.1, keep_ids=keep_ids)
+        self.assertEqual(sorted(train_ids + valid_ids), list(keep_ids))
+
+
+class RandomDataset(Dataset):
+    def __len__(self):
+        return 8
+
+
+    def __getitem__(self, idx):
+        return np.random.rand(), idx
+
+
+class TestLoader(unittest.TestCase):
+    def test_worker_seeding(self):
+        draws = []
+        for _ in range(2):
+            loader = make_loader(RandomDataset(), 1, num_workers=2, seed=0,
+                                 persistent_workers=False, pin_memory=False)
+            draws.append([float(values[0]) for values, _ in loader])
+        # Workers no longer repeat the parent's NumPy state, and runs are reproducible
+        self.assertEqual(len(set(draws[0])), 8)
+        self.assertEqual(draws[0], draws[1])
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,17 @@
+import io
 import os
 import sys
 import time
+import hashlib
+import struct
+import zipfile
+import itertools
 import torch
 import math
 import random
+import signal
+import threading
+import multiprocessing
 import numpy as np
 import pandas as pd
 import torch.nn as nn
@@ -14,19 +22,30 @@ from torch import tensor
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
+from torch.utils.data import Sampler
+from torch.utils.data import Subset
 from torchvision import transforms
 from torchvision.models.detection.rpn import AnchorGenerator
 from torchvision.models.detection.faster_rcnn import FasterRCNN, FastRCNNPredictor
+from torchvision.models.detection.image_list import ImageList
 from torchvision.ops.boxes import box_iou
+from torchvision.ops.misc import FrozenBatchNorm2d
 from torchvision.transforms import ToTensor, Compose, RandomHorizontalFlip,\
     RandomVerticalFlip,  Normalize
 from sklearn.model_selection import train_test_split
 from PIL import Image, ImageFile, ImageFilter
 
 import pathlib
+from collections import OrderedDict
 from typing import Callable, Iterator, Union, Optional, List, Tuple, Dict
 from torchvision.transforms.functional import resize
 
+# Data loading and checkpointing code shared with `vessel_classifier.py`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import BatchAugment, REPLAY_VARIANTS, ZipImageSource, open_image, build_tile_cache, \
+    TileCache, VariantSampler, SHARD_RECORD_HEADER, read_shard, ShardDataset, make_loader, \
+    FrozenDataset, atomic_save, CheckpointWriter, rng_state, set_rng_state
+
 
 def rle2bbox(rle, shape):
     '''
@@ -71,20 +90,224 @@ def rle2bbox(rle, shape):
     return x0, y0, x1, y1
 
 
+def rle_pairs(rles) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    rles: iterable of run-length encoded masks; null entries are allowed
+    Returns (is_str, n_pairs, starts, lengths): which entries are RLE strings,
+    the number of runs in each of those strings, and the 0-indexed start and
+    length of every run, all parsed in a single pass over the joined strings.
+    '''
+    rles = pd.Series(rles, dtype=object).reset_index(drop=True)
+    is_str = rles.notna().to_numpy(dtype=bool)
+    if not is_str.any():
+        empty = np.zeros(0, dtype=np.int64)
+        return is_str, empty, empty, empty
+    # Parse every (start, length) pair in the column at once; RLEs are
+    # separated by newlines, which also split tokens
+    joined = '\n'.join(rles[is_str]) + '\n'
+    a = np.fromstring(joined, dtype=np.int64, sep=' ')
+    # Tokens per RLE, from the first digit of every token and the newlines before it
+    text = np.frombuffer(joined.encode(), dtype=np.uint8)
+    digit = (text >= ord('0')) & (text <= ord('9'))
+    first_digit = digit & ~np.concatenate(([False], digit[:-1]))
+    rle_of_token = np.cumsum(text == ord('\n'))[first_digit]
+    n_pairs = np.bincount(rle_of_token, minlength=int(is_str.sum())) // 2
+    a = a.reshape((-1, 2))
+    starts = a[:,0] - 1  # `start` is 1-indexed
+    lengths = a[:,1]
+    return is_str, n_pairs, starts, lengths
+
+
+def rle_shapes(shape, is_str: np.ndarray) -> Tuple[Union[int, np.ndarray], Union[int, np.ndarray]]:
+    '''
+    (height, width) for the non-null RLEs of `rle_pairs`: the two ints of a
+    single `shape`, or arrays of those RLEs' rows of an (N, 2) `shape`.
+    '''
+    shape = np.asarray(shape)
+    if shape.ndim == 2:
+        return shape[is_str, 0], shape[is_str, 1]
+    return int(shape[0]), int(shape[1])
+
+
+def rle2bbox_batch(rles, shape) -> np.ndarray:
+    '''
+    rles: iterable of run-length encoded masks (e.g. the full `EncodedPixels`
+        column returned by `get_masks`); null entries are allowed
+    shape: (height, width) of images on which RLEs were produced, or an
+        (N, 2) array of the (height, width) of each RLE's image
+    Returns (N, 4) float32 array of (x0, y0, x1, y1) boxes, one row per RLE.
+    Rows for null RLEs are NaN.
+
+    Same column-major and `y` overrun semantics as `rle2bbox`, but every RLE is
+    parsed in a single pass over the joined column instead of once per string.
+    '''
+    is_str, n_pairs, starts, lengths = rle_pairs(rles)
+    boxes = np.full((len(is_str), 4), np.nan, dtype=np.float32)
+    if not is_str.any():
+        return boxes
+    offsets = np.concatenate(([0], np.cumsum(n_pairs)[:-1]))
+    height, width = rle_shapes(shape, is_str)
+    # Height of the image of every run
+    run_height = np.repeat(height, n_pairs) if np.ndim(height) else height
+
+    y0 = starts % run_height
+    y1 = y0 + lengths
+    overrun = np.maximum.reduceat(y1 > run_height, offsets)
+    y0 = np.where(overrun, 0, np.minimum.reduceat(y0, offsets))
+    y1 = np.where(overrun, height, np.maximum.reduceat(y1, offsets))
+
+    x0 = np.minimum.reduceat(starts // run_height, offsets)
+    x1 = np.maximum.reduceat((starts + lengths) // run_height, offsets)
+
+    if np.any(x1 > width):
+        # just went out of the image dimensions
+        i = int(np.argmax(x1 > width))
+        raise ValueError("invalid RLE or image dimensions: x1=%d > shape[1]=%d" % (
+            x1[i], np.broadcast_to(width, x1.shape)[i]
+        ))
+
+    boxes[is_str] = np.stack([x0, y0, x1, y1], axis=1)
+    return boxes
+
+
+def rle2crop_batch(rles, shape) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Decodes every RLE in `rles` to its mask cropped to the `rle2bbox` box,
+    i.e. rows y0:y1 and columns x0:x1 + 1 (runs may end in column x1).
+    `shape` is as for `rle2bbox_batch`.
+
+    Returns (boxes, bits, nbytes): the `rle2bbox_batch` boxes, the bit-packed
+    crops of all non-null RLEs back to back (row-major, each padded to whole
+    bytes) and the number of bytes taken by each RLE (0 for null RLEs).
+    '''
+    boxes = rle2bbox_batch(rles, shape)
+    is_str, n_pairs, starts, lengths = rle_pairs(rles)
+    nbytes = np.zeros(len(is_str), dtype=np.int64)
+    if not is_str.any():
+        return boxes, np.zeros(0, dtype=np.uint8), nbytes
+    x0, y0, x1, y1 = boxes[is_str].astype(np.int64).T
+    h, w = y1 - y0, x1 - x0 + 1
+    nbytes[is_str] = (h * w + 7) // 8
+    base = 8 * np.concatenate(([0], np.cumsum(nbytes[is_str])[:-1]))
+
+    # Expand every run into its pixel indices, keeping track of its RLE
+    run_rle = np.repeat(np.arange(len(n_pairs)), n_pairs)
+    pixel_run = np.repeat(np.arange(len(starts)), lengths)
+    run_first = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    pixels = starts[pixel_run] + np.arange(len(pixel_run)) - run_first[pixel_run]
+    r = run_rle[pixel_run]
+    height, _ = rle_shapes(shape, is_str)
+    pixel_height = height[r] if np.ndim(height) else height
+    x = pixels // pixel_height
+    y = pixels % pixel_height
+
+    flat = np.zeros(8 * nbytes.sum(), dtype=bool)
+    flat[base[r] + (y - y0[r]) * w[r] + (x - x0[r])] = True
+    return boxes, np.packbits(flat), nbytes
+
+
+def unpack_crop(bits: np.ndarray, box) -> np.ndarray:
+    '''Inverse of `rle2crop_batch` for one RLE: (y1 - y0, x1 - x0 + 1) uint8 mask.'''
+    x0, y0, x1, y1 = [int(v) for v in box]
+    h, w = y1 - y0, x1 - x0 + 1
+    return np.unpackbits(bits, count=h * w).reshape((h, w))
+
+
+def paste_masks(crops: List[np.ndarray],
+                boxes: np.ndarray,
+                shape=(768, 768),
+                out_shape=(299, 299)) -> np.ndarray:
+    '''
+    Pastes the `unpack_crop` crops of one image into an (N, out_h, out_w) uint8
+    array, nearest-neighbour resampling each crop from `shape` to `out_shape`.
+    '''
+    masks = np.zeros((len(crops), out_shape[0], out_shape[1]), dtype=np.uint8)
+    y_scale = shape[0] / out_shape[0]
+    x_scale = shape[1] / out_shape[1]
+    # Source pixel of the center of every output row and column
+    src_y = np.floor((np.arange(out_shape[0]) + 0.5) * y_scale).astype(np.int64)
+    src_x = np.floor((np.arange(out_shape[1]) + 0.5) * x_scale).astype(np.int64)
+    for i, (crop, box) in enumerate(zip(crops, boxes)):
+        x0, y0 = int(box[0]), int(box[1])
+        rows = np.flatnonzero((src_y >= y0) & (src_y < y0 + crop.shape[0]))
+        cols = np.flatnonzero((src_x >= x0) & (src_x < x0 + crop.shape[1]))
+        masks[i][np.ix_(rows, cols)] = crop[np.ix_(src_y[rows] - y0, src_x[cols] - x0)]
+    return masks
+
+
+def format_rle(starts: np.ndarray,
+               lengths: np.ndarray,
+               counts: np.ndarray) -> List[Optional[str]]:
+    '''
+    Formats 1-indexed run `starts` and `lengths`, grouped `counts` runs per mask,
+    as RLE strings. Masks without runs get None (an empty `EncodedPixels`).
+    '''
+    pairs = np.stack([starts, lengths], axis=1).ravel().astype(str)
+    splits = np.cumsum(2 * counts)[:-1]
+    return [' '.join(p) if len(p) else None for p in np.split(pairs, splits)]
+
+
+def rle_encode_batch(masks: np.ndarray) -> List[Optional[str]]:
+    '''
+    masks: (N, height, width) binary masks
+    Returns N RLE strings in the same column-major format read by `rle2bbox`.
+
+    Runs are found for the whole batch at once by differencing the transposed,
+    flattened masks, so there is no Python loop over pixels or runs.
+    '''
+    masks = np.asarray(masks, dtype=bool)
+    N = masks.shape[0]
+    flat = masks.transpose(0, 2, 1).reshape((N, -1)) # Column-major pixel order
+    padded = np.zeros((N, flat.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = flat
+    changes = np.diff(padded, axis=1) # 1 where a run starts, -1 just after it ends
+    rows, starts = np.nonzero(changes == 1)
+    _, ends = np.nonzero(changes == -1)
+    counts = np.bincount(rows, minlength=N)
+    return format_rle(starts + 1, ends - starts, counts)
+
+
+def boxes2rle_batch(boxes: np.ndarray, shape=(768, 768)) -> List[Optional[str]]:
+    '''
+    boxes: (N, 4) (x0, y0, x1, y1) boxes with exclusive x1, y1, at `shape`
+        resolution (scale predictions made at 299x299 with `Resize.resize_boxes`)
+    shape: (height, width) of the image the RLEs refer to
+    Returns N RLE strings of the filled boxes, one run per box column.
+    '''
+    boxes = np.round(np.asarray(boxes, dtype=np.float64)).astype(np.int64).reshape((-1, 4))
+    x0 = np.clip(boxes[:,0], 0, shape[1])
+    x1 = np.clip(boxes[:,2], 0, shape[1])
+    y0 = np.clip(boxes[:,1], 0, shape[0])
+    y1 = np.clip(boxes[:,3], 0, shape[0])
+    counts = np.where(y1 > y0, np.maximum(x1 - x0, 0), 0)
+    run_box = np.repeat(np.arange(len(boxes)), counts)
+    first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    cols = x0[run_box] + np.arange(len(run_box)) - first[run_box]
+    starts = cols * shape[0] + y0[run_box] + 1
+    return format_rle(starts, (y1 - y0)[run_box], counts)
+
+
+def write_rle_csv(path: Union[str, pathlib.Path],
+                  image_names: List[str],
+                  rles: List[Optional[str]],
+                  append: bool = False) -> None:
+    '''
+    Writes (ImageId, EncodedPixels) rows in the format of
+    `train_ship_segmentations_v2.csv`. Use `append` to export in batches.
+    '''
+    df = pd.DataFrame({'ImageId': image_names, 'EncodedPixels': rles})
+    df.to_csv(path, index=False, mode='a' if append else 'w', header=not append)
+
+
 def make_target(in_mask_list, N, shape=(768, 768)):
     if N == 0:
         target = {}
         target["boxes"] = torch.zeros((0, 4), dtype=torch.float32)
         target["labels"] = torch.zeros((0), dtype=torch.int64)
         return target
-    bbox_array = np.zeros((N, 4), dtype=np.float32)
     labels = torch.ones((N,), dtype=torch.int64)
-    i = 0
-    for rle in in_mask_list:
-        if isinstance(rle, str):
-            bbox = rle2bbox(rle, shape)
-            bbox_array[i,:] = bbox
-            i += 1
+    bbox_array = rle2bbox_batch(in_mask_list, shape)
+    bbox_array = bbox_array[~np.isnan(bbox_array).any(axis=1)]
     target = {
         'boxes': torch.from_numpy(bbox_array),
         'labels': labels,
@@ -94,6 +317,16 @@ def make_target(in_mask_list, N, shape=(768, 768)):
     return target
 
 
+def make_target_from_boxes(boxes: np.ndarray) -> dict:
+    '''Builds the same target as `make_target` from pre-decoded (N, 4) boxes.'''
+    N = boxes.shape[0]
+    target = {
+        'boxes': torch.from_numpy(boxes.astype(np.float32)).reshape((N, 4)),
+        'labels': torch.ones((N,), dtype=torch.int64),
+    }
+    return target
+
+
 def get_masks(ship_dir: str, 
                 train_image_dir: Union[str, pathlib.Path], 
                 valid_image_dir: Union[str, pathlib.Path]
@@ -123,23 +356,59 @@ def is_valid_box(bbox, shape=(299,299)) -> bool:
     return False
 
 
+def is_valid_batch(boxes: np.ndarray, shape=(768,768)) -> np.ndarray:
+    '''
+    Vectorized `is_valid_box` over an (N, 4) array of (x0, y0, x1, y1) boxes.
+    `shape` may also be an (N, 2) array of per-box (width, height).
+    NaN rows (null RLEs) are reported as valid.
+    '''
+    width, height = np.asarray(shape).T
+    xmin, ymin, xmax, ymax = boxes.T
+    valid = (xmin >= 0) & (xmax <= width) & (xmin < xmax) & \
+        (ymin >= 0) & (ymax <= height) & (ymin < ymax)
+    return valid | np.isnan(boxes).any(axis=1)
+
+
+def resized_validity(boxes: np.ndarray,
+                     offsets: np.ndarray,
+                     input_shape=(768, 768),
+                     output_shape=(299, 299),
+                     chunksize: int = 1 << 20) -> np.ndarray:
+    '''
+    (M,) bool, True for images whose boxes (`boxes[offsets[i]:offsets[i+1]]`)
+    all stay valid after the `Resize` applied by `VesselDataset`. Images
+    without boxes are valid. `input_shape` may also be an (M, 2) array of
+    per-image (width, height), e.g. `AnnotationIndex.sizes`. Boxes, offsets
+    and sizes may be memory-mapped; boxes are resized `chunksize` at a time.
+    '''
+    boxes = np.asarray(boxes).reshape((-1, 4))
+    offsets = np.asarray(offsets)
+    valid = np.ones(len(offsets) - 1, dtype=bool)
+    for first in range(0, len(boxes), chunksize):
+        chunk = torch.from_numpy(np.asarray(boxes[first:first + chunksize], dtype=np.float32))
+        images = np.searchsorted(offsets, np.arange(first, first + len(chunk)), side='right') - 1
+        shape = input_shape
+        if np.ndim(input_shape) == 2:
+            shape = np.asarray(input_shape)[images]
+        resized = Resize(input_shape=shape, output_shape=output_shape).resize_boxes(chunk)
+        valid[images[~is_valid_batch(resized.numpy(), output_shape)]] = False
+    return valid
+
+
 def filter_masks(masks: pd.DataFrame, no_null_samples: bool) -> Tuple[dict, dict]:
     if no_null_samples:
         masks_not_null = masks.drop(
             masks[masks.EncodedPixels.isnull()].index
         )
         masks = masks_not_null
+    # Decode and validate every RLE in one pass before grouping
+    valid = is_valid_batch(rle2bbox_batch(masks['EncodedPixels'], (768, 768)))
+    invalid_names = set(masks['ImageId'].values[~valid])
     grp = list(masks.groupby('ImageId'))
-    image_names =  {idx: filename for idx, (filename, _) in enumerate(grp)} 
+    image_names =  {idx: filename for idx, (filename, _) in enumerate(grp)}
     image_masks = {idx: m['EncodedPixels'].values for idx, (_, m) in enumerate(grp)}
-    to_remove = []
-    for idx, in_mask_list in image_masks.items():
-        N = sum([1 for i in in_mask_list if isinstance(i, str)])
-        if N > 0:
-            for i, rle in enumerate(in_mask_list):
-                if not is_valid(rle):
-                    to_remove.append(idx)
-                    
+    to_remove = [idx for idx, filename in image_names.items() if filename in invalid_names]
+
     for idx in to_remove:
         del image_names[idx]
         del image_masks[idx]
@@ -148,9 +417,15 @@ def filter_masks(masks: pd.DataFrame, no_null_samples: bool) -> Tuple[dict, dict
 
 def get_train_valid_dfs(masks: dict,
                            seed: int,
-                           test_size: Union[float, int]
+                           test_size: Union[float, int],
+                           keep_ids: Optional[np.ndarray] = None
                           ) -> Tuple[list, dict, list, dict]:
-    ids = np.array(list(masks.keys())).reshape((len(masks),1))
+    # `keep_ids`, e.g. the `dedup_ids.npy` of `near_duplicates.py`, restricts
+    # the split to those image IDs
+    ids = np.array(list(masks.keys()))
+    if keep_ids is not None:
+        ids = ids[np.isin(ids, keep_ids)]
+    ids = ids.reshape((len(ids),1))
     train_ids, valid_ids = train_test_split(
          ids, 
          test_size = test_size, 
@@ -162,6 +437,825 @@ def get_train_valid_dfs(masks: dict,
     return train_ids, train_masks, valid_ids, valid_masks
 
 
+def reduce_annotation_groups(starts: np.ndarray,
+                             is_str: np.ndarray,
+                             valid: np.ndarray,
+                             no_null_samples: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, dict]:
+    '''
+    Per-image filtering of rows already sorted by image, given the first row of
+    each image (`starts`) and per-row null (`is_str`) and box validity flags.
+
+    Returns (ids, keep, keep_rows, offsets, report): ID numbers of all images
+    (as `filter_masks` would assign them), the images and non-null rows that
+    survive, box offsets of the kept images and rejected counts per reason.
+    '''
+    counts = np.add.reduceat(is_str.astype(np.int64), starts)
+    invalid = np.logical_or.reduceat(~valid, starts)
+
+    no_masks = counts == 0
+    if no_null_samples:
+        # Dropped before grouping in `filter_masks`, so they take no ID number
+        keep_group = ~no_masks
+    else:
+        keep_group = np.ones(len(starts), dtype=bool)
+    ids = np.cumsum(keep_group) - 1
+    keep = keep_group & ~invalid
+    report = {
+        'no_masks': int(no_masks.sum()) if no_null_samples else 0,
+        'invalid_box': int((keep_group & invalid).sum()),
+        'kept': int(keep.sum()),
+    }
+
+    keep_rows = np.repeat(keep, np.diff(np.append(starts, len(is_str)))) & is_str
+    offsets = np.zeros(keep.sum() + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts[keep])
+    return ids, keep, keep_rows, offsets, report
+
+
+def filter_annotations(masks: pd.DataFrame,
+                       no_null_samples: bool,
+                       shape=(768, 768)) -> Tuple[dict, dict]:
+    '''
+    Columnar equivalent of `filter_masks`. Works on group offsets of the table
+    sorted by `ImageId` instead of per-image Python objects.
+
+    Returns (annotations, report):
+        annotations: dict of flat arrays in the `write_annotation_index` layout
+            ('ids', 'names', 'offsets', 'boxes'); image ID numbers match the
+            keys `filter_masks` would assign
+        report: number of images rejected per reason, plus images kept
+    '''
+    masks = masks.sort_values('ImageId', kind='stable')
+    image_ids = masks['ImageId'].to_numpy()
+    names, starts = np.unique(image_ids, return_index=True)
+    is_str = masks['EncodedPixels'].notna().to_numpy()
+    boxes = rle2bbox_batch(masks['EncodedPixels'], shape)
+    valid = is_valid_batch(boxes, shape)
+
+    ids, keep, keep_rows, offsets, report = reduce_annotation_groups(
+        starts, is_str, valid, no_null_samples
+    )
+    annotations = {
+        'ids': ids[keep].astype(np.int64),
+        'names': names[keep].astype(np.bytes_),
+        'offsets': offsets,
+        'boxes': boxes[keep_rows].astype(np.int32).reshape((-1, 4)),
+    }
+    return annotations, report
+
+
+def merge_sorted_runs(run_paths: List[str],
+                      keys: Tuple[str, ...],
+                      dtype: np.dtype,
+                      block_size: int) -> Iterator[np.ndarray]:
+    '''
+    K-way merge of the structured arrays saved in `run_paths`, each sorted
+    by the fields `keys` (most significant first) with no two rows equal on
+    all of them. Yields the merged rows, cast to `dtype`, in sorted batches
+    while reading at most `block_size` rows of each run at a time.
+    '''
+    runs = [np.load(path, mmap_mode='r') for path in run_paths]
+    lengths = np.array([len(run) for run in runs], dtype=np.int64)
+    read = np.zeros(len(runs), dtype=np.int64)
+    pending = np.zeros(len(runs), dtype=np.int64)
+    pool, pool_runs = np.zeros(0, dtype=dtype), np.zeros(0, dtype=np.int64)
+    while True:
+        refill = np.flatnonzero((pending == 0) & (read < lengths))
+        blocks = [np.asarray(runs[k][read[k]:read[k] + block_size]).astype(dtype) for k in refill]
+        pool = np.concatenate([pool] + blocks)
+        pool_runs = np.concatenate([pool_runs] + [np.full(len(block), k, dtype=np.int64) \
+                                                  for k, block in zip(refill, blocks)])
+        counts = np.array([len(block) for block in blocks], dtype=np.int64)
+        read[refill] += counts
+        pending[refill] += counts
+        if len(pool) == 0:
+            return
+        order = np.lexsort([pool[key] for key in reversed(keys)])
+        pool, pool_runs = pool[order], pool_runs[order]
+        # Rows up to the last one read from a run with unread rows are final
+        cut = len(pool)
+        open_runs = read < lengths
+        if open_runs.any():
+            runs_reversed, last = np.unique(pool_runs[::-1], return_index=True)
+            cut = len(pool) - int(last[open_runs[runs_reversed]].max())
+        yield pool[:cut]
+        pending -= np.bincount(pool_runs[:cut], minlength=len(runs))
+        pool, pool_runs = pool[cut:], pool_runs[cut:]
+
+
+def spill_to_npy(spill_path: Union[str, pathlib.Path],
+                 npy_path: Union[str, pathlib.Path],
+                 dtype: np.dtype,
+                 shape=(),
+                 chunksize: int = 50000) -> None:
+    '''
+    Copies the raw rows of `shape` and `dtype` appended to `spill_path` into
+    the .npy file `npy_path`, `chunksize` rows at a time, and removes the
+    spill file.
+    '''
+    row_nbytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+    count = os.path.getsize(spill_path) // row_nbytes if row_nbytes else 0
+    out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=(count,) + tuple(shape))
+    if count:
+        spilled = np.memmap(spill_path, dtype=dtype, mode='r', shape=(count,) + tuple(shape))
+        for first in range(0, count, chunksize):
+            out[first:first + chunksize] = spilled[first:first + chunksize]
+        del spilled
+    out.flush()
+    del out
+    os.remove(spill_path)
+
+
+def ingest_annotations(sources: List[dict],
+                       index_dir: Union[str, pathlib.Path],
+                       no_null_samples: bool,
+                       chunksize: int = 50000,
+                       shape=(768, 768),
+                       with_masks: bool = False,
+                       probe_sizes: bool = False,
+                       num_workers: int = 0) -> dict:
+    '''
+    Streams several segmentation CSVs into a single annotation index.
+
+    sources: list of {'csv': path to CSV with `ImageId` and `EncodedPixels`
+        columns, 'image_dir': directory holding that source's images}
+    Each CSV is read `chunksize` rows at a time. The decoded boxes (and mask
+    crops) of a chunk are appended to spill files in `index_dir`, and its
+    rows are sorted by image into a run file. The runs are then merged (see
+    `merge_sorted_runs`) and the index arrays are written batch by batch, so
+    memory holds about `chunksize` rows (or 1024 per run, if more) plus one
+    byte per image for `resized_valid.npy`, whatever the size of the input.
+
+    Images are keyed by (image_dir, ImageId): the same ImageId under different
+    image roots is kept as two images, while an image listed by more than one
+    source with the same root keeps only the first source's masks (counted as
+    'duplicate' in the returned report). Besides the `write_annotation_index`
+    arrays the index stores the sources' `roots.npy` and per-image `root_ids.npy`
+    into it.
+
+    With `with_masks`, every RLE is also decoded once to its bit-packed crop
+    (see `rle2crop_batch`), stored as `mask_bits.npy` with per-box byte
+    offsets `mask_offsets.npy` in the same order as `boxes.npy`.
+
+    With `probe_sizes`, the size of every image is read from its header
+    (`probe_image_sizes`, with `num_workers` processes) before its RLEs are
+    decoded, instead of assuming `shape`, and stored as `sizes.npy`.
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+    spill_path = os.path.join(index_dir, 'boxes.tmp')
+    mask_spill_path = os.path.join(index_dir, 'mask_bits.tmp')
+    root_keys = [os.path.normpath(os.path.abspath(source['image_dir'])) for source in sources]
+    # Sources sharing an image root share a root ID
+    source_roots = np.array([root_keys.index(key) for key in root_keys], dtype=np.int32)
+
+    # Per-row records, sorted by (root, name, source) and file order in each run
+    row_fields = [('root', np.int32), ('source', np.int32), ('row', np.int64),
+                  ('is_str', bool), ('valid', bool), ('size', np.int32, (2,)),
+                  ('mask_offset', np.int64), ('mask_nbytes', np.int64)]
+    sort_keys = ('root', 'name', 'source', 'row')
+    run_paths, name_width = [], 1
+    num_rows, num_mask_bytes = 0, 0
+    with open(spill_path, 'wb') as spill, \
+         open(mask_spill_path if with_masks else os.devnull, 'wb') as mask_spill:
+        for source_id, source in enumerate(sources):
+            image_dir = source['image_dir']
+            if probe_sizes and zipfile.is_zipfile(image_dir):
+                image_dir = ZipImageSource(image_dir)
+            # Sizes of the previous chunk's images, whose rows may continue
+            known_sizes = {}
+            for chunk in pd.read_csv(source['csv'],
+                                     usecols=['ImageId', 'EncodedPixels'],
+                                     chunksize=chunksize):
+                names = chunk['ImageId'].to_numpy().astype(np.bytes_)
+                run = np.zeros(len(chunk), dtype=row_fields + [('name', names.dtype)])
+                # (height, width) for RLE decoding, (width, height) for box checks
+                rle_shape, box_shape = shape, shape
+                if probe_sizes:
+                    chunk_names = chunk['ImageId'].to_numpy()
+                    unique_names = pd.unique(chunk_names)
+                    new_names = [name for name in unique_names if name not in known_sizes]
+                    known_sizes.update(zip(new_names, probe_image_sizes(image_dir, new_names,
+                                                                        num_workers=num_workers)))
+                    known_sizes = {name: known_sizes[name] for name in unique_names}
+                    box_shape = np.array([known_sizes[name] for name in chunk_names],
+                                         dtype=np.int32).reshape((-1, 2))
+                    rle_shape = box_shape[:, ::-1]
+                if with_masks:
+                    boxes, bits, nbytes = rle2crop_batch(chunk['EncodedPixels'], rle_shape)
+                    bits.tofile(mask_spill)
+                    run['mask_offset'] = num_mask_bytes + np.cumsum(nbytes) - nbytes
+                    run['mask_nbytes'] = nbytes
+                    num_mask_bytes += int(nbytes.sum())
+                else:
+                    boxes = rle2bbox_batch(chunk['EncodedPixels'], rle_shape)
+                run['root'] = source_roots[source_id]
+                run['name'] = names
+                run['source'] = source_id
+                run['row'] = np.arange(num_rows, num_rows + len(chunk))
+                run['is_str'] = chunk['EncodedPixels'].notna().to_numpy()
+                run['valid'] = is_valid_batch(boxes, box_shape)
+                run['size'] = box_shape
+                np.nan_to_num(boxes).astype(np.int32).tofile(spill)
+                run_paths.append(os.path.join(index_dir, 'run_%05d.tmp.npy' % len(run_paths)))
+                np.save(run_paths[-1], np.sort(run, order=list(sort_keys)))
+                name_width = max(name_width, names.dtype.itemsize)
+                num_rows += len(chunk)
+
+    spilled = np.memmap(spill_path, dtype=np.int32, mode='r', shape=(num_rows, 4)) \
+        if num_rows else np.zeros((0, 4), dtype=np.int32)
+    spilled_bits = np.memmap(mask_spill_path, dtype=np.uint8, mode='r') if num_mask_bytes \
+        else np.zeros(0, dtype=np.uint8)
+    name_dtype = np.dtype('S%d' % name_width)
+    outputs = ['boxes', 'names', 'ids', 'offsets', 'root_ids']
+    outputs += ['sizes'] if probe_sizes else []
+    outputs += ['mask_bits', 'mask_offsets'] if with_masks else []
+    out = {key: open(os.path.join(index_dir, key + '.part'), 'wb') for key in outputs}
+    np.zeros(1, dtype=np.int64).tofile(out['offsets'])
+    if with_masks:
+        np.zeros(1, dtype=np.int64).tofile(out['mask_offsets'])
+    report = {'no_masks': 0, 'invalid_box': 0, 'kept': 0, 'duplicate': 0}
+    num_ids, num_boxes, num_kept_bytes = 0, 0, 0
+    merged = merge_sorted_runs(run_paths, sort_keys, row_fields + [('name', name_dtype)],
+                               block_size=max(chunksize // max(len(run_paths), 1), 1024))
+    carry = None
+    for batch in itertools.chain(merged, [None]):
+        rows = batch if carry is None else \
+            (carry if batch is None else np.concatenate([carry, batch]))
+        if batch is not None:
+            # Hold back the last image, whose rows may continue in the next batch
+            last = rows[-1]
+            other = np.flatnonzero((rows['name'] != last['name']) | (rows['root'] != last['root']))
+            cut = other[-1] + 1 if len(other) else 0
+            rows, carry = rows[:cut], rows[cut:]
+        if rows is None or len(rows) == 0:
+            continue
+        new_image = np.ones(len(rows), dtype=bool)
+        new_image[1:] = (rows['name'][1:] != rows['name'][:-1]) | \
+            (rows['root'][1:] != rows['root'][:-1])
+        starts = np.flatnonzero(new_image)
+        # Drop rows from any source after the first one that lists the image
+        first_source = np.repeat(rows['source'][starts], np.diff(np.append(starts, len(rows))))
+        duplicate = rows['source'] != first_source
+        report['duplicate'] += int(np.logical_or.reduceat(duplicate, starts).sum())
+        ids, keep, keep_rows, offsets, batch_report = reduce_annotation_groups(
+            starts, rows['is_str'] & ~duplicate, rows['valid'] | duplicate, no_null_samples
+        )
+        for reason, count in batch_report.items():
+            report[reason] += count
+        images = starts[keep]
+        kept = rows[keep_rows]
+        (ids[keep] + num_ids).astype(np.int64).tofile(out['ids'])
+        (offsets[1:] + num_boxes).astype(np.int64).tofile(out['offsets'])
+        np.ascontiguousarray(spilled[kept['row']]).tofile(out['boxes'])
+        rows['name'][images].tofile(out['names'])
+        rows['root'][images].tofile(out['root_ids'])
+        if probe_sizes:
+            rows['size'][images].tofile(out['sizes'])
+        if with_masks:
+            # Copy the byte ranges of the kept rows in index order, one slice
+            # per run of rows which are also consecutive in the spill file
+            src, lengths = kept['mask_offset'], kept['mask_nbytes']
+            run_starts = np.flatnonzero(np.concatenate(([True], src[1:] != src[:-1] + lengths[:-1])))
+            run_ends = np.append(run_starts[1:], len(kept))
+            ends = np.cumsum(lengths)
+            for first, last in zip(run_starts, run_ends):
+                spilled_bits[src[first]:src[first] + ends[last - 1] - ends[first] + lengths[first]] \
+                    .tofile(out['mask_bits'])
+            (num_kept_bytes + ends).astype(np.int64).tofile(out['mask_offsets'])
+            num_kept_bytes += int(ends[-1]) if len(ends) else 0
+        num_ids += int(ids[-1]) + 1
+        num_boxes += int(offsets[-1])
+    del spilled, spilled_bits
+    for path in run_paths + [spill_path] + ([mask_spill_path] if with_masks else []):
+        os.remove(path)
+
+    dtypes = {'boxes': (np.int32, (4,)), 'names': (name_dtype, ()), 'ids': (np.int64, ()),
+              'offsets': (np.int64, ()), 'root_ids': (np.int32, ()), 'sizes': (np.int32, (2,)),
+              'mask_bits': (np.uint8, ()), 'mask_offsets': (np.int64, ())}
+    for key in outputs:
+        out[key].close()
+        dtype, row_shape = dtypes[key]
+        spill_to_npy(os.path.join(index_dir, key + '.part'), os.path.join(index_dir, key + '.npy'),
+                     dtype, row_shape, chunksize=chunksize)
+    # Every array is already in `index_dir`
+    write_annotation_index({}, index_dir)
+    roots = [source['image_dir'] for source in sources]
+    np.save(os.path.join(index_dir, 'roots.npy'), np.array(roots, dtype=np.bytes_))
+    return report
+
+
+def split_image_ids(ids: np.ndarray,
+                    seed: int,
+                    test_size: Union[float, int],
+                    offsets: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Seeded train/valid split of image ID numbers. Without `offsets` the split
+    matches `get_train_valid_dfs` for the same IDs; with the index `offsets`
+    the split is stratified on the number of boxes per image (see
+    `pooled_strata`).
+    '''
+    train_ids, valid_ids = train_test_split(
+         np.asarray(ids),
+         test_size = test_size,
+         stratify = pooled_strata(np.diff(offsets)) if offsets is not None else None,
+         random_state=seed
+        )
+    return train_ids, valid_ids
+
+
+def pooled_strata(counts: np.ndarray, min_size: int = 2) -> np.ndarray:
+    '''
+    Stratum of every image for a split on `counts` (e.g. boxes per image):
+    counts shared by fewer than `min_size` images (which `train_test_split`
+    rejects) are pooled with the next smaller counts until the pool is large
+    enough; a remainder at the smallest counts joins the pool above it.
+    '''
+    values, inverse, sizes = np.unique(counts, return_inverse=True, return_counts=True)
+    labels = np.zeros(len(values), dtype=np.int64)
+    label, pooled = 0, 0
+    for i in range(len(values) - 1, -1, -1):
+        labels[i] = label
+        pooled += sizes[i]
+        if pooled >= min_size:
+            label += 1
+            pooled = 0
+    if pooled > 0 and label > 0:
+        labels[labels == label] = label - 1
+    return labels[inverse]
+
+
+def print_validity_report(report: dict) -> None:
+    print('Annotation filtering results:')
+    for reason, count in report.items():
+        print('    %-12s %d' % (reason + ':', count))
+    print('\n')
+
+
+def write_annotation_index(annotations: dict,
+                           index_dir: Union[str, pathlib.Path]) -> None:
+    '''
+    Writes `annotations` to `index_dir` as flat arrays:
+        ids.npy:     (M,) int64 image ID numbers, sorted
+        names.npy:   (M,) fixed-width bytes filenames
+        offsets.npy: (M + 1,) int64; boxes of image i are boxes[offsets[i]:offsets[i+1]]
+        boxes.npy:   (B, 4) int32 (x0, y0, x1, y1) boxes
+        resized_valid.npy: (M,) bool, see `resized_validity`
+        sizes.npy:   (M, 2) int32 (width, height), only if `annotations`
+                     has 'sizes'; images are otherwise 768x768
+    Arrays left out of `annotations` are memory-mapped from `index_dir`,
+    where they were already written (as `ingest_annotations` does, chunk
+    by chunk).
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+    arrays = {}
+    for key in ('ids', 'names', 'offsets', 'boxes', 'sizes'):
+        path = os.path.join(index_dir, key + '.npy')
+        if key in annotations:
+            np.save(path, annotations[key])
+            arrays[key] = annotations[key]
+        elif os.path.exists(path):
+            arrays[key] = np.load(path, mmap_mode='r')
+    input_shape = arrays['sizes'] if 'sizes' in arrays else (768, 768)
+    np.save(os.path.join(index_dir, 'resized_valid.npy'),
+            resized_validity(arrays['boxes'], arrays['offsets'], input_shape))
+
+
+def compile_annotation_index(image_names: dict,
+                             image_masks: dict,
+                             index_dir: Union[str, pathlib.Path],
+                             shape=(768, 768)) -> None:
+    '''Writes the output of `filter_masks` in the `write_annotation_index` layout.'''
+    ids = np.array(sorted(image_names.keys()), dtype=np.int64)
+    rles = [rle for idx in ids for rle in image_masks[idx] if isinstance(rle, str)]
+    counts = [sum(1 for rle in image_masks[idx] if isinstance(rle, str)) for idx in ids]
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    annotations = {
+        'ids': ids,
+        'names': np.array([image_names[idx] for idx in ids], dtype=np.bytes_),
+        'offsets': offsets,
+        'boxes': rle2bbox_batch(rles, shape).astype(np.int32).reshape((-1, 4)),
+    }
+    write_annotation_index(annotations, index_dir)
+
+
+def load_index_segment(index_dir: Union[str, pathlib.Path]) -> dict:
+    '''Memory-maps the arrays of one index directory; missing optional arrays are None.'''
+    segment = {}
+    for key in ('ids', 'names', 'offsets', 'boxes', 'root_ids', 'mask_bits',
+                'mask_offsets', 'labels', 'valid', 'resized_valid', 'sizes'):
+        path = os.path.join(index_dir, key + '.npy')
+        segment[key] = np.load(path, mmap_mode='r') if os.path.exists(path) else None
+    segment['roots'] = None
+    if os.path.exists(os.path.join(index_dir, 'roots.npy')):
+        segment['roots'] = [root.decode() for root in np.load(os.path.join(index_dir, 'roots.npy'))]
+    return segment
+
+
+# Arrays of an `AnnotationIndex`, merged from its segments on first use
+INDEX_KEYS = ('ids', 'names', 'offsets', 'boxes', 'roots', 'root_ids', 'mask_bits',
+              'mask_offsets', 'labels', 'valid', 'sizes', 'resized_valid')
+
+
+def merge_index_segments(segments: List[dict], keys=INDEX_KEYS) -> dict:
+    '''
+    Concatenates `keys` of index segments, shifting box and mask offsets and
+    root IDs. Images of segments without roots get root ID -1, images
+    without a stored split get `valid` -1 and images without sizes are
+    768x768. The arrays of a single segment are returned as they are
+    (memory-mapped), with defaults only for the missing optional ones.
+    '''
+    def concat(arrays):
+        return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+    def shifted(key, lengths):
+        if len(segments) == 1:
+            return segments[0][key]
+        shifts = np.cumsum([0] + [len(seg[lengths]) for seg in segments[:-1]])
+        return np.concatenate([np.zeros(1, np.int64)] + [np.asarray(seg[key][1:]) + shift \
+                                                         for seg, shift in zip(segments, shifts)])
+
+    def sizes(seg):
+        return seg['sizes'] if seg['sizes'] is not None else \
+            np.full((len(seg['ids']), 2), 768, dtype=np.int32)
+
+    merged = {}
+    for key in keys:
+        if key in ('ids', 'names', 'boxes'):
+            merged[key] = concat([seg[key] for seg in segments])
+        elif key == 'offsets':
+            merged[key] = shifted('offsets', 'boxes')
+        elif key == 'roots':
+            merged[key] = None
+            if any(seg['roots'] is not None for seg in segments):
+                merged[key] = [root for seg in segments for root in (seg['roots'] or [])]
+        elif key == 'root_ids':
+            root_ids, num_roots = [], 0
+            for seg in segments:
+                if seg['roots'] is not None:
+                    root_ids.append(seg['root_ids'] if num_roots == 0 else \
+                                    np.asarray(seg['root_ids']) + num_roots)
+                    num_roots += len(seg['roots'])
+                else:
+                    root_ids.append(np.full(len(seg['ids']), -1, dtype=np.int32))
+            merged[key] = concat(root_ids)
+        elif key == 'labels':
+            merged[key] = concat([seg['labels'] if seg['labels'] is not None else \
+                                  (np.diff(seg['offsets']) > 0).astype(np.int8) for seg in segments])
+        elif key == 'valid':
+            merged[key] = concat([seg['valid'] if seg['valid'] is not None else \
+                                  np.full(len(seg['ids']), -1, dtype=np.int8) for seg in segments])
+        elif key == 'sizes':
+            merged[key] = None
+            if any(seg['sizes'] is not None for seg in segments):
+                merged[key] = concat([sizes(seg) for seg in segments])
+        elif key == 'resized_valid':
+            merged[key] = concat([seg['resized_valid'] if seg['resized_valid'] is not None else \
+                                  resized_validity(seg['boxes'], seg['offsets'], sizes(seg)) \
+                                  for seg in segments])
+        elif key in ('mask_bits', 'mask_offsets'):
+            merged[key] = None
+            with_masks = all(seg['mask_bits'] is not None or len(seg['boxes']) == 0 \
+                             for seg in segments) \
+                and any(seg['mask_bits'] is not None for seg in segments)
+            if with_masks:
+                masked = [seg for seg in segments if seg['mask_bits'] is not None]
+                if key == 'mask_bits':
+                    merged[key] = concat([seg['mask_bits'] for seg in masked])
+                else:
+                    # Segments without masks have no boxes, so add no offsets
+                    shifts = np.cumsum([0] + [len(seg['mask_bits']) for seg in masked[:-1]])
+                    merged[key] = masked[0]['mask_offsets'] if len(masked) == 1 else \
+                        np.concatenate([np.zeros(1, np.int64)] + \
+                                       [np.asarray(seg['mask_offsets'][1:]) + shift \
+                                        for seg, shift in zip(masked, shifts)])
+        else:
+            raise KeyError(key)
+    return merged
+
+
+class AnnotationIndex:
+    '''
+    Read-only view of an index written by `write_annotation_index` (or by
+    `ingest_annotations`, in which case every image also has its own root),
+    plus any label batches added since with `append_labels` as segments.
+
+    Every array of an index without appended batches is memory-mapped, so
+    DataLoader workers share a single physical copy instead of each copying
+    the Python dicts from `filter_masks`. With appended batches, each array
+    (`INDEX_KEYS`) is concatenated from the memory-mapped segments on first
+    use only; `merge` instead writes all of them to `index_dir/merged/` once
+    and memory-maps them, so that workers share those as well. The index
+    is pickled (e.g. for spawned workers) as its directory only, and the
+    copy maps the arrays again.
+
+    Besides the `write_annotation_index` arrays, `labels` holds image-level
+    labels (1 if the image contains a vessel), `valid` the stored train (0) /
+    valid (1) assignment, -1 if the split is left to `split`, and `sizes`
+    the (width, height) of every image, None if all are 768x768 (see
+    `ingest_annotations` with `probe_sizes`). `resized_valid` is computed on
+    load for indexes written before it was stored.
+    '''
+    def __init__(self, index_dir: Union[str, pathlib.Path]):
+        self.index_dir = index_dir
+        self.segments = [load_index_segment(index_dir)]
+        self.segments += [load_index_segment(segment_dir) \
+                          for segment_dir in list_index_segments(index_dir)]
+        if len(self.segments) > 1 and self.merged_key() == self.segments_key():
+            self.__dict__.update(merge_index_segments([load_index_segment(self.merged_dir())]))
+
+
+    def __getstate__(self):
+        return {'index_dir': self.index_dir}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['index_dir'])
+
+
+    def merged_dir(self) -> str:
+        return os.path.join(self.index_dir, 'merged')
+
+
+    def segments_key(self) -> str:
+        return '\n'.join(os.path.basename(d) for d in list_index_segments(self.index_dir))
+
+
+    def merged_key(self) -> Optional[str]:
+        # Segments the arrays in `merged_dir` were merged from, None if there are none
+        key_path = os.path.join(self.merged_dir(), 'segments.txt')
+        if not os.path.exists(key_path):
+            return None
+        with open(key_path) as f:
+            return f.read()
+
+
+    def merge(self) -> None:
+        '''
+        Merges every array of the segments now, in the parent process before
+        DataLoader workers start (see `VesselDataset`). The merged arrays are
+        written once, to be rewritten only after `append_labels`.
+        '''
+        if len(self.segments) == 1:
+            self.__dict__.update(merge_index_segments(self.segments))
+            return
+        key = self.segments_key()
+        if self.merged_key() != key:
+            merged_dir = self.merged_dir()
+            os.makedirs(merged_dir, exist_ok=True)
+            key_path = os.path.join(merged_dir, 'segments.txt')
+            if os.path.exists(key_path):
+                os.remove(key_path)
+            for name, value in merge_index_segments(self.segments).items():
+                path = os.path.join(merged_dir, name + '.npy')
+                if name == 'roots' and value is not None:
+                    value = np.array(value, dtype=np.bytes_)
+                if value is not None:
+                    np.save(path, value)
+                elif os.path.exists(path):
+                    os.remove(path)
+            # Written last, so arrays of an interrupted merge are never used
+            with open(key_path, 'w') as f:
+                f.write(key)
+        self.__dict__.update(merge_index_segments([load_index_segment(self.merged_dir())]))
+
+
+    def __getattr__(self, key):
+        # Only called for arrays not merged yet
+        if key not in INDEX_KEYS or 'segments' not in self.__dict__:
+            raise AttributeError(key)
+        value = merge_index_segments(self.segments, keys=(key,))[key]
+        setattr(self, key, value)
+        return value
+
+
+    def __len__(self):
+        return sum(len(seg['ids']) for seg in self.segments)
+
+
+    def row(self, idx: int) -> int:
+        row = int(np.searchsorted(self.ids, idx))
+        if row >= len(self.ids) or self.ids[row] != idx:
+            raise KeyError(idx)
+        return row
+
+
+    def name(self, idx: int) -> str:
+        return self.names[self.row(idx)].decode()
+
+
+    def image_boxes(self, idx: int) -> np.ndarray:
+        row = self.row(idx)
+        return np.array(self.boxes[self.offsets[row]:self.offsets[row + 1]])
+
+
+    def image_size(self, idx: int) -> Tuple[int, int]:
+        '''(width, height) of an image.'''
+        if self.sizes is None:
+            return (768, 768)
+        width, height = self.sizes[self.row(idx)]
+        return int(width), int(height)
+
+
+    def image_masks(self, idx: int, shape=(768, 768), out_shape=(299, 299)) -> np.ndarray:
+        '''(N, out_h, out_w) uint8 instance masks of an image, from the stored crops.'''
+        row = self.row(idx)
+        first, last = self.offsets[row], self.offsets[row + 1]
+        boxes = self.boxes[first:last]
+        crops = [unpack_crop(self.mask_bits[self.mask_offsets[i]:self.mask_offsets[i + 1]], box)
+                 for i, box in zip(range(first, last), boxes)]
+        return paste_masks(crops, boxes, shape, out_shape)
+
+
+    def image_dir(self, idx: int) -> Optional[str]:
+        if self.roots is None:
+            return None
+        root_id = self.root_ids[self.row(idx)]
+        return self.roots[root_id] if root_id >= 0 else None
+
+
+    def has_box_targets(self, ids: np.ndarray) -> np.ndarray:
+        '''False for positive images that only carry an image-level label.'''
+        rows = np.searchsorted(self.ids, ids)
+        counts = self.offsets[rows + 1] - self.offsets[rows]
+        return ~((self.labels[rows] == 1) & (counts == 0))
+
+
+    def split(self,
+              seed: int,
+              test_size: Union[float, int],
+              keep_ids: Optional[np.ndarray] = None,
+              stratify: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Train/valid image IDs. Images without a stored assignment are split by
+        `split_image_ids`, so appending batches never moves existing images,
+        and with `stratify` on their number of boxes. With `keep_ids` (see
+        `get_train_valid_dfs`) other images are left out.
+        '''
+        ids, valid = np.asarray(self.ids), np.asarray(self.valid)
+        if keep_ids is not None:
+            keep = np.isin(ids, keep_ids)
+            ids, valid = ids[keep], valid[keep]
+        train_ids, valid_ids = ids[valid == 0], ids[valid == 1]
+        if np.any(valid == -1):
+            offsets = None
+            if stratify:
+                rows = np.searchsorted(self.ids, ids[valid == -1])
+                counts = self.offsets[rows + 1] - self.offsets[rows]
+                offsets = np.concatenate([[0], np.cumsum(counts)])
+            split_train_ids, split_valid_ids = split_image_ids(ids[valid == -1], seed, test_size,
+                                                               offsets=offsets)
+            train_ids = np.concatenate([split_train_ids, train_ids])
+            valid_ids = np.concatenate([split_valid_ids, valid_ids])
+        return train_ids, valid_ids
+
+
+def list_index_segments(index_dir: Union[str, pathlib.Path]) -> List[str]:
+    segments_dir = os.path.join(index_dir, 'segments')
+    if not os.path.isdir(segments_dir):
+        return []
+    return [os.path.join(segments_dir, d) for d in sorted(os.listdir(segments_dir))]
+
+
+def append_labels(index_dir: Union[str, pathlib.Path],
+                  labels_csv: Union[str, pathlib.Path],
+                  image_dir: Union[str, pathlib.Path],
+                  valid_fraction: float = 0.01,
+                  seed: int = 0) -> int:
+    '''
+    Appends a batch of labeled tiles (the `labels.csv` written by the tiler
+    notebook, with `sample_id` and `label` columns; images are saved as
+    `image_dir/<sample_id>.jpg`) to an existing index as a new segment.
+
+    Only the new rows are read and written: tiles get the next free image ID
+    numbers and a seeded train/valid assignment of their own, which is stored
+    so later batches never change it. Tiles already in the index under the
+    same image root are skipped, by binary search in the sorted names of each
+    segment sharing the root; the index itself is never merged. Returns the
+    number of tiles added.
+    '''
+    segment_dirs = list_index_segments(index_dir)
+    segments = [load_index_segment(index_dir)] + \
+        [load_index_segment(segment_dir) for segment_dir in segment_dirs]
+    df = pd.read_csv(labels_csv)
+    names = (df['sample_id'].astype(str) + '.jpg').to_numpy().astype(np.bytes_)
+    root_key = os.path.normpath(os.path.abspath(image_dir))
+    new = np.ones(len(names), dtype=bool)
+    for seg in segments:
+        if seg['roots'] is None:
+            continue
+        same_root = [i for i, root in enumerate(seg['roots']) \
+                     if os.path.normpath(os.path.abspath(root)) == root_key]
+        if not same_root:
+            continue
+        existing = seg['names']
+        if len(same_root) < len(seg['roots']):
+            existing = existing[np.isin(seg['root_ids'], same_root)]
+        # Names of an ingested index are already sorted within each root
+        if np.any(existing[1:] < existing[:-1]):
+            existing = np.sort(existing)
+        rows = np.minimum(np.searchsorted(existing, names), max(len(existing) - 1, 0))
+        if len(existing):
+            new &= existing[rows] != names
+    names = names[new]
+    if len(names) == 0:
+        return 0
+
+    segment_dir = os.path.join(index_dir, 'segments', '%05d' % (len(segment_dirs) + 1))
+    # IDs are sorted within every segment
+    first_id = max([int(seg['ids'][-1]) + 1 for seg in segments if len(seg['ids'])], default=0)
+    rng = np.random.RandomState(seed + len(segment_dirs) + 1)
+    annotations = {
+        'ids': np.arange(first_id, first_id + len(names), dtype=np.int64),
+        'names': names,
+        'offsets': np.zeros(len(names) + 1, dtype=np.int64),
+        'boxes': np.zeros((0, 4), dtype=np.int32),
+    }
+    write_annotation_index(annotations, segment_dir)
+    np.save(os.path.join(segment_dir, 'roots.npy'), np.array([str(image_dir)], dtype=np.bytes_))
+    np.save(os.path.join(segment_dir, 'root_ids.npy'), np.zeros(len(names), dtype=np.int32))
+    np.save(os.path.join(segment_dir, 'labels.npy'), df['label'].to_numpy()[new].astype(np.int8))
+    np.save(os.path.join(segment_dir, 'valid.npy'),
+            (rng.rand(len(names)) < valid_fraction).astype(np.int8))
+    return len(names)
+
+
+# Start of frame markers, whose segment holds the image dimensions
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(f) -> Optional[Tuple[int, int]]:
+    '''
+    (width, height) of a JPEG file object from its frame header, seeking
+    past every segment before it, so only a few hundred bytes are read.
+    None if `f` is not a JPEG or has no frame header before the scan data.
+    '''
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':  # Fill bytes
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue  # Markers without a segment
+        if marker in (0xD9, 0xDA):
+            return None
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if marker in JPEG_SOF_MARKERS:
+            header = f.read(5)
+            if len(header) < 5:
+                return None
+            height, width = struct.unpack('>xHH', header)
+            return width, height
+        f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+
+
+def probe_image_size(image_dir: Union[str, pathlib.Path, ZipImageSource], name: str) -> Tuple[int, int]:
+    '''
+    (width, height) of an image without decoding it: from the JPEG header
+    (see `jpeg_size`), else from PIL, which also only parses the header.
+    Members of a `ZipImageSource` are read whole.
+    '''
+    if isinstance(image_dir, ZipImageSource):
+        f = io.BytesIO(image_dir.read(name))
+    else:
+        f = open(os.path.join(image_dir, name), 'rb')
+    with f:
+        size = jpeg_size(f)
+        if size is None:
+            f.seek(0)
+            size = Image.open(f).size
+    return size
+
+
+def probe_sizes(args) -> np.ndarray:
+    '''Worker for `probe_image_sizes`: sizes of `names` from one image directory or archive.'''
+    image_dir, names = args
+    return np.array([probe_image_size(image_dir, name) for name in names],
+                    dtype=np.int32).reshape((-1, 2))
+
+
+def probe_image_sizes(image_dir: Union[str, pathlib.Path, ZipImageSource],
+                      names: List[str],
+                      num_workers: int = 0,
+                      chunksize: int = 1024) -> np.ndarray:
+    '''(len(names), 2) int32 (width, height) of images `names`, see `probe_image_size`.'''
+    jobs = [(image_dir, names[first:first + chunksize]) for first in range(0, len(names), chunksize)]
+    if num_workers > 0:
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.map(probe_sizes, jobs)
+    else:
+        results = [probe_sizes(job) for job in jobs]
+    return np.concatenate(results) if results else np.zeros((0, 2), dtype=np.int32)
+
+
 class Resize:
     def __init__(self, 
                  input_shape = (768, 768), 
@@ -174,11 +1268,11 @@ class Resize:
         
         
     def resize_boxes(self, boxes: torch.tensor) -> torch.tensor:
-        x_orig, y_orig = self.input_shape
+        # `input_shape` may also be an (N, 2) array of per-box (width, height)
+        input_shape = torch.from_numpy(np.asarray(self.input_shape, dtype=np.float64))
         x_new, y_new = self.output_shape
-        x_scale = x_new / x_orig
-        y_scale = y_new / y_orig
-        row_scaler = torch.tensor([x_scale, y_scale, x_scale, y_scale])
+        scale = torch.tensor([x_new, y_new], dtype=torch.float64) / input_shape
+        row_scaler = scale[..., [0, 1, 0, 1]].float()
         boxes_scaled = torch.round(boxes * row_scaler).int() # Converts to new coordinates
         return boxes_scaled
         
@@ -200,8 +1294,23 @@ class RandomBlur:
         if prob < self.p:
             x = x.filter(ImageFilter.GaussianBlur(self.radius))
         return x
-    
-    
+
+
+    def __repr__(self):
+        return '%s(p=%s, radius=%s)' % (self.__class__.__name__, self.p, self.radius)
+
+
+def stack_collate(batch):
+    '''Collates (uint8 image, target) samples into one (B, C, H, W) tensor and a tuple of targets.'''
+    images, targets = zip(*batch)
+    return torch.stack(images), targets
+
+
+def list_collate(batch):
+    '''Collates samples into a tuple of images and a tuple of targets, as detection models expect.'''
+    return tuple(zip(*batch))
+
+
 class VesselDataset(Dataset):
     def __init__(self, 
                  boxes: dict, 
@@ -212,13 +1321,48 @@ class VesselDataset(Dataset):
                  test_image_dir=None, 
                  transform=None, 
                  mode='train', 
-                 binary=True):
+                 binary=True,
+                 index: Optional[AnnotationIndex] = None,
+                 return_masks: bool = False,
+                 tile_cache: Optional[TileCache] = None,
+                 batch_augment: bool = False,
+                 draft_size: Optional[Tuple[int, int]] = None,
+                 variant_sampler: Optional[VariantSampler] = None,
+                 filter_invalid: bool = True):
+        # If `index` is given, names and boxes are read from the memory-mapped
+        # index and `boxes` and `image_names` may be None
         self.boxes = boxes
         self.image_ids = image_ids
         self.image_names = image_names
+        self.index = index
+        if index is not None:
+            # Before any worker starts, so that all of them map the same arrays
+            index.merge()
+        # Instance masks come from an index built with `with_masks=True`
+        if return_masks and (index is None or index.mask_bits is None):
+            raise ValueError('return_masks requires an index built with masks')
+        self.return_masks = return_masks
+        # Images are read pre-resized from `tile_cache` instead of decoded
+        self.tile_cache = tile_cache
+        # Training samples read one of the tile cache's augmented variants,
+        # picked by `variant_sampler`, and are not blurred again
+        if variant_sampler is not None and (tile_cache is None or tile_cache.variants is None):
+            raise ValueError('variant_sampler requires a tile cache built with variants')
+        self.variant_sampler = variant_sampler
+        # Return resized (C, H, W) uint8 images for train and valid samples,
+        # leaving blur, flips and normalization to `BatchAugment`
+        self.batch_augment = batch_augment
+        # Decode JPEGs at reduced resolution before the final resize (see `open_image`)
+        self.draft_size = draft_size
+        # Image directories may also be `ZipImageSource`s; index roots which
+        # are zip files are opened (and their central directories read) here
         self.train_image_dir = train_image_dir
         self.valid_image_dir = valid_image_dir
         self.test_image_dir = test_image_dir
+        self.archives = {}
+        if index is not None and index.roots is not None:
+            self.archives = {root: ZipImageSource(root) for root in index.roots \
+                             if zipfile.is_zipfile(root)}
 
         mean = [0.485, 0.456, 0.406]
         std = [0.229, 0.224, 0.225]
@@ -240,38 +1384,171 @@ class VesselDataset(Dataset):
             ToTensor(),
             Normalize(mean, std) # Apply to all input images
         ])
+        self.replay_transform = Compose([
+            ToTensor(),
+            Normalize(mean, std)
+        ])
         self.mode = mode
+        # `__getitem__` does not check boxes, so train and valid samples whose
+        # boxes become invalid at 299x299 are dropped here, unless the caller
+        # skips them itself (e.g. with `ValidSampler`)
+        self.num_excluded = 0
+        if filter_invalid and mode in ('train', 'valid'):
+            valid = self.valid_mask()
+            self.num_excluded = int(np.sum(~valid))
+            if self.num_excluded:
+                self.image_ids = np.asarray(image_ids)[valid] if isinstance(image_ids, np.ndarray) \
+                    else [idx for idx, keep in zip(image_ids, valid) if keep]
 
 
     def __len__(self):
         return len(self.image_ids)
 
 
+    def transform_config(self) -> dict:
+        '''Everything which determines the samples, for `FrozenDataset`.'''
+        transform = {'train': self.train_transform, 'valid': self.valid_transform}.get(
+            self.mode, self.test_transform)
+        index = None
+        if self.index is not None:
+            index = [str(self.index.index_dir), len(self.index), len(self.index.boxes)]
+        return {
+            'mode': self.mode,
+            'image_ids': [int(idx) for idx in self.image_ids],
+            'transform': repr(transform),
+            'batch_augment': self.batch_augment,
+            'draft_size': self.draft_size,
+            'tile_cache': str(self.tile_cache.cache_dir) if self.tile_cache is not None else None,
+            'return_masks': self.return_masks,
+            'index': index,
+        }
+
+
+    def image_sizes(self) -> np.ndarray:
+        '''
+        (len(self), 2) (width, height) of every sample's original image, for
+        `GroupedBatchSampler`: from the index, or probed from the headers.
+        '''
+        if self.index is not None:
+            if self.index.sizes is None:
+                return np.full((len(self), 2), 768, dtype=np.int32)
+            return np.asarray(self.index.sizes)[np.searchsorted(self.index.ids, self.image_ids)]
+        image_dir = {'train': self.train_image_dir,
+                     'valid': self.valid_image_dir}.get(self.mode, self.test_image_dir)
+        return probe_image_sizes(image_dir, [self.image_names[idx] for idx in self.image_ids])
+
+
+    def valid_mask(self) -> np.ndarray:
+        '''
+        (len(self),) bool, True for samples whose boxes all stay valid after
+        resizing to 299x299. Used with `filter_invalid` or by `ValidSampler`,
+        since `__getitem__` does not check boxes.
+        '''
+        if self.index is not None:
+            return np.asarray(self.index.resized_valid)[np.searchsorted(self.index.ids, self.image_ids)]
+        img_masks = [[rle for rle in self.boxes[idx] if isinstance(rle, str)] for idx in self.image_ids]
+        offsets = np.zeros(len(img_masks) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(rles) for rles in img_masks])
+        boxes = rle2bbox_batch([rle for rles in img_masks for rle in rles], (768, 768))
+        return resized_validity(boxes.reshape((-1, 4)), offsets)
+
+
     def __getitem__(self, idx):
         idx = self.image_ids[idx] # Convert from input to image ID number
-        img_file_name = self.image_names[idx]
-        if self.mode == 'train':
-            img_path = os.path.join(self.train_image_dir, img_file_name)
+        if self.index is not None:
+            img_file_name = self.index.name(idx)
+        else:
+            img_file_name = self.image_names[idx]
+        image_dir = self.index.image_dir(idx) if self.index is not None else None
+        if image_dir is not None:
+            image_dir = self.archives.get(image_dir, image_dir)
+        elif self.mode == 'train':
+            image_dir = self.train_image_dir
         elif self.mode == 'valid':
-            img_path = os.path.join(self.valid_image_dir, img_file_name)
+            image_dir = self.valid_image_dir
         else:
-            img_path = os.path.join(self.test_image_dir, img_file_name)
-
-        img = Image.open(img_path)
+            image_dir = self.test_image_dir
+
+        variant = None
+        if self.tile_cache is not None:
+            if self.variant_sampler is not None and self.mode == 'train':
+                k = self.variant_sampler()
+                img = Image.fromarray(self.tile_cache.tile(img_file_name, k))
+                variant = self.tile_cache.variants[k]
+            else:
+                img = Image.fromarray(self.tile_cache.tile(img_file_name))
+            size = self.index.image_size(idx) if self.index is not None else (768, 768)
+        else:
+            img = open_image(image_dir, img_file_name)
+            # True (width, height), from the header before any draft decode
+            size = img.size
+            if self.draft_size is not None:
+                img.draft('RGB', self.draft_size)
+        target = None
         if self.mode =='train' or self.mode =='valid':
-            img_boxes = self.boxes[idx]
-            N = sum([1 for i in img_boxes if isinstance(i, str)])
-            target = make_target(img_boxes, N, shape=(768, 768))
-            img, target = Resize(input_shape = (768, 768), 
-                                 output_shape = (299, 299)
-                                )(img, target)
-            for row in target['boxes']:
-                if not is_valid_box(row, shape=(299,299)):
-                    random_idx = random.choice(range(self.__len__()))
-                    return self.__getitem__(random_idx)
+            if self.index is not None:
+                target = make_target_from_boxes(self.index.image_boxes(idx))
+            else:
+                img_boxes = self.boxes[idx]
+                N = sum([1 for i in img_boxes if isinstance(i, str)])
+                target = make_target(img_boxes, N, shape=(size[1], size[0]))
+        return self.make_sample(img, target, idx, resized=self.tile_cache is not None, size=size,
+                                variant=variant)
+
+
+    def from_record(self, record: dict):
+        '''Builds the same sample as `__getitem__` from a `read_shard` record.'''
+        img = Image.open(io.BytesIO(record['jpeg']))
+        size = img.size
+        if self.draft_size is not None:
+            img.draft('RGB', self.draft_size)
+        target = None
+        if self.mode =='train' or self.mode =='valid':
+            target = make_target_from_boxes(record['boxes'])
+        return self.make_sample(img, target, record['id'], size=size)
+
+
+    def make_sample(self,
+                    img: Image.Image,
+                    target: Optional[dict],
+                    idx: int,
+                    resized: bool = False,
+                    size=(768, 768),
+                    variant=None):
+        '''
+        Resizes and transforms an image (and target) of image ID `idx`, whose
+        original (width, height) is `size`. A cached (blur, hflip, vflip)
+        `variant` image gets its target flipped to match and is not blurred.
+        '''
+        if self.mode =='train' or self.mode =='valid':
+            resize_fn = Resize(input_shape = size, 
+                               output_shape = (299, 299)
+                              )
+            if resized:
+                target['boxes'] = resize_fn.resize_boxes(target['boxes'])
+            else:
+                img, target = resize_fn(img, target)
+            if self.return_masks:
+                target['masks'] = torch.from_numpy(
+                    self.index.image_masks(idx, shape=(size[1], size[0]), out_shape=(299, 299))
+                )
+            if variant is not None:
+                # Same box arithmetic as `BatchAugment.flip`
+                for flip, (lo, hi), dim in [(variant[1], (0, 2), -1), (variant[2], (1, 3), -2)]:
+                    if flip:
+                        boxes = target['boxes'].clone()
+                        boxes[:, lo], boxes[:, hi] = 299 - target['boxes'][:, hi], \
+                            299 - target['boxes'][:, lo]
+                        target['boxes'] = boxes
+                        if 'masks' in target:
+                            target['masks'] = target['masks'].flip(dim)
+
+            if self.batch_augment:
+                img = torch.from_numpy(np.array(img.convert('RGB'), dtype=np.uint8)).permute(2, 0, 1)
+                return img, target
         
         if self.mode =='train':
-            img = self.train_transform(img)
+            img = self.train_transform(img) if variant is None else self.replay_transform(img)
             assert not np.any(np.isnan(img.numpy()))
             return img, target
         elif self.mode == 'valid':
@@ -284,17 +1561,219 @@ class VesselDataset(Dataset):
             return img
         
 
+def read_image_bytes(image_dir: Union[str, pathlib.Path, ZipImageSource], name: str) -> bytes:
+    if isinstance(image_dir, ZipImageSource):
+        return image_dir.read(name)
+    with open(os.path.join(image_dir, name), 'rb') as f:
+        return f.read()
+
+
+def write_shards(index: AnnotationIndex,
+                 ids: np.ndarray,
+                 shard_dir: Union[str, pathlib.Path],
+                 image_dir: Optional[Union[str, pathlib.Path, ZipImageSource]] = None,
+                 records_per_shard: int = 512,
+                 seed: int = 0,
+                 stop: Optional[threading.Event] = None) -> int:
+    '''
+    Packs the (JPEG bytes, boxes, label) records of images `ids` of `index`
+    into sequential shard files `shard_dir/NNNNN.shard`, in a seeded random
+    order, and writes the number of records per shard to `counts.npy`.
+    Images are read from their index root, else from `image_dir`. Returns
+    the number of shards written; when `stop` is set, writing ends after
+    the current shard, without `counts.npy`.
+    '''
+    os.makedirs(shard_dir, exist_ok=True)
+    ids = np.asarray(ids)[np.random.RandomState(seed).permutation(len(ids))]
+    archives = {}
+    counts = []
+    for shard, first in enumerate(range(0, len(ids), records_per_shard)):
+        shard_ids = ids[first:first + records_per_shard]
+        with open(os.path.join(shard_dir, '%05d.shard' % shard), 'wb') as f:
+            for idx in shard_ids:
+                name = index.name(idx)
+                root = index.image_dir(idx)
+                if root is not None and zipfile.is_zipfile(root):
+                    root = archives.setdefault(root, ZipImageSource(root))
+                jpeg = read_image_bytes(root if root is not None else image_dir, name)
+                boxes = index.image_boxes(idx).astype(np.int32)
+                f.write(SHARD_RECORD_HEADER.pack(int(idx), int(index.labels[index.row(idx)]),
+                                                 len(name.encode()), len(jpeg), len(boxes)))
+                f.write(name.encode())
+                f.write(jpeg)
+                f.write(boxes.tobytes())
+        counts.append(len(shard_ids))
+        if stop is not None and stop.is_set():
+            return len(counts)
+    np.save(os.path.join(shard_dir, 'counts.npy'), np.array(counts, dtype=np.int64))
+    return len(counts)
+
+
+class ValidSampler(Sampler):
+    '''
+    Samples only the dataset positions for which `valid` is True, in random
+    order if `shuffle` (drawn from torch's global RNG, like `RandomSampler`).
+    Images with boxes that become invalid after resizing are thus never
+    loaded; `num_excluded` counts them.
+
+    With `seed`, the order of each epoch is instead drawn from `seed` and
+    the epoch given to `set_epoch`, so it can be replayed when resuming,
+    skipping the `start` samples already seen.
+    '''
+    def __init__(self, valid: np.ndarray, shuffle: bool = True, seed: Optional[int] = None):
+        self.indices = np.flatnonzero(valid)
+        self.num_excluded = len(valid) - len(self.indices)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+
+    def set_epoch(self, epoch: int, start: int = 0) -> None:
+        self.epoch = epoch
+        self.start = start
+
+
+    def __len__(self):
+        return len(self.indices) - self.start
+
+
+    def __iter__(self) -> Iterator[int]:
+        indices = self.indices
+        if self.shuffle:
+            generator = None
+            if self.seed is not None:
+                generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = indices[torch.randperm(len(indices), generator=generator).numpy()]
+        return iter(indices[self.start:].tolist())
+
+
+class GroupedBatchSampler(Sampler):
+    '''
+    Batches of the dataset positions `indices` (e.g. `ValidSampler.indices`)
+    in which all images share their original (width, height), or with
+    `aspect_bins` their bin of aspect ratio (h / w) between those edges, so
+    boxes and resizing distortion are consistent within a batch when
+    datasets of different image sizes are mixed.
+
+    Each group is shuffled and cut into batches (only its last batch may be
+    smaller, or is dropped with `drop_last`), then the batches of all groups
+    are shuffled together; drawn from torch's global RNG, or from `seed` and
+    the epoch like `ValidSampler` (`start` then counts batches).
+    '''
+    def __init__(self,
+                 sizes: np.ndarray,
+                 batch_size: int,
+                 indices: Optional[np.ndarray] = None,
+                 aspect_bins: Optional[tuple] = None,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 seed: Optional[int] = None):
+        sizes = np.asarray(sizes).reshape((-1, 2))
+        self.indices = np.arange(len(sizes)) if indices is None else np.asarray(indices)
+        sizes = sizes[self.indices]
+        if aspect_bins is None:
+            _, groups = np.unique(sizes, axis=0, return_inverse=True)
+        else:
+            groups = np.digitize(sizes[:, 1] / sizes[:, 0], aspect_bins)
+        self.groups = np.asarray(groups).reshape(-1)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+
+    def set_epoch(self, epoch: int, start: int = 0) -> None:
+        self.epoch = epoch
+        self.start = start
+
+
+    def __len__(self):
+        counts = np.bincount(self.groups)
+        if self.drop_last:
+            return int(np.sum(counts // self.batch_size)) - self.start
+        return int(np.sum((counts + self.batch_size - 1) // self.batch_size)) - self.start
+
+
+    def __iter__(self) -> Iterator[List[int]]:
+        generator = None
+        if self.seed is not None:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        batches = []
+        for group in np.unique(self.groups):
+            members = self.indices[self.groups == group]
+            if self.shuffle:
+                members = members[torch.randperm(len(members), generator=generator).numpy()]
+            for first in range(0, len(members), self.batch_size):
+                batch = members[first:first + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return iter(batches[self.start:])
+
+
 # Adapted from https://discuss.pytorch.org/t/faster-rcnn-with-inceptionv3-backbone-very-slow/91455
+class FrozenPrefixSequential(nn.Sequential):
+    '''
+    `nn.Sequential` whose first `num_frozen` layers (see
+    `frozen_prefix_length`) run under `torch.no_grad()`, so no activations
+    are kept for them; only the layers after them are recorded by autograd.
+    Slices are plain (`num_frozen=0`).
+    '''
+    def __init__(self, *layers, num_frozen: int = 0):
+        super().__init__(*layers)
+        self.num_frozen = num_frozen
+
+
+    def forward(self, x):
+        layers = list(self)
+        with torch.no_grad():
+            for layer in layers[:self.num_frozen]:
+                x = layer(x)
+        for layer in layers[self.num_frozen:]:
+            x = layer(x)
+        return x
+
+
+def freeze_batch_norm(module: nn.Module) -> nn.Module:
+    '''
+    `module` with its `BatchNorm2d` layers replaced by `FrozenBatchNorm2d`
+    with the same statistics and affine parameters, so they always
+    normalize with their running statistics and never update them.
+    '''
+    if isinstance(module, nn.BatchNorm2d):
+        frozen = FrozenBatchNorm2d(module.num_features, eps=module.eps)
+        with torch.no_grad():
+            frozen.weight.copy_(module.weight)
+            frozen.bias.copy_(module.bias)
+            frozen.running_mean.copy_(module.running_mean)
+            frozen.running_var.copy_(module.running_var)
+        return frozen
+    for name, child in module.named_children():
+        setattr(module, name, freeze_batch_norm(child))
+    return module
+
+
 def make_model(backbone_state_dict,
                num_classes,
                anchor_sizes: tuple,
                box_detections_per_img: int,
-               num_trainable_backbone_layers: int):
+               num_trainable_backbone_layers: int,
+               aspect_ratios: tuple = (0.25, 0.5, 1.0, 2.0, 4.0),
+               trainable_offset: int = 1):
+        # The last `num_trainable_backbone_layers` layers, counted back from
+        # the `trainable_offset`-th last, stay trainable; 3 skips the
+        # parameterless pooling and dropout layers. Batch norms of frozen
+        # layers are frozen too, and the frozen prefix runs without autograd
         inception = torchvision.models.inception_v3(pretrained=False, progress=False, 
                                                     num_classes=num_classes, aux_logits=False)
-        inception.load_state_dict(torch.load(backbone_state_dict))
+        if backbone_state_dict is not None:
+            inception.load_state_dict(torch.load(backbone_state_dict))
         modules = list(inception.children())[:-1]
-        backbone = nn.Sequential(*modules)
+        backbone = FrozenPrefixSequential(*modules)
 
         #for layer in backbone:
         #    for p in layer.parameters():
@@ -302,23 +1781,23 @@ def make_model(backbone_state_dict,
 
         num_layers = len(backbone)
         if (num_trainable_backbone_layers < num_layers) and (num_trainable_backbone_layers != -1):
-            trainable_layers = [num_layers - (i + 1) for i in range(num_trainable_backbone_layers)]
+            trainable_layers = [num_layers - (trainable_offset + i) \
+                                for i in range(num_trainable_backbone_layers)]
             print('Trainable layers: \n')
             for layer_idx, layer in enumerate(backbone):
                 if layer_idx not in trainable_layers:
                     for p in layer.parameters():
                         p.requires_grad = False # Freezes the backbone layers
+                    backbone[layer_idx] = freeze_batch_norm(layer)
                 else:
                     print(layer, '\n\n')
             print('=================================\n\n')
+            backbone.num_frozen = frozen_prefix_length(backbone)
 
         backbone.out_channels = 2048
 
         # Use smaller anchor boxes since targets are relatively small
-        anchor_generator = AnchorGenerator(
-            sizes=anchor_sizes,
-            aspect_ratios=((0.25, 0.5, 1.0, 2.0, 4.0),) * len(anchor_sizes)
-        )
+        anchor_generator = make_anchor_generator(anchor_sizes, aspect_ratios)
         model = FasterRCNN(backbone,
                            min_size=299,   # Backbone expects 299x299 inputs
                            max_size=299,   # so you don't need to rescale
@@ -326,80 +1805,264 @@ def make_model(backbone_state_dict,
                            box_predictor=FastRCNNPredictor(1024, num_classes),
                            box_detections_per_img=box_detections_per_img
         )
+        # Recorded by `save_model`, to rebuild the same frozen layers
+        model.trainable_offset = trainable_offset
 
         return model
 
 
+def make_anchor_generator(anchor_sizes: tuple, aspect_ratios: tuple) -> AnchorGenerator:
+    return AnchorGenerator(
+        sizes=anchor_sizes,
+        aspect_ratios=(aspect_ratios,) * len(anchor_sizes)
+    )
+
+
+def match_state_dict(state_dict: dict, model_dict: dict) -> dict:
+    '''
+    `state_dict` keyed by the names of `model_dict`: matched by name, or
+    paired by position only when the names differ (for checkpoints saved
+    with other module names). Raises ValueError if the tensors do not fit.
+
+    Batch norms may be frozen (`FrozenBatchNorm2d`, which has no
+    `num_batches_tracked`) in one and not the other: that entry is matched
+    by name only, and dropped or zero-filled (it is unused with a
+    `momentum`).
+    '''
+    def tracked(key):
+        return key.endswith('num_batches_tracked')
+
+    state = {key: value for key, value in state_dict.items() if not tracked(key)}
+    model_keys = [key for key in model_dict.keys() if not tracked(key)]
+    if set(state.keys()) != set(model_keys):
+        if len(state) != len(model_keys):
+            raise ValueError('State dict has %d tensors, the model %d' % (len(state), len(model_keys)))
+        state = dict(zip(model_keys, state.values()))
+    for key in model_keys:
+        if tuple(state[key].shape) != tuple(model_dict[key].shape):
+            raise ValueError('Shape of %s is %s in the state dict, %s in the model' %
+                             (key, tuple(state[key].shape), tuple(model_dict[key].shape)))
+    return {key: state_dict.get(key, torch.zeros((), dtype=torch.long)) if tracked(key) else state[key] \
+            for key in model_dict.keys()}
+
+
 # Code for loading full model from state dict:
 def make_model_from_dict(state_dict_path,
                          backbone_state_dict_path,
                          num_classes,
                          anchor_sizes: tuple,
                          box_detections_per_img: int,
-                         num_trainable_backbone_layers):
-    # Adapted from https://discuss.pytorch.org/t/faster-rcnn-with-inceptionv3-backbone-very-slow/91455
-    def _make_model(backbone_state_dict,
-                num_classes,
-                anchor_sizes: tuple,
-                box_detections_per_img: int,
-                num_trainable_backbone_layers: int):
-        inception = torchvision.models.inception_v3(pretrained=False, progress=False, 
-                                                    num_classes=num_classes, aux_logits=False)
-        if backbone_state_dict is not None:
-            inception.load_state_dict(torch.load(backbone_state_dict))
-        modules = list(inception.children())[:-1]
-        backbone = nn.Sequential(*modules)
+                         num_trainable_backbone_layers,
+                         aspect_ratios: tuple = (0.25, 0.5, 1.0, 2.0, 4.0)):
+    model = make_model(backbone_state_dict_path, 
+                       num_classes, 
+                       anchor_sizes, 
+                       box_detections_per_img, 
+                       num_trainable_backbone_layers,
+                       aspect_ratios,
+                       trainable_offset=3
+    )
+    model.load_state_dict(match_state_dict(torch.load(state_dict_path), model.state_dict()))
+    return model
 
-        #for layer in backbone:
-        #    for p in layer.parameters():
-        #        p.requires_grad = False # Freezes the backbone layers
 
-        num_layers = len(backbone)
-        if (num_trainable_backbone_layers < num_layers) and (num_trainable_backbone_layers != -1):
-            trainable_layers = [num_layers - (3 + i) for i in range(num_trainable_backbone_layers)]
-            print('Trainable layers: \n')
-            for layer_idx, layer in enumerate(backbone):
-                if layer_idx not in trainable_layers:
-                    for p in layer.parameters():
-                        p.requires_grad = False # Freezes the backbone layers
-                else:
-                    print(layer, '\n\n')
-            print('=================================\n\n')
+def frozen_prefix_length(backbone: nn.Sequential) -> int:
+    '''
+    Number of leading backbone layers which are frozen (no parameter
+    requires grad) and deterministic in training (no dropout), i.e. whose
+    output only depends on the input image.
+    '''
+    for i, layer in enumerate(backbone):
+        if isinstance(layer, nn.Dropout) or any(p.requires_grad for p in layer.parameters()):
+            return i
+    return len(backbone)
 
-        backbone.out_channels = 2048
 
-        # Use smaller anchor boxes since targets are relatively small
-        anchor_generator = AnchorGenerator(
-            sizes=anchor_sizes,
-            aspect_ratios=((0.25, 0.5, 1.0, 2.0, 4.0),) * len(anchor_sizes)
-        )
-        model = FasterRCNN(backbone,
-                           min_size=299,   # Backbone expects 299x299 inputs
-                           max_size=299,   # so you don't need to rescale
-                           rpn_anchor_generator=anchor_generator,
-                           box_predictor=FastRCNNPredictor(1024, num_classes),
-                           box_detections_per_img=box_detections_per_img
-        )
-
-        return model
+class BackbonePrefix:
+    '''
+    Everything a `make_model` model computes before its first trainable
+    backbone layer: `augment` (e.g. an always-blur `BatchAugment`), the
+    model's `transform` and the `frozen_prefix_length` backbone layers, in
+    eval mode and without gradients. Used as the `prepare` of a
+    `FrozenDataset` it caches the activations at the freeze boundary, from
+    which `forward_from_activations` continues.
+
+    Its repr includes a digest of the frozen weights, so the cache is
+    rebuilt when they change. The transform must leave the image size
+    unchanged (299x299 inputs to a `min_size=max_size=299` model).
+    '''
+    def __init__(self,
+                 model: FasterRCNN,
+                 augment: Optional[BatchAugment] = None,
+                 device: Union[str, torch.device] = 'cpu'):
+        self.length = frozen_prefix_length(model.backbone)
+        self.layers = model.backbone[:self.length]
+        self.transform = model.transform
+        self.augment = augment
+        self.device = device
+        digest = hashlib.sha1()
+        for name, tensor in self.layers.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        self.digest = digest.hexdigest()
+
+
+    def __repr__(self):
+        return 'BackbonePrefix(length=%d, weights=%s, augment=%r)' % (self.length, self.digest,
+                                                                      self.augment)
+
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        images = images.to(self.device)
+        if self.augment is not None:
+            images = self.augment(images)
+        modes = [(m, m.training) for m in [self.layers, self.transform]]
+        self.layers.eval()
+        self.transform.eval()
+        try:
+            with torch.no_grad():
+                image_list, _ = self.transform(list(images.float()))
+                if any(tuple(size) != tuple(images.shape[-2:]) for size in image_list.image_sizes):
+                    raise ValueError('BackbonePrefix requires inputs the model does not resize, got %s'
+                                     % (tuple(images.shape[-2:]),))
+                activations = self.layers(image_list.tensors)
+        finally:
+            for module, training in modes:
+                module.train(training)
+        return activations.cpu()
+
+
+def forward_from_activations(model: FasterRCNN,
+                             activations: torch.Tensor,
+                             targets: Optional[List[dict]] = None,
+                             image_size=(299, 299)):
+    '''
+    `model(images, targets)` (losses in training, detections in eval) of
+    `image_size` images whose `BackbonePrefix` activations are
+    `activations`: only the trainable backbone layers and the RPN and ROI
+    heads are run.
+    '''
+    features = model.backbone[frozen_prefix_length(model.backbone):](activations)
+    features = OrderedDict([('0', features)])
+    # The anchor generator only reads the padded batch shape of the images
+    divisor = model.transform.size_divisible
+    padded = [int(math.ceil(s / divisor) * divisor) for s in image_size]
+    batch_shape = (len(activations), 3, padded[0], padded[1])
+    image_sizes = [tuple(image_size)] * len(activations)
+    images = ImageList(activations.new_zeros(()).expand(batch_shape), image_sizes)
+    if targets is not None:
+        # As resized (by a factor of 1) in `model.transform`
+        targets = [dict(t, boxes=t['boxes'].float()) for t in targets]
+    proposals, proposal_losses = model.rpn(images, features, targets)
+    detections, detector_losses = model.roi_heads(features, proposals, image_sizes, targets)
+    if model.training:
+        return dict(detector_losses, **proposal_losses)
+    return model.transform.postprocess(detections, image_sizes, image_sizes)
+
+
+# Architecture parameters (the `make_model` arguments) stored with the
+# weights by `save_model`
+ARCH_KEYS = ('num_classes', 'anchor_sizes', 'aspect_ratios', 'box_detections_per_img',
+             'num_trainable_backbone_layers')
+
+
+def model_arch(params: dict) -> dict:
+    '''The `ARCH_KEYS` entries of a training `params` dict.'''
+    return {key: params[key] for key in ARCH_KEYS}
+
+
+def save_model(model: nn.Module,
+               path: Union[str, pathlib.Path],
+               arch: dict,
+               writer: Optional[CheckpointWriter] = None,
+               **extra) -> None:
+    '''
+    Writes a self-describing checkpoint: the architecture parameters
+    `arch` (see `ARCH_KEYS`, plus the model's `trainable_offset`) and the
+    name-keyed state dict, plus any `extra` entries. Written atomically, in
+    the background with `writer`.
+    '''
+    arch = dict(arch)
+    if hasattr(model, 'trainable_offset'):
+        arch['trainable_offset'] = model.trainable_offset
+    checkpoint = dict(extra, arch=arch, state_dict=model.state_dict())
+    if writer is not None:
+        writer.save(checkpoint, path)
+    else:
+        atomic_save(checkpoint, path)
 
 
-    model = _make_model(backbone_state_dict_path, 
-                        num_classes, 
-                        anchor_sizes, 
-                        box_detections_per_img, 
-                        num_trainable_backbone_layers
-    )
-    model_dict = model.state_dict()
-    state_dict = torch.load(state_dict_path)
-    new_state_dict = {}
-    for sd_key, model_key in list(zip(state_dict.keys(), model_dict.keys())):
-        new_state_dict[model_key] = state_dict[sd_key]
-    assert len(new_state_dict) == len(model_dict)
-    for nsd_key, model_key in list(zip(new_state_dict.keys(), model_dict.keys())):
-        assert nsd_key == model_key
-    model.load_state_dict(new_state_dict)
-    return model
+def load_model(path: Union[str, pathlib.Path],
+               device: Union[str, torch.device] = 'cpu',
+               arch: Optional[dict] = None) -> nn.Module:
+    '''
+    Model of a `save_model` checkpoint, built without random initialization:
+    it is created on the meta device and the checkpoint's tensors, memory-
+    mapped from the file, are assigned to it, so weights are only paged in
+    as they are moved to `device`. Backbone layers are frozen as in the
+    saved model (`arch['trainable_offset']`), else as by
+    `make_model_from_dict`.
+
+    Plain state dicts (saved before `save_model`) also load, given `arch`,
+    with keys matched by `match_state_dict`.
+    '''
+    checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    if 'arch' in checkpoint and 'state_dict' in checkpoint:
+        arch, state_dict = checkpoint['arch'], checkpoint['state_dict']
+    elif arch is not None:
+        state_dict = checkpoint
+    else:
+        raise ValueError('%s is a plain state dict, `arch` is required' % path)
+    with torch.device('meta'):
+        model = make_model(None, **dict({'trainable_offset': 3}, **arch))
+    model.load_state_dict(match_state_dict(state_dict, model.state_dict()), assign=True)
+    # Anchor templates are plain tensors rather than buffers, so are rebuilt
+    model.rpn.anchor_generator = make_anchor_generator(arch['anchor_sizes'], arch['aspect_ratios'])
+    return model.to(device)
+
+
+def save_training_state(path: Union[str, pathlib.Path],
+                        model: nn.Module,
+                        optimizer: optim.Optimizer,
+                        arch: dict,
+                        epoch: int,
+                        step: int,
+                        lr_scheduler=None,
+                        writer: Optional[CheckpointWriter] = None,
+                        validate: bool = False) -> None:
+    '''
+    `save_model` checkpoint (so `load_model` reads its model) which also
+    holds everything needed to resume training after `step` batches of
+    `epoch`: optimizer (momentum buffers), LR scheduler and RNG states.
+    `validate` marks a state saved at the end of epoch `epoch - 1` before
+    it was validated, so resuming validates it first.
+    '''
+    save_model(model, path, arch, writer,
+               optimizer=optimizer.state_dict(),
+               lr_scheduler=lr_scheduler.state_dict() if lr_scheduler is not None else None,
+               epoch=epoch,
+               step=step,
+               validate=validate,
+               rng=rng_state())
+
+
+def load_training_state(path: Union[str, pathlib.Path],
+                        optimizer: optim.Optimizer,
+                        lr_scheduler=None) -> Tuple[int, int, bool]:
+    '''
+    Restores the optimizer, LR scheduler and RNG states of a
+    `save_training_state` checkpoint, whose model is read by `load_model`.
+    Returns (epoch, step, validate): the position training resumes from,
+    where the samplers' `set_epoch` skips the samples already seen, and
+    whether epoch `epoch - 1` still has to be validated. RNGs of DataLoader
+    workers (per-sample transforms) are reseeded rather than restored.
+    '''
+    checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    if lr_scheduler is not None and checkpoint['lr_scheduler'] is not None:
+        lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+    set_rng_state(checkpoint['rng'])
+    return checkpoint['epoch'], checkpoint['step'], checkpoint.get('validate', False)
 
 
 def train_print(i, running_loss, 
@@ -423,17 +2086,32 @@ def train_one_epoch(model,
                     lr_scheduler,
                     batch_size,
                     print_every,
-                    num_epochs):
+                    num_epochs,
+                    augment: Optional[BatchAugment] = None,
+                    start_step: int = 0,
+                    checkpoint_fn: Optional[Callable[[int], None]] = None,
+                    checkpoint_every: int = 0,
+                    stop: Optional[threading.Event] = None,
+                    from_activations: bool = False):
+    # `data_loader` starts after the `start_step` batches already done (see
+    # `ValidSampler.set_epoch`); `checkpoint_fn(step)` is called every
+    # `checkpoint_every` steps, and once more before returning early when
+    # `stop` is set (e.g. `CheckpointWriter.preempted`). With
+    # `from_activations` the inputs are cached `BackbonePrefix` activations
     model.train()
     running_loss = 0.0
     minibatch_time = 0.0
 
-    for i, (inputs, targets) in enumerate(data_loader):
+    for i, (inputs, targets) in enumerate(data_loader, start_step):
         start = time.time()
-        inputs = [Variable(input).to(device) for input in inputs]
         targets = [{k: Variable(v).to(device) for k, v in t.items()} for t in targets]
-
-        loss_dict = model(inputs, targets)
+        if from_activations:
+            loss_dict = forward_from_activations(model, inputs.to(device, non_blocking=True), targets)
+        else:
+            if augment is not None:
+                inputs, targets = augment(inputs.to(device, non_blocking=True), targets)
+            inputs = [Variable(input).to(device) for input in inputs]
+            loss_dict = model(inputs, targets)
         losses = sum(loss for loss in loss_dict.values())
         if not math.isfinite(losses):
             #print("Loss is %-10.5f, skipping this batch...\n" % losses)
@@ -449,6 +2127,13 @@ def train_one_epoch(model,
         if lr_scheduler is not None:
             lr_scheduler.step()
 
+        if stop is not None and stop.is_set():
+            if checkpoint_fn is not None:
+                checkpoint_fn(i + 1)
+            return model
+        if checkpoint_fn is not None and checkpoint_every > 0 and (i + 1) % checkpoint_every == 0:
+            checkpoint_fn(i + 1)
+
         running_loss += losses
         end = time.time()
         minibatch_time += float(end - start)
@@ -570,14 +2255,19 @@ def calculate_map(gt_boxes,
 
 
 @torch.no_grad()
-def evaluate(model, data_loader, device, thresh_list):
+def evaluate(model, data_loader, device, thresh_list, augment: Optional[BatchAugment] = None,
+             stop: Optional[threading.Event] = None):
+    # Returns None if `stop` (e.g. `CheckpointWriter.preempted`) is set
+    # before all batches are evaluated
     #cpu_device = torch.device("cpu")
     model.eval()
     start = time.time()
     mAP_dict = {thresh: [] for thresh in thresh_list}
     for images, targets in data_loader:
-        images = list(Variable(img).to(device) for img in images)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        if augment is not None:
+            images, targets = augment(images.to(device, non_blocking=True), targets)
+        images = list(Variable(img).to(device) for img in images)
 
         outputs = model(images, targets)
         #outputs = [{k: v.to(device) for k, v in t.items()} for t in outputs]
@@ -590,6 +2280,8 @@ def evaluate(model, data_loader, device, thresh_list):
                                       device=device) \
                         for target, output in zip(targets, outputs)]
             mAP_dict[thresh] += mAP_list # Creates a list of mAP's for each sample
+        if stop is not None and stop.is_set():
+            return None
     end = time.time()
     for thresh in thresh_list:
         mAP_dict[thresh] = np.mean(mAP_dict[thresh])
@@ -625,14 +2317,73 @@ def main(savepath,
         # All samples have at least one ground truth bbox
         'no_null_samples': True,
         'test_size': 0.01,
+        # Train and validate on one image per group of near-duplicates, as
+        # listed by `near_duplicates.py` in the index's `dedup_ids.npy`
+        'dedup': False,
+        # Keep the distribution of boxes per image equal in train and valid
+        'stratify_split': False,
         'shuffle': True,       
         'batch_size': 12,
+        # See `loader_benchmark.py` for images/sec at different worker counts
+        'num_workers': 8,
+        'persistent_workers': True,
+        'prefetch_factor': 2,
         'num_epochs': 30,
         'print_every': 500,
+        # Periodically save the full training state (model, optimizer, RNGs,
+        # epoch and step) next to `savepath` and resume from it when present
+        'resume': True,
+        'checkpoint_every': 1000,
+        # Checkpoints are written in the background; per-epoch copies are
+        # kept for the last `keep_checkpoints` epochs plus the best by mAP.
+        # On SIGTERM (preemption) the current step is saved within the deadline
+        'keep_checkpoints': 3,
+        'preempt_deadline': 30.0,
+        # Decode and resize every image once into a uint8 memmap (~27GB for
+        # the full dataset at 299x299) and read tiles from it during training
+        'tile_cache': False,
+        'tile_cache_workers': 8,
+        # Precompute augmented variants of every training tile (see
+        # `REPLAY_VARIANTS`, 2 x ~27GB) and read one per sample, picked with
+        # the same probabilities, instead of blurring during training
+        'replay_cache': False,
+        # Stream training images from large sequential shard files (written
+        # once from the index) through a shuffle buffer instead of reading
+        # loose JPEGs at random
+        'shards': False,
+        'records_per_shard': 512,
+        'shard_buffer_size': 2048,
         # Increase number of detections since there may be many vessels in an image
         'box_detections_per_img': 256,
+        # Blur and normalize whole batches on the GPU instead of per sample
+        # in the workers; same probabilities as the PIL transforms
+        'batch_augment': True,
+        # Decode 768x768 JPEGs at 384x384 in the DCT domain before resizing
+        # to 299x299; `None` decodes at full size. See `loader_benchmark.py`
+        'draft_size': (384, 384),
+        'train_blur_p': 0.95,
+        'valid_blur_p': 1.0,
+        # Read every image's size from its JPEG header when compiling the
+        # index, instead of assuming 768x768, and batch training images of
+        # the same size (or of the same aspect ratio bin with `aspect_bins`)
+        'probe_sizes': True,
+        'group_by_size': False,
+        'aspect_bins': None,
+        # Decode, resize and blur the validation set once into a memmap
+        # under the index (rebuilt when the transforms change) instead of
+        # on every evaluation pass
+        'freeze_valid': True,
+        # Run the frozen backbone layers once over the (always blurred)
+        # training images, store their output activations under the index
+        # (rebuilt when the frozen weights change) and train only the
+        # trainable layers and heads from them; no random blur. float16
+        # halves the cache; activations beyond its range raise, use float32
+        'activation_cache': False,
+        'activation_dtype': np.float16,
         # Use small anchor boxes since targets are small
         'anchor_sizes': ((4,), (8,), (16,), (32,), (64,)),
+        # Same ratios for every anchor size; `anchor_stats.py` fits both from the data
+        'aspect_ratios': (0.25, 0.5, 1.0, 2.0, 4.0),
         # IoU thresholds for mAP calculation
         'thresh_list': np.arange(0.5, 0.76, 0.05).round(8)
     }
@@ -644,23 +2395,24 @@ def main(savepath,
 
     # NOTE: InceptionV3 backbone requires input samples of size 299x299x3
     anchor_sizes = params['anchor_sizes']
+    aspect_ratios = params['aspect_ratios']
     num_classes = params['num_classes']
     box_detections_per_img = params['box_detections_per_img']
     num_trainable_backbone_layers = params['num_trainable_backbone_layers']
-    if state_dict is not None:
-        model = make_model_from_dict(state_dict,
-                                     backbone_state_dict,
-                                     num_classes=num_classes,
-                                     anchor_sizes=anchor_sizes,
-                                     box_detections_per_img=box_detections_per_img,
-                                     num_trainable_backbone_layers=num_trainable_backbone_layers
-        )
+    resume_path = os.path.splitext(savepath)[0] + '_training_state.pth'
+    resume = params['resume'] and os.path.exists(resume_path)
+    if resume:
+        model = load_model(resume_path)
+    elif state_dict is not None:
+        # `save_model` checkpoints carry their own architecture parameters
+        model = load_model(state_dict, arch=model_arch(params))
     else:
         model = make_model(backbone_state_dict,
                            num_classes=num_classes,
                            anchor_sizes=anchor_sizes,
                            box_detections_per_img=box_detections_per_img,
-                           num_trainable_backbone_layers=num_trainable_backbone_layers
+                           num_trainable_backbone_layers=num_trainable_backbone_layers,
+                           aspect_ratios=aspect_ratios
         )
     
     device = torch.device('cuda')
@@ -674,77 +2426,272 @@ def main(savepath,
                           lr=lr,
                           momentum=momentum,
                           weight_decay=weight_decay)
+    lr_scheduler = None
+    start_epoch, start_step, rng, validate = 0, 0, None, False
+    if resume:
+        start_epoch, start_step, validate = load_training_state(resume_path, optimizer,
+                                                                lr_scheduler)
+        # Restored again right before training; building the datasets below may draw from them
+        rng = rng_state()
+        print('Resuming from epoch %d, step %d.\n' % (start_epoch + 1, start_step))
+    # Installed before the caches are built, whose loops also stop on SIGTERM
+    writer = CheckpointWriter(keep_last=params['keep_checkpoints'],
+                              deadline=params['preempt_deadline'])
+    writer.handle_sigterm()
+
+    def exit_if_preempted():
+        # The training state is saved before this point; wait for pending writes
+        if writer.preempted.is_set():
+            print('Preempted, exiting...\n')
+            writer.close(timeout=params['preempt_deadline'])
+            sys.exit(128 + signal.SIGTERM)
     
     ship_dir = '../../../data/airbus-ship-detection/'
     train_image_dir = os.path.join(ship_dir, 'train_v2/')
     valid_image_dir = os.path.join(ship_dir, 'train_v2/')
-    masks = get_masks(ship_dir, train_image_dir, valid_image_dir)
 
     no_null_samples = params['no_null_samples']
-    image_names, filtered_masks = filter_masks(masks, no_null_samples=no_null_samples)
-    
-    test_size = params['test_size']
-    train_ids, train_masks, valid_ids, valid_masks = get_train_valid_dfs(
-        filtered_masks, seed, test_size=test_size
-    )
+    # Compile the filtered annotations once; later runs only memory-map them
+    index_dir = os.path.join(ship_dir, 'annotation_index_no_null/' if no_null_samples \
+                             else 'annotation_index/')
+    # Add one entry per additional dataset; each keeps its own image root
+    sources = [
+        {'csv': os.path.join(ship_dir, 'train_ship_segmentations_v2.csv'),
+         'image_dir': train_image_dir},
+    ]
+    if not os.path.exists(os.path.join(index_dir, 'boxes.npy')):
+        report = ingest_annotations(sources, index_dir, no_null_samples=no_null_samples,
+                                    probe_sizes=params['probe_sizes'],
+                                    num_workers=params['num_workers'])
+        print_validity_report(report)
+    index = AnnotationIndex(index_dir)
 
-    vessel_dataset = VesselDataset(train_masks,
+    test_size = params['test_size']
+    # Batches added with `append_labels` keep their stored assignment
+    keep_ids = None
+    if params['dedup']:
+        keep_ids = np.load(os.path.join(index_dir, 'dedup_ids.npy'))
+    train_ids, valid_ids = index.split(seed, test_size=test_size, keep_ids=keep_ids,
+                                       stratify=params['stratify_split'])
+    # Tiles labeled positive without boxes are only usable by the classifier
+    train_ids = train_ids[index.has_box_targets(train_ids)]
+    valid_ids = valid_ids[index.has_box_targets(valid_ids)]
+
+    tile_cache = None
+    if params['tile_cache']:
+        cache_dir = os.path.join(index_dir, 'tile_cache_299/')
+        if not os.path.exists(os.path.join(cache_dir, 'names.npy')):
+            cache_ids = np.concatenate([train_ids, valid_ids])
+            # Roots may be directories or zip archives
+            images = [(index.image_dir(i) or train_image_dir, index.name(i)) for i in cache_ids]
+            build_tile_cache(images, cache_dir, num_workers=params['tile_cache_workers'],
+                             stop=writer.preempted)
+            exit_if_preempted()
+        tile_cache = TileCache(cache_dir)
+
+    train_tile_cache, variant_sampler = tile_cache, None
+    if params['replay_cache']:
+        replay_dir = os.path.join(index_dir, 'replay_cache_299/')
+        if not os.path.exists(os.path.join(replay_dir, 'names.npy')):
+            images = [(index.image_dir(i) or train_image_dir, index.name(i)) for i in train_ids]
+            build_tile_cache(images, replay_dir, num_workers=params['tile_cache_workers'],
+                             variants=REPLAY_VARIANTS, radius=2, stop=writer.preempted)
+            exit_if_preempted()
+        train_tile_cache = TileCache(replay_dir)
+        variant_sampler = VariantSampler(train_tile_cache.variants,
+                                         blur_p=params['train_blur_p'], seed=seed)
+
+    vessel_dataset = VesselDataset(None,
                                    train_ids,
-                                   image_names,
+                                   None,
                                    train_image_dir=train_image_dir,
-                                   mode='train')
-    vessel_valid_dataset = VesselDataset(valid_masks,
+                                   mode='train',
+                                   index=index,
+                                   tile_cache=train_tile_cache,
+                                   batch_augment=params['batch_augment'],
+                                   draft_size=params['draft_size'],
+                                   variant_sampler=variant_sampler,
+                                   filter_invalid=False)
+    vessel_valid_dataset = VesselDataset(None,
                                          valid_ids,
-                                         image_names,
+                                         None,
                                          valid_image_dir=valid_image_dir,
-                                         mode='valid')
+                                         mode='valid',
+                                         index=index,
+                                         tile_cache=tile_cache,
+                                         batch_augment=params['batch_augment'],
+                                         draft_size=params['draft_size'],
+                                         filter_invalid=False)
 
-    print("Train Size: %d" % len(train_ids))
-    print("Valid Size: %d" % len(valid_ids))
-    
     batch_size = params['batch_size']
     shuffle = params['shuffle']
-    collate_fn = lambda batch: tuple(zip(*batch))
-    loader = DataLoader(
-                dataset=vessel_dataset,
-                shuffle=shuffle,
-                #num_workers = 0,
-                batch_size=batch_size,
-                collate_fn=collate_fn,
-                pin_memory=torch.cuda.is_available()
-            )
-
-    valid_loader = DataLoader(
-                dataset=vessel_valid_dataset,
-                shuffle=shuffle,
-                #num_workers = 0,
-                batch_size=batch_size,
-                collate_fn=collate_fn,
-                pin_memory=torch.cuda.is_available()
-            )
+    # Skip images with boxes that become degenerate at 299x299 without loading
+    # them; the datasets keep all IDs (`filter_invalid=False`) so that sampler
+    # positions index the full split
+    # Seeded per epoch so a resumed epoch replays the same order
+    sampler = ValidSampler(vessel_dataset.valid_mask(), shuffle=shuffle, seed=seed)
+    valid_sampler = ValidSampler(vessel_valid_dataset.valid_mask(), shuffle=shuffle)
+    print("Train Size: %d (%d excluded, invalid boxes after resizing)" %
+          (len(sampler), sampler.num_excluded))
+    print("Valid Size: %d (%d excluded, invalid boxes after resizing)" %
+          (len(valid_sampler), valid_sampler.num_excluded))
+    
+    collate_fn = list_collate
+    augment, valid_augment = None, None
+    if params['batch_augment']:
+        collate_fn = stack_collate
+        # Cached variants are already blurred (or not)
+        augment = BatchAugment(blur_p=0.0 if params['replay_cache'] else params['train_blur_p'],
+                               radius=2)
+        valid_augment = BatchAugment(blur_p=params['valid_blur_p'], radius=2)
+    loader_params = {
+        'collate_fn': collate_fn,
+        'num_workers': params['num_workers'],
+        'persistent_workers': params['persistent_workers'],
+        'prefetch_factor': params['prefetch_factor'],
+        'seed': seed,
+    }
+    shard_dataset = None
+    from_activations = params['activation_cache']
+    if from_activations:
+        activation_source = VesselDataset(None,
+                                          train_ids,
+                                          None,
+                                          valid_image_dir=train_image_dir,
+                                          mode='valid',
+                                          index=index,
+                                          tile_cache=tile_cache,
+                                          batch_augment=params['batch_augment'],
+                                          draft_size=params['draft_size'],
+                                          filter_invalid=False)
+        prefix = BackbonePrefix(model,
+                                augment=BatchAugment(blur_p=1.0, radius=2) \
+                                    if params['batch_augment'] else None,
+                                device=device)
+        print('Caching activations of the first %d backbone layers...\n' % prefix.length)
+        activation_dataset = FrozenDataset(Subset(activation_source, sampler.indices),
+                                           cache_dir=os.path.join(index_dir, 'activation_cache/'),
+                                           config={'seed': seed},
+                                           prepare=prefix,
+                                           batch_size=batch_size,
+                                           num_workers=params['num_workers'],
+                                           dtype=params['activation_dtype'],
+                                           stop=writer.preempted)
+        exit_if_preempted()
+        sampler = ValidSampler(np.ones(len(activation_dataset), dtype=bool),
+                               shuffle=shuffle, seed=seed)
+        augment = None
+        loader = make_loader(activation_dataset, batch_size, sampler=sampler,
+                             **dict(loader_params, collate_fn=stack_collate, num_workers=0))
+    elif params['shards']:
+        shard_dir = os.path.join(index_dir, 'shards_train/')
+        if not os.path.exists(os.path.join(shard_dir, 'counts.npy')):
+            # Only images the sampler would draw are packed
+            write_shards(index, train_ids[sampler.indices], shard_dir,
+                         image_dir=train_image_dir,
+                         records_per_shard=params['records_per_shard'],
+                         seed=seed,
+                         stop=writer.preempted)
+            exit_if_preempted()
+        shard_dataset = ShardDataset(shard_dir, dataset=vessel_dataset, shuffle=shuffle,
+                                     buffer_size=params['shard_buffer_size'], seed=seed)
+        # Workers must be restarted to see `set_epoch`
+        loader = make_loader(shard_dataset, batch_size,
+                             **dict(loader_params, persistent_workers=False))
+    elif params['group_by_size']:
+        batch_sampler = GroupedBatchSampler(vessel_dataset.image_sizes(), batch_size,
+                                            indices=sampler.indices,
+                                            aspect_bins=params['aspect_bins'],
+                                            shuffle=shuffle,
+                                            seed=seed)
+        loader = make_loader(vessel_dataset, batch_size, batch_sampler=batch_sampler,
+                             **loader_params)
+    else:
+        loader = make_loader(vessel_dataset, batch_size, sampler=sampler, **loader_params)
+    if params['freeze_valid']:
+        prepare = None
+        if params['batch_augment']:
+            # Blur is applied once when freezing; only normalization is left
+            prepare = BatchAugment(blur_p=params['valid_blur_p'], radius=2, normalize=False)
+            valid_augment = BatchAugment()
+        frozen_valid_dataset = FrozenDataset(Subset(vessel_valid_dataset, valid_sampler.indices),
+                                             cache_dir=os.path.join(index_dir, 'valid_cache/'),
+                                             config={'seed': seed},
+                                             prepare=prepare,
+                                             batch_size=batch_size,
+                                             num_workers=params['num_workers'],
+                                             stop=writer.preempted)
+        exit_if_preempted()
+        valid_loader = make_loader(frozen_valid_dataset, batch_size, shuffle=shuffle,
+                                   **dict(loader_params, num_workers=0))
+    else:
+        valid_loader = make_loader(vessel_valid_dataset, batch_size, sampler=valid_sampler,
+                                   **loader_params)
     
     num_epochs = params['num_epochs']
     print_every = params['print_every']
     thresh_list = params['thresh_list']
+    arch = model_arch(params)
+
+    def save_checkpoint(epoch, step, validate=False):
+        save_training_state(resume_path, model, optimizer, arch, epoch, step, lr_scheduler,
+                            writer=writer, validate=validate)
+
+    def validate_epoch(epoch):
+        print('Epoch %d completed. Running validation...\n' % (epoch + 1))
+        mAP = evaluate(model, valid_loader, device, thresh_list, augment=valid_augment,
+                       stop=writer.preempted)
+        exit_if_preempted()
+        print_metrics(mAP, epoch, thresh_list)
+        print('Saving Model...\n')
+        save_model(model, savepath, arch, writer)
+        epoch_path = os.path.splitext(savepath)[0] + '_epoch%d.pth' % (epoch + 1)
+        save_model(model, epoch_path, arch, writer, epoch=epoch + 1, mAP=float(mAP))
+        writer.retain(epoch_path, metric=float(mAP))
+        # The epoch is validated and retained; a resume no longer repeats it
+        save_checkpoint(epoch + 1, 0)
+        print('Model Saved.\n')
+        exit_if_preempted()
 
+    if rng is not None:
+        set_rng_state(rng)
+    if validate:
+        # Preempted before the last epoch trained was validated
+        validate_epoch(start_epoch - 1)
     print('Starting Training...\n')
-    for epoch in range(num_epochs):      
+    for epoch in range(start_epoch, num_epochs):      
+        step = start_step if epoch == start_epoch else 0
+        if shard_dataset is not None:
+            # The shuffle buffer cannot be replayed; resume at the epoch's start
+            step = 0
+            shard_dataset.set_epoch(epoch)
+        elif params['group_by_size'] and not from_activations:
+            batch_sampler.set_epoch(epoch, step)
+        else:
+            sampler.set_epoch(epoch, step * batch_size)
         model = train_one_epoch(model,
                                 optimizer,
                                 loader,
                                 device,
                                 epoch,
-                                lr_scheduler = None, 
+                                lr_scheduler = lr_scheduler, 
                                 batch_size=batch_size,
                                 print_every=print_every,
-                                num_epochs = num_epochs
+                                num_epochs = num_epochs,
+                                augment=augment,
+                                start_step=step,
+                                checkpoint_fn=lambda step: save_checkpoint(epoch, step),
+                                checkpoint_every=params['checkpoint_every'],
+                                stop=writer.preempted,
+                                from_activations=from_activations
         )
-        print('Epoch %d completed. Running validation...\n' % (epoch + 1))
-        mAP = evaluate(model, valid_loader, device, thresh_list)
-        print_metrics(mAP, epoch, thresh_list)
-        print('Saving Model...\n')
-        torch.save(model.state_dict(), savepath)
-        print('Model Saved.\n')
+        # `train_one_epoch` saved the training state if it stopped early
+        exit_if_preempted()
+        # Saved before validation, so a preemption from here on loses no
+        # training, and marked so that resuming validates the epoch
+        save_checkpoint(epoch + 1, 0, validate=True)
+        validate_epoch(epoch)
+    writer.close()
     print('Finished Training.\n')
 
 